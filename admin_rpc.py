@@ -0,0 +1,224 @@
+"""
+Small RPC server for the admin operations of the DB, e.g. for ``tools/remote-admin.py``.
+This avoids sending Python code into the IPython kernel and parsing the repr of the result.
+
+Protocol: JSON, one message per line, over a Unix socket which is only accessible by the owner (mode 0600).
+By default, the socket is ``<db>/local/admin-rpc.sock`` (see :func:`get_default_socket_path`).
+
+Request: ``{"id": 1, "method": "drinker_pay", "params": ["max", "10"]}``.
+Response: ``{"id": 1, "result": ...}``, or ``{"id": 1, "error": {"type": "...", "message": "..."}}``.
+
+A list of requests (batch) gets a list of responses.
+Requests on one connection are handled in order, so a client can send many requests
+before it reads the responses (pipelining).
+
+Money amounts are strings (e.g. ``"1.50"``), to not lose precision.
+Drinkers are dicts with the keys :data:`db.Drinker.CodecAttribs`.
+"""
+
+import os
+import sys
+import json
+import socket
+import socketserver
+from decimal import Decimal
+from threading import Thread
+from db import Db, Drinker, BuyItem, AdminCashPosition
+from utils import time_stamp
+
+
+def get_default_socket_path(db_path):
+    """
+    :param str db_path: DB directory
+    :return: socket path in the local state directory of the DB (ignored by Git), see :class:`db.Db`
+    :rtype: str
+    """
+    return "%s/%s/admin-rpc.sock" % (db_path, Db.LocalDirName)
+
+
+def to_json_obj(obj):
+    """
+    :param object obj: result of some DB method
+    :return: object which can be serialized via JSON
+    """
+    if obj is None or isinstance(obj, (bool, int, str)):
+        return obj
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, Drinker):
+        return {attr: to_json_obj(getattr(obj, attr)) for attr in Drinker.CodecAttribs}
+    if isinstance(obj, AdminCashPosition):
+        return {"cash_position": str(obj.cash_position), "purchases": to_json_obj(obj.purchases)}
+    if isinstance(obj, BuyItem):
+        return {"intern_name": obj.intern_name, "shown_name": obj.shown_name, "price": str(obj.price)}
+    if isinstance(obj, dict):
+        return {key: to_json_obj(value) for (key, value) in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json_obj(value) for value in obj]
+    raise TypeError("admin RPC: cannot serialize %r" % (obj,))
+
+
+class AdminRpc:
+    """
+    The methods which can be called via RPC, and the JSON handling. Independent from the transport,
+    i.e. this is used by :class:`AdminRpcServer`, and can also be called in the IPython kernel.
+    """
+
+    # These do not change anything.
+    ReadOnlyMethods = {
+        "get_db_path",
+        "get_drinker_names",
+        "get_drinkers_credit_balances",
+        "get_drinker_inactive_and_non_neg_balance",
+        "get_buy_items",
+        "get_drinker",
+        "get_admin_state_formatted",
+        "export_state",
+    }
+
+    def __init__(self, db, extra_methods=None, read_only=False):
+        """
+        :param Db db:
+        :param dict[str,()->None]|None extra_methods: e.g. "reload" and "exit" from main.py
+        :param bool read_only: only allow :data:`ReadOnlyMethods`
+        """
+        self.db = db
+        self.read_only = read_only
+        self.methods = {
+            "get_db_path": lambda: db.path,
+            "get_drinker_names": db.get_drinker_names,
+            "get_drinkers_credit_balances": db.get_drinkers_credit_balances,
+            "get_drinker_inactive_and_non_neg_balance": db.get_drinker_inactive_and_non_neg_balance,
+            "get_buy_items": db.get_buy_items,
+            "get_drinker": db.get_drinker,
+            "get_admin_state_formatted": db.get_admin_state_formatted,
+            "export_state": db.export_state,
+            "drinker_buy_item": db.drinker_buy_item,
+            "drinker_pay": db.drinker_pay,
+            "admin_pay": db.admin_pay,
+            "admin_set_cash_position": db.admin_set_cash_position,
+            "drinkers_delete": db.drinkers_delete,
+            "apply_batch": db.apply_batch,
+        }  # type: dict
+        if extra_methods:
+            self.methods.update(extra_methods)
+
+    def handle(self, request):
+        """
+        :param dict[str]|list[dict[str]] request: single request or batch, see module docstring
+        :return: response, or list of responses for a batch
+        :rtype: dict[str]|list[dict[str]]
+        """
+        if isinstance(request, list):
+            return [self.handle(r) for r in request]
+        request_id = request.get("id") if isinstance(request, dict) else None
+        # noinspection PyBroadException
+        try:
+            if not isinstance(request, dict) or not isinstance(request.get("params", []), list):
+                raise ValueError("invalid request %r" % (request,))
+            method = request.get("method")
+            if method not in self.methods:
+                raise ValueError("unknown method %r, available: %s" % (method, ", ".join(sorted(self.methods))))
+            if self.read_only and method not in self.ReadOnlyMethods:
+                raise PermissionError("%s is not allowed in read-only mode, changes go through the kiosk" % method)
+            result = to_json_obj(self.methods[method](*request.get("params", [])))
+        except Exception as exc:
+            print("%s: admin RPC %r failed: %s: %s" % (time_stamp(), request, type(exc).__name__, exc))
+            return {"id": request_id, "error": {"type": type(exc).__name__, "message": str(exc)}}
+        return {"id": request_id, "result": result}
+
+    def handle_json(self, s):
+        """
+        :param str s: JSON request (or batch)
+        :return: JSON response (or batch)
+        :rtype: str
+        """
+        try:
+            request = json.loads(s)
+        except ValueError as exc:
+            return json.dumps({"id": None, "error": {"type": type(exc).__name__, "message": str(exc)}})
+        return json.dumps(self.handle(request))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server = None  # type: AdminRpcServer
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            self.wfile.write(self.server.rpc.handle_json(line.decode("utf8")).encode("utf8") + b"\n")
+            self.wfile.flush()
+
+
+class AdminRpcServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves :class:`AdminRpc` on a Unix socket, in background threads (one per connection).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, rpc, socket_path):
+        """
+        :param AdminRpc rpc:
+        :param str socket_path:
+        """
+        self.rpc = rpc
+        self.socket_path = os.path.abspath(socket_path)
+        if os.path.exists(self.socket_path):
+            self._remove_stale_socket()
+        super(AdminRpcServer, self).__init__(self.socket_path, _RequestHandler)
+        self.thread = Thread(target=self.serve_forever, name="AdminRpcServer", daemon=True)
+        self.thread.start()
+        print("Admin RPC on socket %s." % self.socket_path)
+
+    def _remove_stale_socket(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.socket_path)
+        except OSError:
+            os.remove(self.socket_path)  # left over from a previous run
+        else:
+            raise Exception("admin RPC: socket %s is in use, is another kiosk running?" % self.socket_path)
+        finally:
+            s.close()
+
+    def server_bind(self):
+        super(AdminRpcServer, self).server_bind()
+        # Before listen(), so nobody else can ever connect.
+        os.chmod(self.socket_path, 0o600)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def main():
+    """
+    Serves the given DB, without GUI. For testing.
+    """
+    import argparse
+    import better_exchook
+
+    better_exchook.install()
+    arg_parser = argparse.ArgumentParser(description="Serve the admin RPC for the DB, without GUI.")
+    arg_parser.add_argument("--db", required=True, help="path to database")
+    arg_parser.add_argument("--socket", help="default: <db>/local/admin-rpc.sock")
+    args = arg_parser.parse_args()
+    db = Db(path=args.db)
+    server = AdminRpcServer(AdminRpc(db), socket_path=args.socket or get_default_socket_path(db.path))
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        print("KeyboardInterrupt", file=sys.stderr)
+    finally:
+        server.close()
+        db.at_exit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+"""
+Codec for the DB state files (drinkers, admin cash position) and the config files (e.g. buy items).
+
+The files are written in the :func:`utils.better_repr` format, i.e. they are valid Python expressions,
+and historically they were read back via ``eval``.
+The parser here supports exactly the subset of Python expressions which we write
+(and which is used in the hand-written config files), and it never executes any code.
+"""
+
+import re
+from decimal import Decimal
+from utils import better_repr
+
+
+class ParseError(Exception):
+    """
+    Invalid or unsupported syntax.
+    """
+
+
+def format_obj(obj):
+    """
+    :param object obj: some object with the attribute ``CodecAttribs``, e.g. :class:`db.Drinker`
+    :return: the repr of the object, like ``Drinker(\\nname='foo',\\n...)``
+    :rtype: str
+    """
+    return "%s(\n%s)" % (
+        obj.__class__.__name__,
+        ",\n".join(["%s=%s" % (attr, better_repr(getattr(obj, attr))) for attr in obj.CodecAttribs]),
+    )
+
+
+def dumps(obj):
+    """
+    :param object obj:
+    :return: file content
+    :rtype: str
+    """
+    if hasattr(obj, "CodecAttribs"):
+        return "%s\n" % format_obj(obj)
+    return "%s\n" % better_repr(obj)
+
+
+def loads(s, names, filename="<string>"):
+    """
+    :param str s: file content
+    :param dict[str,object] names: available names. callables can be called, e.g. ``{"Drinker": Drinker}``.
+        True, False, None and Decimal are always available.
+    :param str filename: for error messages
+    :return: parsed object
+    """
+    if s[:1] in _NameStartChars:
+        obj = _loads_obj_fast(s, names=names)
+        if obj is not None:
+            return obj
+    return _Parser(s, names=names, filename=filename).parse()
+
+
+def _loads_obj_fast(s, names):
+    """
+    Fast path for the format written by :func:`format_obj`, i.e. one attribute per line,
+    where all the values fit into a single line.
+    This just splits the lines, and handles the common simple values (str, Decimal, small dict str->int) directly.
+    Any other value is parsed via :class:`_Parser`.
+
+    :param str s:
+    :param dict[str,object] names:
+    :return: parsed object, or None if the format does not match. in that case, use the generic :class:`_Parser`
+    """
+    lines = s.rstrip("\n").split("\n")
+    if len(lines) < 2 or not lines[0].endswith("(") or not lines[-1].endswith(")"):
+        return None
+    func = names.get(lines[0][:-1])
+    if not callable(func):
+        return None
+    kwargs = {}
+    for i in range(1, len(lines)):
+        line = lines[i][:-1]  # remove "," or final ")"
+        key, sep, value_str = line.partition("=")
+        if not sep or not key.isidentifier() or key in kwargs:
+            return None
+        value = _loads_simple_value(value_str)
+        if value is _NoValue:
+            try:
+                value = _Parser(value_str, names=names, filename="").parse()
+            except ParseError:
+                return None
+        kwargs[key] = value
+    try:
+        return func(**kwargs)
+    except (TypeError, ValueError, ArithmeticError):
+        return None
+
+
+_NoValue = object()
+
+
+def _loads_simple_value(s):
+    """
+    :param str s: e.g. "'foo'" or "Decimal('1.5')" or "{'Coffee': 3}"
+    :return: value, or _NoValue if this is not one of the simple cases
+    """
+    c = s[:1]
+    if c == "'":
+        value = s[1:-1]
+        if s[-1:] == "'" and "'" not in value and "\\" not in value:
+            return value
+    elif c == "D":
+        if s.startswith("Decimal('") and s.endswith("')"):
+            value = s[9:-2]
+            if "'" not in value:
+                return Decimal(value)
+    elif c == "{":
+        if s[-1:] != "}":
+            return _NoValue
+        if s == "{}":
+            return {}
+        res = {}
+        for item in s[1:-1].split(", "):
+            key, sep, value = item.partition(": ")
+            key_ = key[1:-1]
+            if (
+                not sep
+                or key[:1] != "'"
+                or key[-1:] != "'"
+                or "'" in key_
+                or "\\" in key_
+                or not value.lstrip("-").isdigit()
+                or key_ in res
+            ):
+                return _NoValue
+            res[key_] = int(value)
+        return res
+    return _NoValue
+
+
+_DefaultNames = {"True": True, "False": False, "None": None, "Decimal": Decimal}
+
+# All tokens are found in a single pass by this regex. Whitespace is skipped.
+# Any other char (last alternative) is an error, which is reported by the parser.
+_TokenRe = re.compile(
+    r"""('(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*"|[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?"""
+    r"""|[A-Za-z_]\w*|#[^\n]*|\S)"""
+)
+_EscapeRe = re.compile(r"\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|[0-7]{1,3}|.)", re.S)
+_SimpleEscapes = {
+    "\n": "",
+    "\\": "\\",
+    "'": "'",
+    '"': '"',
+    "a": "\a",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+}
+_NameStartChars = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_")
+_NumberStartChars = frozenset("0123456789+-.")
+
+
+def _unescape_match(m):
+    """
+    :param typing.Match m:
+    :rtype: str
+    """
+    esc = m.group(1)
+    if esc in _SimpleEscapes:
+        return _SimpleEscapes[esc]
+    if esc[0] in "xuU":
+        return chr(int(esc[1:], 16))
+    if esc[0] in "01234567":
+        return chr(int(esc, 8))
+    return "\\" + esc  # like Python, keep unknown escapes as-is
+
+
+class _Parser:
+    def __init__(self, s, names, filename):
+        """
+        :param str s:
+        :param dict[str,object] names:
+        :param str filename:
+        """
+        tokens = _TokenRe.findall(s)
+        if "#" in s:
+            tokens = [tok for tok in tokens if tok[0] != "#"]
+        self.num_tokens = len(tokens)
+        tokens.extend(["", ""])  # end markers, such that we never need to check the index
+        self.tokens = tokens
+        self.pos = 0
+        self.names = _DefaultNames.copy()
+        self.names.update(names)
+        self.filename = filename
+
+    def parse(self):
+        """
+        :return: the single expression in the string
+        """
+        value = self._parse_value()
+        if self.pos != self.num_tokens:
+            self._error("unexpected trailing content")
+        return value
+
+    def _error(self, msg):
+        if self.pos >= self.num_tokens:
+            at = "end"
+        else:
+            at = repr(" ".join(self.tokens[self.pos : min(self.pos + 5, self.num_tokens)]))
+        raise ParseError("%s, token %i: %s, at %s" % (self.filename, self.pos, msg, at))
+
+    def _expect(self, tok):
+        """
+        :param str tok:
+        """
+        if self.tokens[self.pos] != tok:
+            self._error("expected %r" % tok)
+        self.pos += 1
+
+    def _parse_value(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        c = tok[:1]
+        if c == "'" or c == '"':
+            if "\\" in tok:
+                return _EscapeRe.sub(_unescape_match, tok[1:-1])
+            return tok[1:-1]
+        if c in _NameStartChars:
+            if tok not in self.names:
+                self.pos -= 1
+                self._error("unknown name %r" % tok)
+            if self.tokens[self.pos] == "(":
+                self.pos += 1
+                return self._parse_call(self.names[tok])
+            return self.names[tok]
+        if c == "{":
+            return self._parse_dict_or_set()
+        if c == "[":
+            return self._parse_seq("]")
+        if c == "(":
+            return self._parse_tuple()
+        if c.isdigit() or (c in _NumberStartChars and len(tok) > 1):
+            if "." in tok or "e" in tok or "E" in tok:
+                return float(tok)
+            return int(tok)
+        self.pos -= 1
+        self._error("unexpected token")
+
+    def _parse_seq(self, end):
+        """
+        :param str end: e.g. "]"
+        :rtype: list
+        """
+        tokens = self.tokens
+        items = []
+        while True:
+            if tokens[self.pos] == end:
+                self.pos += 1
+                return items
+            items.append(self._parse_value())
+            tok = tokens[self.pos]
+            if tok == ",":
+                self.pos += 1
+                continue
+            self._expect(end)
+            return items
+
+    def _parse_tuple(self):
+        """
+        :return: tuple, or the value itself for ``(x)`` (without comma)
+        """
+        items = self._parse_seq(")")
+        if len(items) == 1 and self.tokens[self.pos - 2] != ",":
+            return items[0]
+        return tuple(items)
+
+    def _parse_dict_or_set(self):
+        """
+        :rtype: dict|set
+        """
+        tokens = self.tokens
+        if tokens[self.pos] == "}":
+            self.pos += 1
+            return {}
+        first = self._parse_value()
+        if tokens[self.pos] == ":":
+            self.pos += 1
+            res = {first: self._parse_value()}
+            while tokens[self.pos] == ",":
+                self.pos += 1
+                if tokens[self.pos] == "}":
+                    break
+                key = self._parse_value()
+                self._expect(":")
+                res[key] = self._parse_value()
+            self._expect("}")
+            return res
+        res = {first}
+        while tokens[self.pos] == ",":
+            self.pos += 1
+            if tokens[self.pos] == "}":
+                break
+            res.add(self._parse_value())
+        self._expect("}")
+        return res
+
+    def _parse_call(self, func):
+        """
+        :param callable func:
+        :return: func(*args, **kwargs)
+        """
+        if not callable(func):
+            self._error("%r is not callable" % (func,))
+        tokens = self.tokens
+        args = []
+        kwargs = {}
+        while True:
+            if tokens[self.pos] == ")":
+                self.pos += 1
+                break
+            if tokens[self.pos + 1] == "=":
+                key = tokens[self.pos]
+                if key[:1] not in _NameStartChars:
+                    self._error("invalid keyword argument")
+                self.pos += 2
+                kwargs[key] = self._parse_value()
+            elif kwargs:
+                self._error("positional argument after keyword argument")
+            else:
+                args.append(self._parse_value())
+            tok = tokens[self.pos]
+            if tok == ",":
+                self.pos += 1
+                continue
+            self._expect(")")
+            break
+        try:
+            return func(*args, **kwargs)
+        except (TypeError, ValueError, ArithmeticError) as exc:
+            self._error("invalid call to %s: %s" % (getattr(func, "__name__", func), exc))
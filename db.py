@@ -1,13 +1,20 @@
-from typing import Optional, Union, Callable, List, Dict
-import sys
-import os
+from typing import Optional, Union, List, Dict, Tuple, Set
 from decimal import Decimal
 import subprocess
 from pprint import pprint
-from threading import RLock, Thread, Condition
-from utils import better_repr, is_git_dir, time_stamp
-import better_exchook
+from contextlib import ExitStack
+from threading import Lock
+from utils import time_stamp, OwnerTrackingLock, make_git_ignored_dir
+from journal import Journal
+from scheduler import Scheduler
+from events import EventBus
+from git_commit import GitCommitEngine
+from storage import Storage, make_storage, FileStorage, GitTreeStorage, SqliteStorage
+import codec
 import time
+import math
+import uuid
+import os
 
 
 class BuyItem:
@@ -24,6 +31,8 @@ class BuyItem:
 
 
 class Drinker:
+    CodecAttribs = ["name", "shown_name", "credit_balance", "buy_item_counts", "total_buy_item_counts"]
+
     def __init__(self, name, shown_name=None, credit_balance=0, buy_item_counts=None, total_buy_item_counts=None):
         """
         :param str name:
@@ -40,16 +49,49 @@ class Drinker:
         if self.buy_item_counts and not self.total_buy_item_counts:
             self.total_buy_item_counts = self.buy_item_counts.copy()
 
-    def __repr__(self):
-        attribs = ["name", "shown_name", "credit_balance", "buy_item_counts", "total_buy_item_counts"]
-        return "%s(\n%s)" % (
-            self.__class__.__name__,
-            ",\n".join(["%s=%s" % (attr, better_repr(getattr(self, attr))) for attr in attribs]),
+    def copy(self):
+        """
+        :return: deep copy (the counter dicts are not shared)
+        :rtype: Drinker
+        """
+        return Drinker(
+            name=self.name,
+            shown_name=self.shown_name,
+            credit_balance=self.credit_balance,
+            buy_item_counts=self.buy_item_counts.copy(),
+            total_buy_item_counts=self.total_buy_item_counts.copy(),
         )
 
+    def buy_item(self, item_name, price, amount=1):
+        """
+        :param str item_name: intern name
+        :param Decimal price: price of a single item
+        :param int amount: can be negative, to undo drinks
+        """
+        self.buy_item_counts.setdefault(item_name, 0)
+        self.buy_item_counts[item_name] += amount
+        if self.buy_item_counts[item_name] < 0:
+            self.buy_item_counts[item_name] = 0  # it's only for visual feedback; this makes more sense
+        self.total_buy_item_counts.setdefault(item_name, 0)
+        self.total_buy_item_counts[item_name] += amount
+        self.credit_balance -= price * amount
+
+    def pay(self, amount):
+        """
+        :param Decimal amount:
+        """
+        self.credit_balance += amount
+        if self.credit_balance >= 0:
+            # Reset counts in this case.
+            self.buy_item_counts.clear()
+
+    def __repr__(self):
+        return codec.format_obj(self)
+
 
 class AdminCashPosition:
     DbFilePath = "admin-cash-position.txt"
+    CodecAttribs = ["cash_position", "purchases"]
 
     def __init__(self, cash_position=0, purchases=None):
         """
@@ -61,6 +103,12 @@ class AdminCashPosition:
             purchases = []
         self.purchases = purchases
 
+    def copy(self):
+        """
+        :rtype: AdminCashPosition
+        """
+        return AdminCashPosition(cash_position=self.cash_position, purchases=list(self.purchases))
+
     def pay_purchase(self, user_name, item_name, money_amount):
         """
         :param str user_name:
@@ -73,11 +121,7 @@ class AdminCashPosition:
         self.cash_position -= money_amount
 
     def __repr__(self):
-        attribs = ["cash_position", "purchases"]
-        return "%s(\n%s)" % (
-            self.__class__.__name__,
-            ",\n".join(["%s=%s" % (attr, better_repr(getattr(self, attr))) for attr in attribs]),
-        )
+        return codec.format_obj(self)
 
     def format(self):
         """
@@ -93,150 +137,468 @@ class AdminCashPosition:
         )
 
 
-class _Task(Thread):
-    def __init__(self, db, wait_time=None, **kwargs):
+class DrinkerCache:
+    """
+    In-memory cache of parsed :class:`Drinker` objects.
+    Every entry is stored together with the stat key of the file it was loaded from (see :func:`Storage.stat_key`),
+    and it is only used as long as the file still has the same stat key.
+    So external edits of the drinker files still show up.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}  # type: Dict[str,Tuple[object,Drinker]]  # drinker name -> (stat key, drinker)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, stat_key):
         """
-        :param Db db:
-        :param float|None wait_time:
+        :param str name:
+        :param object|None stat_key: current stat key of the drinker file. None means that we cannot validate
+        :return: copy of the cached drinker, or None if not cached or outdated
+        :rtype: Drinker|None
         """
-        super(_Task, self).__init__(name=self.__class__.__name__, **kwargs)
-        self.creation_time = time.time()
-        self.db = db
-        self.wait_time = wait_time
-        self.condition = Condition()
-
-    def run(self):
-        with self.condition:
-            if self.wait_time:
-                self.condition.wait(self.wait_time)
-        with self.db.lock:
-            # noinspection PyBroadException
-            try:
-                self.do_task()
-            except Exception:
-                better_exchook.better_exchook(*sys.exc_info())
-            finally:
-                self.db.tasks.remove(self)
+        with self.lock:
+            entry = self.entries.get(name)
+            if stat_key is None or entry is None or entry[0] != stat_key:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1].copy()
+
+    def put(self, name, stat_key, drinker):
+        """
+        :param str name:
+        :param object|None stat_key: stat key of the drinker file, corresponding to the drinker
+        :param Drinker drinker:
+        """
+        with self.lock:
+            if stat_key is None:
+                self.entries.pop(name, None)
+                return
+            self.entries[name] = (stat_key, drinker.copy())
+
+    def invalidate(self, name=None):
+        """
+        :param str|None name: if None, invalidates all entries
+        """
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(name, None)
 
-    def skip_wait_time(self):
-        with self.condition:
-            self.wait_time = None
-            self.condition.notify_all()
+    def __repr__(self):
+        return "<%s, %i entries, %i hits, %i misses>" % (
+            self.__class__.__name__,
+            len(self.entries),
+            self.hits,
+            self.misses,
+        )
+
+
+class DrinkerAggregates:
+    """
+    Aggregates over all drinkers (credit balances, buy item counts, negative balance, inactive drinkers),
+    updated incrementally with every saved drinker, such that the queries do not need to load all drinkers.
+    The initial state is built once, lazily, via :func:`Db._build_aggregates`.
+    External edits of the drinker files are only picked up via :func:`Db.reload`.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.built = False
+        self.balances = {}  # type: Dict[str,Decimal]  # drinker name -> credit balance, all drinkers in the DB
+        self.total_buy_item_counts = {}  # type: Dict[str,Dict[str,int]]  # drinker name -> item name -> count
+        self.active = set()  # type: Set[str]
+        self.active_total_buy_item_counts = {}  # type: Dict[str,int]  # item name -> count, over active drinkers
+        self.negative_balance = set()  # type: Set[str]
+        self.inactive = set()  # type: Set[str]  # in the DB, but not active
+        self.total_debt = Decimal(0)  # sum over the negative balances, as a positive number
+
+    def _remove(self, name):
+        """
+        :param str name:
+        """
+        if name not in self.balances:
+            return
+        balance = self.balances.pop(name)
+        if balance < 0:
+            self.total_debt += balance
+            self.negative_balance.discard(name)
+        counts = self.total_buy_item_counts.pop(name)
+        if name in self.active:
+            for key, value in counts.items():
+                self.active_total_buy_item_counts[key] -= value
+        self.inactive.discard(name)
+
+    def update(self, drinker):
+        """
+        :param Drinker drinker: new state
+        """
+        name = drinker.name
+        with self.lock:
+            self._remove(name)
+            self.balances[name] = drinker.credit_balance
+            if drinker.credit_balance < 0:
+                self.total_debt -= drinker.credit_balance
+                self.negative_balance.add(name)
+            self.total_buy_item_counts[name] = dict(drinker.total_buy_item_counts)
+            if name in self.active:
+                for key, value in drinker.total_buy_item_counts.items():
+                    self.active_total_buy_item_counts[key] = self.active_total_buy_item_counts.get(key, 0) + value
+            else:
+                self.inactive.add(name)
 
-    def do_task(self):
-        raise NotImplementedError
+    def remove(self, name):
+        """
+        :param str name: drinker deleted from the DB
+        """
+        with self.lock:
+            self._remove(name)
 
-    @property
-    def delayed_time(self):
-        if getattr(self, "creation_time", None):
-            return time.time() - self.creation_time
-        return None
+    def set_active(self, names):
+        """
+        :param list[str] names: active drinkers
+        """
+        with self.lock:
+            self.active = set(names)
+            self.inactive = set(self.balances.keys()) - self.active
+            self.active_total_buy_item_counts = {}
+            for name in self.active:
+                for key, value in self.total_buy_item_counts.get(name, {}).items():
+                    self.active_total_buy_item_counts[key] = self.active_total_buy_item_counts.get(key, 0) + value
 
-    def verbose_existing(self):
-        return self.wait_time and self.delayed_time and self.delayed_time >= 0.5
+    def clear(self):
+        """
+        Removes all drinkers, such that it will be built again. The active drinkers are kept.
+        """
+        with self.lock:
+            self.built = False
+            self.balances.clear()
+            self.total_buy_item_counts.clear()
+            self.active_total_buy_item_counts.clear()
+            self.negative_balance.clear()
+            self.inactive.clear()
+            self.total_debt = Decimal(0)
 
     def __repr__(self):
-        return "<%s, wait time %.1f, delayed time %.1f>" % (
+        return "<%s, %i drinkers, %i negative, %i inactive, total debt %s>" % (
             self.__class__.__name__,
-            self.wait_time or 0,
-            self.delayed_time or -1,
+            len(self.balances),
+            len(self.negative_balance),
+            len(self.inactive),
+            self.total_debt,
         )
 
-    def __hash__(self):
-        return hash(id(self))
 
-    def __eq__(self, other):
-        return isinstance(other, self.__class__)
+class QuickPicks:
+    """
+    Decayed purchase frequency per drinker, to show the regular drinkers at the top of the GUI.
 
+    This uses forward decay: a purchase at time t adds ``exp((t - landmark_time) / decay_time)`` to the score.
+    So relative to each other, older purchases count less, but the stored scores never need to be decayed,
+    and every update is O(1).
+    When the exponent gets too large, all scores are rescaled to a new landmark time.
+    The number of drinkers is bounded: when there are more than ``2 * max_size``,
+    only the ``max_size`` best are kept, which is amortized O(1) per update.
+    """
 
-class _GitCommitBaseTask(_Task):
-    def __init__(self, commit_files, commit_msg, **kwargs):
+    DbFilePath = "quick-picks.txt"
+    CodecAttribs = ["decay_time", "landmark_time", "scores"]
+    MaxExponent = 50.0
+
+    def __init__(self, decay_time=7 * 24 * 60 * 60, landmark_time=None, scores=None, max_size=50):
         """
-        :param list[str] commit_files:
-        :param str commit_msg:
+        :param float|int decay_time: in secs. a purchase counts 1/e after this time
+        :param float|None landmark_time: unix time. by default now
+        :param dict[str,float]|None scores: drinker name -> score, relative to the landmark time
+        :param int max_size:
         """
-        super(_GitCommitBaseTask, self).__init__(**kwargs)
-        self.commit_files = commit_files
-        self.commit_msg = commit_msg
+        self.lock = Lock()
+        self.decay_time = decay_time
+        self.landmark_time = landmark_time if landmark_time is not None else time.time()
+        self.scores = scores or {}  # type: Dict[str,float]
+        self.max_size = max_size
+        self.dirty = False
 
-    def do_task(self):
-        try:
-            cmd = ["git", "add"] + self.commit_files
-            print("$ %s" % " ".join(cmd))
-            subprocess.check_call(cmd, cwd=self.db.path)
-        except subprocess.CalledProcessError as exc:
-            print("Git add error:", exc)
-        else:
-            try:
-                cmd = ["git", "commit"] + self.commit_files + ["-m", self.commit_msg]
-                print("$ %s" % " ".join(cmd))
-                subprocess.check_call(cmd, cwd=self.db.path)
-            except subprocess.CalledProcessError as exc:
-                print("Git commit error:", exc)
+    def add(self, drinker_name, amount=1, t=None):
+        """
+        :param str drinker_name:
+        :param int amount: number of items bought
+        :param float|None t: unix time. by default now
+        """
+        if t is None:
+            t = time.time()
+        with self.lock:
+            exponent = (t - self.landmark_time) / self.decay_time
+            if exponent > self.MaxExponent:
+                factor = math.exp(-exponent)
+                self.scores = {name: score * factor for (name, score) in self.scores.items()}
+                self.landmark_time = t
+                exponent = 0.0
+            self.scores[drinker_name] = self.scores.get(drinker_name, 0.0) + amount * math.exp(exponent)
+            if len(self.scores) > 2 * self.max_size:
+                best = sorted(self.scores.items(), key=lambda item: -item[1])[: self.max_size]
+                self.scores = dict(best)
+            self.dirty = True
+
+    def get_top(self, n, names=None):
+        """
+        :param int n:
+        :param set[str]|list[str]|None names: only consider these drinkers, e.g. the active ones
+        :return: drinker names, best first
+        :rtype: list[str]
+        """
+        with self.lock:
+            items = [(name, score) for (name, score) in self.scores.items() if names is None or name in names]
+        items.sort(key=lambda item: (-item[1], item[0]))
+        return [name for (name, _) in items[:n]]
 
+    def get_score(self, drinker_name, t=None):
+        """
+        :param str drinker_name:
+        :param float|None t: unix time. by default now
+        :return: decayed number of purchases, e.g. 1.0 for a single purchase right now
+        :rtype: float
+        """
+        if t is None:
+            t = time.time()
+        with self.lock:
+            return self.scores.get(drinker_name, 0.0) * math.exp((self.landmark_time - t) / self.decay_time)
 
-class _GitCommitDrinkersTask(_GitCommitBaseTask):
-    def __init__(self, **kwargs):
-        super(_GitCommitDrinkersTask, self).__init__(
-            commit_files=["drinkers"], commit_msg="drink-kiosk: drinkers update", **kwargs
-        )
+    def dumps(self):
+        """
+        :return: file content. resets the dirty flag
+        :rtype: str
+        """
+        with self.lock:
+            self.dirty = False
+            return codec.dumps(self)
 
+    def __repr__(self):
+        return "<%s, %i drinkers, top: %r>" % (self.__class__.__name__, len(self.scores), self.get_top(5))
 
-class _GitCommitAdminCashTask(_GitCommitBaseTask):
-    def __init__(self, **kwargs):
-        super(_GitCommitAdminCashTask, self).__init__(
-            commit_files=[AdminCashPosition.DbFilePath], commit_msg="drink-kiosk: admin-cash-position", **kwargs
-        )
+
+class StateVersions:
+    """
+    Version counter of the DB state, for incremental snapshots (:func:`Db.export_state`).
+    Every change gets a new version, and for every drinker and for the other parts of the state (:data:`Parts`),
+    we keep the version of its last change.
+    A change must be counted after the new state is visible (e.g. in the drinker cache),
+    such that a snapshot never has a newer version than its content.
+    """
+
+    Parts = ("drinker_names", "buy_items", "admin_cash_position")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.instance = uuid.uuid4().hex[:12]  # the versions are only meaningful within this instance
+        self.version = 0
+        self.reset_version = 0  # everything changed with this version
+        self.drinkers = {}  # type: Dict[str,int]  # drinker name -> version of its last change
+        self.parts = {}  # type: Dict[str,int]  # part (see Parts) -> version of its last change
+
+    def bump(self, drinker_names=(), parts=()):
+        """
+        :param list[str]|tuple[str] drinker_names: changed (or deleted) drinkers
+        :param list[str]|tuple[str] parts: changed parts, see :data:`Parts`
+        """
+        with self.lock:
+            self.version += 1
+            for name in drinker_names:
+                self.drinkers[name] = self.version
+            for part in parts:
+                assert part in self.Parts
+                self.parts[part] = self.version
+
+    def bump_all(self):
+        """
+        Everything might have changed, e.g. after a reload.
+        """
+        with self.lock:
+            self.version += 1
+            self.reset_version = self.version
+            self.drinkers.clear()
+            self.parts.clear()
+
+    def get_changes(self, since_version):
+        """
+        :param int|None since_version:
+        :return: current version, changed drinkers and changed parts since then,
+            or (current version, None, None) if everything needs to be reloaded
+        :rtype: (int, set[str]|None, set[str]|None)
+        """
+        with self.lock:
+            if since_version is None or not self.reset_version <= since_version <= self.version:
+                return self.version, None, None
+            return (
+                self.version,
+                {name for (name, version) in self.drinkers.items() if version > since_version},
+                {part for (part, version) in self.parts.items() if version > since_version},
+            )
+
+    def __repr__(self):
+        return "<%s %s, version %i, %i drinkers changed>" % (
+            self.__class__.__name__, self.instance, self.version, len(self.drinkers))
 
 
 class Db:
+    """
+    The drinkers DB.
+
+    Locking: Every drinker has its own lock (:func:`drinker_lock`), such that operations on different drinkers
+    can run concurrently. There is a lock for the admin cash position (:data:`admin_lock`)
+    and one for the drinkers list (:data:`drinkers_list_lock`).
+    The internal bookkeeping (journal, dirty state for the journal and for Git) is protected by
+    ``_state_lock``, which is only held briefly, and ``_git_commit_lock`` keeps the Git commits in order.
+
+    When several locks are needed, they must be taken in this order:
+
+    1. ``_git_commit_lock``
+    2. drinker locks (if multiple, sorted by drinker name)
+    3. :data:`admin_lock`
+    4. :data:`drinkers_list_lock`
+    5. ``_journal_compact_lock``
+    6. ``_state_lock``
+
+    I.e. never take a drinker lock while holding the admin lock, etc.
+    ``_aggregates_build_lock`` is only taken without holding any other lock, before the drinker locks.
+    The locks of :class:`DrinkerCache`, :class:`DrinkerAggregates`, :class:`QuickPicks`
+    and :class:`StateVersions` are leaf locks.
+    The non-leaf locks are :class:`utils.OwnerTrackingLock` instances, such that
+    :func:`get_lock_holders_formatted` can tell which thread holds which lock, e.g. when the GUI hangs.
+    """
+
     read_only = False
+    LocalDirName = "local"  # in the DB directory, for local state of this kiosk, not DB state. ignored by Git
+    # If set, files which the codec cannot parse are evaluated as Python code (as it was done in earlier versions).
+    # Only enable this for DB files you trust.
+    allow_eval_fallback = False
+    codec_names = {
+        "BuyItem": BuyItem,
+        "Drinker": Drinker,
+        "AdminCashPosition": AdminCashPosition,
+        "QuickPicks": QuickPicks,
+    }
 
-    def __init__(self, path):
+    def __init__(self, path, use_journal=False, storage=None, read_only=None):
         """
         :param str path:
+        :param bool use_journal: write operations to the journal, see :mod:`journal`
+        :param Storage|None storage: by default via :func:`storage.make_storage`
+        :param bool|None read_only: do not write to the DB. by default :data:`read_only` of the class
         """
+        if read_only is not None:
+            self.read_only = read_only
         self.path = path
-        self.lock = RLock()
-        self.drinkers_list_filename = "%s/drinkers/list.txt" % self.path
-        self._check_valid_path()
+        self._drinker_locks = {}  # type: Dict[str,OwnerTrackingLock]
+        self._drinker_locks_lock = Lock()
+        self.admin_lock = OwnerTrackingLock("admin_lock")
+        self.drinkers_list_lock = OwnerTrackingLock("drinkers_list_lock")
+        self._state_lock = OwnerTrackingLock("_state_lock")
+        self.storage = storage or make_storage(path, read_only=self.read_only)
+        self.local_path = "%s/%s" % (path, self.LocalDirName)  # see make_local_dir
+        if not self.read_only:
+            self.make_local_dir()
+        self.drinkers_list_filename = "drinkers/list.txt"
+        self.storage.check_valid()
         self.drinker_names = [
             name
-            for name in self._open(self.drinkers_list_filename).read().splitlines()
+            for name in self.storage.read(self.drinkers_list_filename).splitlines()
             if name and not name.startswith("#")
         ]
         self.currency = "€"
         self.default_git_commit_wait_time = 60 * 60  # 1h
         self.buy_items = self._load_buy_items()
         self.admin_cash_position = self._load_admin_cash_position()
-        self.update_drinker_callbacks = []  # type: List[Callable[[str], None]]
-        self.tasks = []  # type: List[_Task]
-
-    def _check_valid_path(self):
-        assert os.path.isdir(self.path)
-        assert is_git_dir(self.path), "not a Git dir?"
-
-    def _open(self, fn, mode="r"):
+        # Drinker update events. The key is the drinker name. Subscribe e.g. the GUI reload.
+        self.events = EventBus()
+        self.scheduler = Scheduler(name="DbScheduler")
+        self.drinker_cache = DrinkerCache()
+        self.aggregates = DrinkerAggregates()
+        self.aggregates.set_active(self.drinker_names)
+        self._aggregates_build_lock = OwnerTrackingLock("_aggregates_build_lock", reentrant=False)
+        self.quick_picks = self._load_quick_picks()
+        self.quick_picks_save_wait_time = 5 * 60  # 5min
+        self.versions = StateVersions()
+        self.journal = None  # type: Optional[Journal]
+        self.journal_compact_wait_time = 10 * 60  # 10min
+        self._journal_dirty_drinkers = {}  # type: Dict[str,Drinker]  # newer than the snapshot files
+        self._journal_dirty_admin_cash_position = None  # type: Optional[str]  # file content, if newer than the file
+        self._journal_compact_lock = OwnerTrackingLock("_journal_compact_lock")  # one compaction at a time
+        self._git_commit_engine = None  # type: Optional[GitCommitEngine]
+        self._git_commit_lock = OwnerTrackingLock("_git_commit_lock")
+        self._git_dirty_keys = set()  # type: Set[str]  # storage keys written since the last Git commit
+        if not self.read_only:
+            self._init_git_dirty_keys()
+        if use_journal:
+            self._init_journal()
+
+    def make_local_dir(self):
+        """
+        Creates the local state directory, if needed. Also the read-only kiosk needs it, e.g. for the admin socket.
+        """
+        make_git_ignored_dir(self.local_path)
+
+    def drinker_lock(self, drinker_name):
         """
-        :param str fn:
-        :param str mode:
+        :param str drinker_name:
+        :return: lock for this drinker. see the class docstring for the lock order
+        :rtype: OwnerTrackingLock
         """
-        return open(fn, mode)
+        with self._drinker_locks_lock:
+            lock = self._drinker_locks.get(drinker_name)
+            if lock is None:
+                lock = self._drinker_locks[drinker_name] = OwnerTrackingLock("drinker_lock(%r)" % drinker_name)
+            return lock
 
-    def _exists(self, fn):
+    def get_lock_holders_formatted(self):
         """
-        :param str fn:
-        :rtype: bool
+        :return: the DB locks which are currently held, by which thread and since when, suitable for stdout
+        :rtype: str
         """
-        return os.path.exists(fn)
+        with self._drinker_locks_lock:
+            locks = list(self._drinker_locks.values())
+        locks += [
+            self.admin_lock,
+            self.drinkers_list_lock,
+            self._git_commit_lock,
+            self._journal_compact_lock,
+            self._state_lock,
+            self._aggregates_build_lock,
+        ]
+        held = [lock.get_owner_formatted() for lock in locks]
+        held = [s for s in held if s]
+        if not held:
+            return "No DB lock is held.\n"
+        return "".join(["%s\n" % s for s in held])
+
+    def _parse(self, s, fn, extra_names=None):
+        """
+        :param str s: file content
+        :param str fn: filename, for error messages
+        :param dict[str,object]|None extra_names: for the codec, in addition to :data:`codec_names`
+        :return: parsed object, via :func:`codec.loads`
+        """
+        names = self.codec_names
+        if extra_names:
+            names = dict(names, **extra_names)
+        try:
+            return codec.loads(s, names=names, filename=fn)
+        except codec.ParseError as exc:
+            if not self.allow_eval_fallback:
+                raise
+            print("%s, fallback to eval." % exc)
+            return eval(s, globals(), dict(names))
 
     def _load_buy_items(self):
         """
         :rtype: list[BuyItem]
         """
-        fn = "%s/config/buy_items.txt" % self.path
-        s = self._open(fn).read()
-        buy_items = eval(s)
+        fn = "config/buy_items.txt"
+        s = self.storage.read(fn)
+        buy_items = self._parse(s, fn)
         assert isinstance(buy_items, list)
         assert all([isinstance(item, BuyItem) for item in buy_items])
         return buy_items
@@ -248,20 +610,64 @@ class Db:
         """
         :rtype: AdminCashPosition
         """
-        fn = "%s/%s" % (self.path, AdminCashPosition.DbFilePath)
-        if self._exists(fn):
-            s = self._open(fn).read()
-            obj = eval(s)
+        fn = AdminCashPosition.DbFilePath
+        if self.storage.exists(fn):
+            s = self.storage.read(fn)
+            obj = self._parse(s, fn)
             assert isinstance(obj, AdminCashPosition)
             return obj
         return AdminCashPosition()
 
+    def _load_quick_picks(self):
+        """
+        The quick picks are local state of the kiosk, not DB state, so they are not in the storage and not in Git.
+
+        :rtype: QuickPicks
+        """
+        fn = "%s/%s" % (self.local_path, QuickPicks.DbFilePath)
+        old_fn = "%s/%s" % (self.path, QuickPicks.DbFilePath)  # earlier versions had it in the DB directory
+        if not os.path.exists(fn) and os.path.exists(old_fn):
+            if self.read_only:
+                fn = old_fn
+            else:
+                os.replace(old_fn, fn)
+        if os.path.exists(fn):
+            try:
+                with open(fn, encoding="utf8") as f:
+                    obj = self._parse(f.read(), fn)
+                assert isinstance(obj, QuickPicks)
+                return obj
+            except Exception as exc:
+                print("Cannot load %s, start with empty quick picks: %s" % (fn, exc))
+        return QuickPicks()
+
+    def save_quick_picks(self):
+        """
+        Writes the quick picks file, if there were changes.
+        """
+        if self.read_only or not self.quick_picks.dirty:
+            return
+        fn = "%s/%s" % (self.local_path, QuickPicks.DbFilePath)
+        s = self.quick_picks.dumps()
+        with open(fn + FileStorage.TmpExt, "w", encoding="utf8") as f:
+            f.write(s)
+        os.replace(fn + FileStorage.TmpExt, fn)
+
+    def get_quick_picks(self, n):
+        """
+        :param int n:
+        :return: active drinkers who bought the most recently (decayed frequency), best first
+        :rtype: list[str]
+        """
+        return self.quick_picks.get_top(n, names=set(self.get_drinker_names()))
+
     def get_admin_state_formatted(self):
         """
         :return: admin cash position, shortened, formatted, suitable for stdout
         :rtype: str
         """
-        return self.admin_cash_position.format()
+        with self.admin_lock:
+            return self.admin_cash_position.format()
 
     def admin_pay(self, drinker_name, purchase, amount):
         """
@@ -271,9 +677,9 @@ class Db:
         :return: new state, via get_admin_state_formatted
         :rtype: str
         """
-        with self.lock:
+        with self.admin_lock:
             self.admin_cash_position.pay_purchase(user_name=drinker_name, item_name=purchase, money_amount=amount)
-            self._save_admin_cash_position()
+            self._persist_op(["admin_pay", drinker_name, purchase, str(amount)], admin_cash_position=True)
             return self.get_admin_state_formatted()
 
     def admin_set_cash_position(self, cash_position_amount):
@@ -283,23 +689,24 @@ class Db:
         :rtype: str
         """
         cash_position_amount = Decimal(cash_position_amount)
-        with self.lock:
+        with self.admin_lock:
             old = self.admin_cash_position.cash_position
             self.admin_cash_position.cash_position = cash_position_amount
-            self._save_admin_cash_position()
+            self._persist_op(["admin_set_cash_position", str(cash_position_amount)], admin_cash_position=True)
             return "admin cash position: old %s -> new %s" % (old, self.admin_cash_position.cash_position)
 
     def _save_admin_cash_position(self):
         if self.read_only:
             return
-        fn = "%s/%s" % (self.path, AdminCashPosition.DbFilePath)
-        with self.lock:
-            with self._open(fn, "w") as f:
-                f.write("%r\n" % self.admin_cash_position)
-            self._add_git_commit_admin_cash_task(wait_time=0)  # always save right now
+        with self.admin_lock:
+            self.storage.write(AdminCashPosition.DbFilePath, codec.dumps(self.admin_cash_position))
+            self._add_git_dirty_key(AdminCashPosition.DbFilePath)
+            self._add_git_commit_task(wait_time=0)  # always save right now
 
     def _update_admin_cash_position(self):
-        self.admin_cash_position = self._load_admin_cash_position()
+        with self.admin_lock:
+            self.compact_journal()  # the journal might be newer than the file
+            self.admin_cash_position = self._load_admin_cash_position()
 
     def get_drinker_names(self):
         """
@@ -313,9 +720,7 @@ class Db:
         :return: all drinkers in the database (not necessarily shown in GUI)
         :rtype: list[str]
         """
-        import glob
-
-        return sorted([os.path.basename(fn).rsplit(".", 1)[0] for fn in glob.glob(self._drinker_filename("*"))])
+        return [fn[: -len(".txt")] for fn in self.storage.list_dir("drinkers/state") if fn.endswith(".txt")]
 
     def get_buy_items(self):
         """
@@ -343,7 +748,7 @@ class Db:
         :param str drinker_name:
         :rtype: str
         """
-        return "%s/drinkers/state/%s.txt" % (self.path, drinker_name)
+        return "drinkers/state/%s.txt" % drinker_name
 
     def get_drinker(self, name, allow_non_existing=False):
         """
@@ -352,9 +757,16 @@ class Db:
         :rtype: Drinker
         """
         drinker_fn = self._drinker_filename(name)
-        with self.lock:
+        with self.drinker_lock(name):
+            with self._state_lock:
+                if name in self._journal_dirty_drinkers:
+                    return self._journal_dirty_drinkers[name].copy()
+            stat_key = self.storage.stat_key(drinker_fn)
+            drinker = self.drinker_cache.get(name, stat_key)
+            if drinker is not None:
+                return drinker
             try:
-                f = self._open(drinker_fn)
+                s = self.storage.read(drinker_fn)
             except FileNotFoundError:
                 if not allow_non_existing:
                     from difflib import get_close_matches
@@ -363,10 +775,10 @@ class Db:
                     raise Exception("drinker %r is unknown. close matches: %r" % (name, close_matches))
                 drinker = Drinker(name=name)
             else:
-                s = f.read()
-                drinker = eval(s)
+                drinker = self._parse(s, drinker_fn)
                 assert isinstance(drinker, Drinker)
                 assert drinker.name == name
+                self.drinker_cache.put(name, stat_key, drinker)
         return drinker
 
     def _save_drinker(self, drinker, commit=True):
@@ -377,36 +789,184 @@ class Db:
         if self.read_only:
             return
         drinker_fn = self._drinker_filename(drinker.name)
-        with self.lock:
-            with self._open(drinker_fn, "w") as f:
-                f.write("%r\n" % drinker)
+        with self.drinker_lock(drinker.name):
+            with self._state_lock:
+                in_journal = drinker.name in self._journal_dirty_drinkers
+                if in_journal:
+                    # The file is behind the journal. It will be written by compact_journal.
+                    self._journal_dirty_drinkers[drinker.name] = drinker.copy()
+            if not in_journal:
+                self.storage.write(drinker_fn, codec.dumps(drinker))
+                self._add_git_dirty_key(drinker_fn)
+                # Write-through.
+                self.drinker_cache.put(drinker.name, self.storage.stat_key(drinker_fn), drinker)
+            self.aggregates.update(drinker)
             if commit:
-                self._add_git_commit_drinkers_task()
+                self._add_git_commit_task()
+
+    def _persist_op(self, record, drinkers=(), admin_cash_position=False):
+        """
+        Persists the result of some operation.
+        Without journal, this writes the drinker files and the admin cash position file.
+        With journal, this only appends the record to the journal,
+        and the files are written later by :func:`compact_journal`.
+
+        The caller must hold the locks of the drinkers, and the admin lock if the admin cash position was updated.
+
+        :param list[str|int] record: operation name and args, for the journal. see :func:`_journal_replay`
+        :param list[Drinker]|tuple[Drinker] drinkers: updated drinkers
+        :param bool admin_cash_position: whether the admin cash position was updated
+        """
+        if not self.read_only:
+            self._persist_op_write(record, drinkers=drinkers, admin_cash_position=admin_cash_position)
+        # Still under the locks of the caller, and after the new state is visible. See export_state.
+        self.versions.bump(
+            drinker_names=[drinker.name for drinker in drinkers],
+            parts=["admin_cash_position"] if admin_cash_position else [],
+        )
+
+    def _persist_op_write(self, record, drinkers=(), admin_cash_position=False):
+        """
+        See :func:`_persist_op`.
+
+        :param list[str|int] record:
+        :param list[Drinker]|tuple[Drinker] drinkers:
+        :param bool admin_cash_position:
+        """
+        if not self.journal:
+            for drinker in drinkers:
+                self._save_drinker(drinker)
+            if admin_cash_position:
+                self._save_admin_cash_position()
+            return
+        for drinker in drinkers:
+            self.aggregates.update(drinker)
+        admin_cash_position_s = codec.dumps(self.admin_cash_position) if admin_cash_position else None
+        with self._state_lock:
+            self.journal.append(record)
+            for drinker in drinkers:
+                self._journal_dirty_drinkers[drinker.name] = drinker.copy()
+            if admin_cash_position:
+                self._journal_dirty_admin_cash_position = admin_cash_position_s
+        self.scheduler.add("journal_compact", self.compact_journal, wait_time=self.journal_compact_wait_time)
+        if admin_cash_position:
+            self._add_git_commit_task(wait_time=0)  # always save right now
+        elif drinkers:
+            self._add_git_commit_task()
+
+    def _get_aggregates(self):
+        """
+        :return: the aggregates. on the first call, this loads all drinkers
+        :rtype: DrinkerAggregates
+        """
+        if not self.aggregates.built:
+            with self._aggregates_build_lock:
+                if not self.aggregates.built:
+                    for drinker_name in self.get_drinker_names_all_in_db():
+                        # Under the drinker lock, such that we do not overwrite a newer state.
+                        with self.drinker_lock(drinker_name):
+                            self.aggregates.update(self.get_drinker(drinker_name))
+                    self.aggregates.built = True
+        return self.aggregates
+
+    def get_drinkers_credit_balances(self):
+        """
+        :return: all drinkers in the DB -> credit balance
+        :rtype: dict[str,Decimal]
+        """
+        aggregates = self._get_aggregates()
+        with aggregates.lock:
+            return dict(aggregates.balances)
 
     def get_drinkers_credit_balances_formatted(self):
         """
         :return: list of all drinkers credit balances formatted string (suitable for stdout)
         :rtype: str
         """
-        out = []
-        for drinker_name in sorted(self.get_drinker_names_all_in_db()):
-            drinker = self.get_drinker(drinker_name)
-            out.append("%s: %s\n" % (drinker_name, drinker.credit_balance))
-        return "".join(out)
+        balances = self.get_drinkers_credit_balances()
+        return "".join(["%s: %s\n" % (name, balance) for (name, balance) in sorted(balances.items())])
+
+    def get_drinker_inactive_and_non_neg_balance(self):
+        """
+        :return: all inactive drinkers with non-negative credit balance -> credit balance
+        :rtype: dict[str,Decimal]
+        """
+        aggregates = self._get_aggregates()
+        with aggregates.lock:
+            return {
+                name: aggregates.balances[name] for name in aggregates.inactive if aggregates.balances[name] >= 0
+            }
 
     def get_drinker_inactive_and_non_neg_balance_formatted(self):
         """
         :return: list of all inactive drinkers with non-negative credit balances formatted string
         :rtype: str
         """
-        out = []
-        for drinker_name in sorted(self.get_drinker_names_all_in_db()):
-            if drinker_name in self.get_drinker_names():
-                continue  # still active
-            drinker = self.get_drinker(drinker_name)
-            if drinker.credit_balance >= 0:
-                out.append("%s: %s\n" % (drinker_name, drinker.credit_balance))
-        return "".join(out)
+        balances = self.get_drinker_inactive_and_non_neg_balance()
+        return "".join(["%s: %s\n" % (name, balance) for (name, balance) in sorted(balances.items())])
+
+    def get_negative_balance_drinker_names(self):
+        """
+        :return: all drinkers in the DB with negative credit balance
+        :rtype: list[str]
+        """
+        aggregates = self._get_aggregates()
+        with aggregates.lock:
+            return sorted(aggregates.negative_balance)
+
+    def get_total_debt(self):
+        """
+        :return: sum over all negative credit balances, as a positive number
+        :rtype: Decimal
+        """
+        aggregates = self._get_aggregates()
+        with aggregates.lock:
+            return aggregates.total_debt
+
+    def export_state(self, since_version=None, instance=None):
+        """
+        Snapshot of the whole state in one structured payload, e.g. for ``tools/remote-admin.py``.
+        With ``since_version``, only what changed since that earlier snapshot is included.
+
+        :param int|None since_version: "version" of an earlier snapshot
+        :param str|None instance: "instance" of the earlier snapshot. versions of another instance
+            (e.g. before a restart) are not comparable, and then we return everything
+        :return: dict with:
+            "instance", "version",
+            "full": whether this is everything. otherwise it updates the earlier snapshot,
+            "drinkers": drinker name -> :class:`Drinker`, all (with "full") or the changed ones,
+            "deleted_drinkers": names (only without "full"),
+            "drinker_names" (active drinkers), "buy_items", "admin_cash_position":
+            only if changed (always with "full")
+        :rtype: dict[str]
+        """
+        if instance != self.versions.instance:
+            since_version = None
+        # Get the version first. Everything we read afterwards is at least as new.
+        version, drinker_names, parts = self.versions.get_changes(since_version)
+        full = drinker_names is None
+        if full:
+            drinker_names = self.get_drinker_names_all_in_db()
+            parts = set(StateVersions.Parts)
+        state = {"instance": self.versions.instance, "version": version, "full": full, "drinkers": {}}
+        deleted = []
+        for name in sorted(drinker_names):
+            with self.drinker_lock(name):
+                if self.storage.exists(self._drinker_filename(name)):
+                    state["drinkers"][name] = self.get_drinker(name).copy()
+                else:
+                    deleted.append(name)
+        if not full:
+            state["deleted_drinkers"] = deleted
+        if "drinker_names" in parts:
+            with self.drinkers_list_lock:
+                state["drinker_names"] = list(self.drinker_names)
+        if "buy_items" in parts:
+            state["buy_items"] = list(self.get_buy_items())
+        if "admin_cash_position" in parts:
+            with self.admin_lock:
+                state["admin_cash_position"] = self.admin_cash_position.copy()
+        return state
 
     def drinker_buy_item(self, drinker_name, item_name, amount=1):
         """
@@ -418,22 +978,19 @@ class Db:
         """
         print("%s: %s drinks %s (amount: %i)." % (time_stamp(), drinker_name, item_name, amount))
         assert isinstance(amount, int)
-        with self.lock:
+        with self.drinker_lock(drinker_name):
             drinker = self.get_drinker(drinker_name)
             item = self._get_buy_item_by_intern_name(item_name)
-            drinker.buy_item_counts.setdefault(item_name, 0)
-            drinker.buy_item_counts[item_name] += amount
-            if drinker.buy_item_counts[item_name] < 0:
-                drinker.buy_item_counts[item_name] = 0  # it's only for visual feedback; this makes more sense
-            drinker.total_buy_item_counts.setdefault(item_name, 0)
-            drinker.total_buy_item_counts[item_name] += amount
-            drinker.credit_balance -= item.price * amount
-            self._save_drinker(drinker)
+            drinker.buy_item(item_name, price=item.price, amount=amount)
+            self._persist_op(["drinker_buy_item", drinker_name, item_name, amount, str(item.price)], drinkers=[drinker])
             if amount != 1:
                 # We want to have a Git commit right after (after the lock release), so enforce this now.
-                self._add_git_commit_drinkers_task(wait_time=0)
-        for cb in self.update_drinker_callbacks:
-            cb(drinker_name)
+                self._add_git_commit_task(wait_time=0)
+        if amount > 0:
+            self.quick_picks.add(drinker_name, amount=amount)
+            if not self.read_only:
+                self.scheduler.add("quick_picks_save", self.save_quick_picks, wait_time=self.quick_picks_save_wait_time)
+        self.events.publish(drinker_name)
         return drinker
 
     def drinker_pay(self, drinker_name, amount):
@@ -448,21 +1005,111 @@ class Db:
         """
         amount = Decimal(amount)
         print("%s: %s pays %s %s." % (time_stamp(), drinker_name, amount, self.currency))
-        with self.lock:
+        with self.drinker_lock(drinker_name), self.admin_lock:
             drinker = self.get_drinker(drinker_name)
-            drinker.credit_balance += amount
-            if drinker.credit_balance >= 0:
-                # Reset counts in this case.
-                drinker.buy_item_counts.clear()
-            self._save_drinker(drinker)
-            # We want to have a Git commit right after (after the lock release), so enforce this now.
-            self._add_git_commit_drinkers_task(wait_time=0)
+            drinker.pay(amount)
             self.admin_cash_position.cash_position += amount
-            self._save_admin_cash_position()
-        for cb in self.update_drinker_callbacks:
-            cb(drinker_name)
+            self._persist_op(["drinker_pay", drinker_name, str(amount)], drinkers=[drinker], admin_cash_position=True)
+            # We want to have a Git commit right after (after the lock release), so enforce this now.
+            self._add_git_commit_task(wait_time=0)
+        self.events.publish(drinker_name)
         return drinker
 
+    BatchOps = {
+        # op name -> arg names
+        "drinker_buy_item": ("drinker_name", "item_name", "amount"),
+        "drinker_pay": ("drinker_name", "amount"),
+        "admin_pay": ("drinker_name", "purchase", "amount"),
+        "admin_set_cash_position": ("amount",),
+    }
+    _BatchDrinkerOps = {"drinker_buy_item", "drinker_pay"}  # ops which change the drinker
+
+    def apply_batch(self, operations):
+        """
+        Applies many operations at once, e.g. when transcribing a paper tally sheet or a bank statement.
+        Everything is validated first. If any operation is invalid, nothing is applied.
+        Otherwise, all operations are applied together (no other operation on the touched drinkers
+        or the admin cash position can come in between), every touched file is written once,
+        there is one update event per touched drinker, and there is a single Git commit.
+
+        :param list[tuple] operations: like in :data:`BatchOps`, e.g.
+            ``("drinker_buy_item", drinker_name, item_name, amount)``,
+            ``("drinker_pay", drinker_name, amount)``,
+            ``("admin_pay", drinker_name, purchase, amount)``,
+            ``("admin_set_cash_position", amount)``.
+        :return: updated drinkers
+        :rtype: dict[str,Drinker]
+        """
+        assert not self.read_only
+        ops = []
+        buy_items = self.get_buy_items_by_intern_name()
+        for i, op in enumerate(operations):
+            op = tuple(op)
+            if not op or op[0] not in self.BatchOps or len(op) != len(self.BatchOps[op[0]]) + 1:
+                raise Exception("apply_batch: invalid operation %i: %r. expected one of %r" % (i, op, self.BatchOps))
+            args = dict(zip(self.BatchOps[op[0]], op[1:]))
+            if "drinker_name" in args and not isinstance(args["drinker_name"], str):
+                raise Exception("apply_batch: operation %i %r: invalid drinker name" % (i, op))
+            if op[0] == "drinker_buy_item":
+                if args["item_name"] not in buy_items:
+                    raise Exception("apply_batch: operation %i %r: unknown item, known: %r" % (i, op, list(buy_items)))
+                if not isinstance(args["amount"], int) or isinstance(args["amount"], bool):
+                    raise Exception("apply_batch: operation %i %r: amount must be int" % (i, op))
+            else:
+                if op[0] == "admin_pay" and not isinstance(args["purchase"], str):
+                    raise Exception("apply_batch: operation %i %r: purchase must be str" % (i, op))
+                try:
+                    args["amount"] = Decimal(args["amount"])
+                except ArithmeticError:
+                    raise Exception("apply_batch: operation %i %r: invalid amount" % (i, op))
+            ops.append((op[0], args))
+        drinker_names = sorted(set(args["drinker_name"] for (op, args) in ops if op in self._BatchDrinkerOps))
+        admin = any(op != "drinker_buy_item" for (op, _) in ops)
+        if not ops:
+            return {}
+
+        with ExitStack() as stack:
+            # See the class docstring for the lock order.
+            # Hold the commit lock, such that no commit can contain only a part of the batch.
+            # It comes first, such that we do not hold the drinker locks while waiting for a running commit.
+            stack.enter_context(self._git_commit_lock)
+            for name in drinker_names:
+                stack.enter_context(self.drinker_lock(name))
+            if admin:
+                stack.enter_context(self.admin_lock)
+            drinkers = {name: self.get_drinker(name) for name in drinker_names}  # raises if unknown
+            admin_cash_position = self.admin_cash_position.copy()
+            records = []
+            for op, args in ops:
+                if op == "drinker_buy_item":
+                    price = buy_items[args["item_name"]].price
+                    drinkers[args["drinker_name"]].buy_item(args["item_name"], price=price, amount=args["amount"])
+                    records.append([op, args["drinker_name"], args["item_name"], args["amount"], str(price)])
+                elif op == "drinker_pay":
+                    drinkers[args["drinker_name"]].pay(args["amount"])
+                    admin_cash_position.cash_position += args["amount"]
+                    records.append([op, args["drinker_name"], str(args["amount"])])
+                elif op == "admin_pay":
+                    admin_cash_position.pay_purchase(
+                        user_name=args["drinker_name"], item_name=args["purchase"], money_amount=args["amount"]
+                    )
+                    records.append([op, args["drinker_name"], args["purchase"], str(args["amount"])])
+                elif op == "admin_set_cash_position":
+                    admin_cash_position.cash_position = args["amount"]
+                    records.append([op, str(args["amount"])])
+            print("%s: apply batch of %i operations on %i drinkers." % (time_stamp(), len(ops), len(drinkers)))
+            if admin:
+                self.admin_cash_position = admin_cash_position
+            self._persist_op(
+                ["batch", records],
+                drinkers=[drinkers[name] for name in drinker_names],
+                admin_cash_position=admin,
+            )
+            self._add_git_commit_task(wait_time=0)
+        for name in drinker_names:
+            self.events.publish(name)
+        return drinkers
+
     def drinkers_delete(self, drinkers):
         """
         Delete the list of inactive drinkers. Only allowed when their credit balance is non-negative.
@@ -472,17 +1119,22 @@ class Db:
         """
         if not drinkers:
             return
-        with self.lock:
-            self._add_git_commit_drinkers_task(wait_time=0)
-            for drinker_name in drinkers:
+        self._add_git_commit_task(wait_time=0)
+        for drinker_name in drinkers:
+            with self.drinker_lock(drinker_name):
                 if drinker_name in self.get_drinker_names():
                     raise Exception("drinker %r is still active" % drinker_name)
+                self.compact_journal()  # such that the file is up-to-date
                 drinker = self.get_drinker(drinker_name)
                 if drinker.credit_balance < 0:
                     raise Exception(
                         "drinker %r has negative credit balance %s" % (drinker_name, drinker.credit_balance)
                     )
-                os.remove(self._drinker_filename(drinker_name))
+                self.storage.remove(self._drinker_filename(drinker_name))
+                self._add_git_dirty_key(self._drinker_filename(drinker_name))
+                self.drinker_cache.invalidate(drinker_name)
+                self.aggregates.remove(drinker_name)
+                self.versions.bump(drinker_names=[drinker_name])
 
     def update_drinkers_list(self, verbose=False):
         """
@@ -495,23 +1147,31 @@ class Db:
         To remove any inactive drinkers, use ``tools/remote-admin.py``
         and the ``drinker_delete_inactive_non_neg_balance`` command.
 
+        This can run while the GUI is running. Only new drinkers and changed shown names are written,
+        and when the list changed, a full reload event is published (see :data:`events`).
+
         :param bool verbose:
         """
         from pprint import pformat
 
-        ldap_cmd_fn = "%s/config/ldap-opts.txt" % self.path  # example: ldapsearch -x -h <host>
+        ldap_cmd_fn = "config/ldap-opts.txt"  # example: ldapsearch -x -h <host>
         ldap_cmd = (
-            " ".join([ln for ln in self._open(ldap_cmd_fn).read().splitlines() if not ln.startswith("#")])
+            " ".join([ln for ln in self.storage.read(ldap_cmd_fn).splitlines() if not ln.startswith("#")])
             .strip()
             .split(" ")
         )
         out = subprocess.check_output(ldap_cmd)
         lines = out.splitlines()
-        drinkers_exclude_list_fn = "%s/drinkers/exclude_list.txt" % self.path
-        exclude_users = set(self._open(drinkers_exclude_list_fn).read().splitlines())
+        drinkers_exclude_list_fn = "drinkers/exclude_list.txt"
+        exclude_users = set(self.storage.read(drinkers_exclude_list_fn).splitlines())
         cur_entry = None  # type: Optional[Dict[str,Union[str,List[str]]]] # key -> value(s)
-        if self._exists("%s/config/ldap_attrib_filter.txt" % self.path):
-            ldap_flags = eval(self._open("%s/config/ldap_attrib_filter.txt" % self.path).read())
+        ldap_attrib_filter_fn = "config/ldap_attrib_filter.txt"
+        if self.storage.exists(ldap_attrib_filter_fn):
+            ldap_flags = self._parse(
+                self.storage.read(ldap_attrib_filter_fn),
+                ldap_attrib_filter_fn,
+                extra_names={"int": int, "float": float, "str": str, "bool": bool},
+            )
             assert isinstance(ldap_flags, dict)
         else:
             ldap_flags = {}
@@ -554,6 +1214,7 @@ class Db:
 
         multi_values = {"cn", "objectClass", "memberUid", "memberUid:", "description"}
         drinkers_list = []  # type: List[str]
+        num_changed = 0
         last_key = None
         cur_line_is_comment, last_line_was_comment = False, False
         for line_num, line in enumerate(lines):
@@ -573,14 +1234,9 @@ class Db:
                             if verbose:
                                 pprint(cur_entry)
                             drinkers_list.append(cur_entry["uid"])
-                            drinker = self.get_drinker(cur_entry["uid"], allow_non_existing=True)
-                            if "gecos" in cur_entry:
-                                drinker.shown_name = cur_entry["gecos"]
-                            elif "sn" in cur_entry:
-                                drinker.shown_name = cur_entry["sn"]
-                            else:
-                                drinker.shown_name = drinker.name
-                            self._save_drinker(drinker, commit=False)  # save. commit all at the end
+                            shown_name = cur_entry.get("gecos", cur_entry.get("sn"))
+                            if self._update_drinker_shown_name(cur_entry["uid"], shown_name):
+                                num_changed += 1
                 cur_entry = None
                 last_key = None
                 continue
@@ -610,145 +1266,332 @@ class Db:
                     " ".join(ldap_cmd),
                 )
                 cur_entry[key] = value
-        print("Found %i users (active drinkers)." % len(drinkers_list))
-        self.drinker_names = drinkers_list  # active drinkers
-        with self.lock:
-            with self._open(self.drinkers_list_filename, "w") as f:
-                f.write("# AUTO-GENERATED FILE by drink-kiosk\n")
-                f.write("# DO NOT EDIT THIS FILE\n")
-                f.write("# this is updated via update_drinkers_list, e.g. via LDAP\n")
-                for name in drinkers_list:
-                    assert "\n" not in name
-                    f.write("%s\n" % name)
-            # Commit all drinkers now.
-            self._add_git_commit_drinkers_task(wait_time=0)
+        print("Found %i users (active drinkers), %i new or renamed." % (len(drinkers_list), num_changed))
+        with self.drinkers_list_lock:
+            if drinkers_list == self.drinker_names and not num_changed:
+                return
+            self.drinker_names = drinkers_list  # active drinkers
+            self.aggregates.set_active(drinkers_list)
+            out = [
+                "# AUTO-GENERATED FILE by drink-kiosk\n",
+                "# DO NOT EDIT THIS FILE\n",
+                "# this is updated via update_drinkers_list, e.g. via LDAP\n",
+            ]
+            for name in drinkers_list:
+                assert "\n" not in name
+                out.append("%s\n" % name)
+            self.storage.write(self.drinkers_list_filename, "".join(out))
+            self._add_git_dirty_key(self.drinkers_list_filename)
+            self.versions.bump(parts=["drinker_names"])
+        # Commit all drinkers now.
+        self._add_git_commit_task(wait_time=0)
+        self.events.publish(None)
+
+    def _update_drinker_shown_name(self, drinker_name, shown_name):
+        """
+        :param str drinker_name:
+        :param str|None shown_name: if None, the name
+        :return: whether the drinker was saved, i.e. it is new or the shown name changed
+        :rtype: bool
+        """
+        with self.drinker_lock(drinker_name):
+            drinker = self.get_drinker(drinker_name, allow_non_existing=True)
+            shown_name = shown_name or drinker.name
+            if drinker.shown_name == shown_name and self.storage.exists(self._drinker_filename(drinker_name)):
+                return False
+            drinker.shown_name = shown_name
+            self._save_drinker(drinker, commit=False)  # commit all at the end
+            self.versions.bump(drinker_names=[drinker_name])
+            return True
+
+    def preload_drinkers(self, num_threads=8):
+        """
+        Reads all active drinkers into the cache (:class:`DrinkerCache`), with multiple threads,
+        such that the GUI does not need to wait for the file system, e.g. on NFS.
+
+        :param int num_threads:
+        :return: number of drinkers
+        :rtype: int
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        names = list(self.get_drinker_names())
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(self.get_drinker, names))
+        return len(names)
 
     def get_total_buy_item_counts(self):
         """
+        :return: item name -> count, summed over the active drinkers
         :rtype: dict[str,int]
         """
-        total_buy_item_counts = {}
-        for drinker_name in self.get_drinker_names():
-            drinker = self.get_drinker(drinker_name, allow_non_existing=True)
-            for key, value in drinker.total_buy_item_counts.items():
-                total_buy_item_counts.setdefault(key, 0)
-                total_buy_item_counts[key] += value
-        return total_buy_item_counts
+        aggregates = self._get_aggregates()
+        with aggregates.lock:
+            return dict(aggregates.active_total_buy_item_counts)
 
     def reload(self):
         """
         Reload drinkers, buy items, etc.
         """
+        self.drinker_cache.invalidate()
+        self.aggregates.clear()
         self.update_drinkers_list()
         self._update_buy_items()
         self._update_admin_cash_position()
+        self.versions.bump_all()
 
-    def _add_task(self, task):
+    def _init_journal(self):
         """
-        :param _Task task:
+        Opens the journal, finishes an interrupted compaction, and replays the remaining journal.
         """
-        with self.lock:
-            if task in self.tasks:
-                idx = self.tasks.index(task)
-                existing_task = self.tasks[idx]
-                if existing_task.verbose_existing():  # keep silent if there is no wait time on it
-                    print("_Task already exists:", existing_task)
-                if existing_task.wait_time and not task.wait_time:
-                    print("Requested to skip wait time of task:", existing_task)
-                    existing_task.skip_wait_time()
-                return
-            self.tasks.append(task)
-            task.start()
+        assert not self.read_only
+        self.journal = Journal("%s/journal" % self.path)
+        manifest = self.journal.read_manifest()
+        if manifest:
+            print("Journal: finish interrupted compaction.")
+            self.journal.finish_compaction(manifest, storage=self.storage)
+        else:
+            # Leftovers from an interrupted compaction before the manifest was written. Not used.
+            tmp_fns = [
+                "drinkers/state/%s" % fn
+                for fn in self.storage.list_dir("drinkers/state")
+                if fn.endswith(self.journal.TmpExt)
+            ]
+            if self.storage.exists(AdminCashPosition.DbFilePath + self.journal.TmpExt):
+                tmp_fns.append(AdminCashPosition.DbFilePath + self.journal.TmpExt)
+            for fn in tmp_fns:
+                self.storage.remove(fn)
+        files = self.journal.list_files()
+        records = self.journal.read_records(files)
+        if records:
+            print("Journal: replay %i records from %i files." % (len(records), len(files)))
+        # This is called in the constructor, so there are no concurrent operations yet.
+        for record in records:
+            self._journal_replay(record)
+        self.compact_journal()
+
+    def _journal_replay(self, record):
+        """
+        :param list[str|int] record: [time_stamp, op, args...], see :func:`_persist_op`
+        """
+        op, args = record[1], record[2:]
+        if op == "batch":
+            (records,) = args
+            for sub_record in records:
+                self._journal_replay([record[0]] + sub_record)
+            return
+        if op == "drinker_buy_item":
+            drinker_name, item_name, amount, price = args
+            drinker = self.get_drinker(drinker_name, allow_non_existing=True)
+            drinker.buy_item(item_name, price=Decimal(price), amount=amount)
+            self._journal_dirty_drinkers[drinker_name] = drinker
+        elif op == "drinker_pay":
+            drinker_name, amount = args
+            drinker = self.get_drinker(drinker_name, allow_non_existing=True)
+            drinker.pay(Decimal(amount))
+            self._journal_dirty_drinkers[drinker_name] = drinker
+            self.admin_cash_position.cash_position += Decimal(amount)
+        elif op == "admin_pay":
+            drinker_name, purchase, amount = args
+            self.admin_cash_position.pay_purchase(user_name=drinker_name, item_name=purchase, money_amount=amount)
+        elif op == "admin_set_cash_position":
+            (amount,) = args
+            self.admin_cash_position.cash_position = Decimal(amount)
+        else:
+            raise Exception("Journal: unknown operation in record %r" % (record,))
+        if op in {"drinker_pay", "admin_pay", "admin_set_cash_position"}:
+            self._journal_dirty_admin_cash_position = codec.dumps(self.admin_cash_position)
+
+    def compact_journal(self):
+        """
+        Folds the journal into the snapshot files (drinker files, admin cash position file).
+        See :mod:`journal` for details.
 
-    def _add_git_commit_drinkers_task(self, wait_time=None):
+        The dirty drinkers and the admin cash position are snapshots
+        which were taken together with the corresponding journal records.
+        The state lock is only held to rotate the journal and to take these snapshots,
+        and at the end to drop them, such that operations can go on while the files are written and synced.
+        New operations go into the next journal file, and their snapshots stay dirty for the next compaction.
         """
+        if not self.journal:
+            return
+        with self._journal_compact_lock:
+            with self._state_lock:
+                files = self.journal.list_files()
+                dirty_drinkers = dict(self._journal_dirty_drinkers)
+                dirty_admin_cash_position = self._journal_dirty_admin_cash_position
+                if not files and not dirty_drinkers and dirty_admin_cash_position is None:
+                    return
+                self.journal.rotate()
+            snapshots = [
+                (self._drinker_filename(name), codec.dumps(drinker), drinker)
+                for (name, drinker) in sorted(dirty_drinkers.items())
+            ]  # type: List[Tuple[str,str,Optional[Drinker]]]
+            if dirty_admin_cash_position is not None:
+                snapshots.append((AdminCashPosition.DbFilePath, dirty_admin_cash_position, None))
+            renames = []
+            for fn, data, _ in snapshots:
+                tmp_fn = fn + self.journal.TmpExt
+                self.storage.write(tmp_fn, data, sync=True)
+                renames.append((tmp_fn, fn))
+            self.journal.write_manifest(renames=renames, files=files)
+            self.journal.finish_compaction({"renames": renames, "files": files}, storage=self.storage)
+            with self._state_lock:
+                for fn, _, drinker in snapshots:
+                    self._git_dirty_keys.add(fn)
+                    if drinker:
+                        self.drinker_cache.put(drinker.name, self.storage.stat_key(fn), drinker)
+                # Only drop what is in the files now. Newer snapshots are from records in the next journal file.
+                for name, drinker in dirty_drinkers.items():
+                    if self._journal_dirty_drinkers.get(name) is drinker:
+                        del self._journal_dirty_drinkers[name]
+                if self._journal_dirty_admin_cash_position is dirty_admin_cash_position:
+                    self._journal_dirty_admin_cash_position = None
+            print("Journal: compacted %i journal files into %i files." % (len(files), len(snapshots)))
+
+    def _add_git_commit_task(self, wait_time=None):
+        """
+        All changes are coalesced into a single commit.
+        If there is a pending commit task already, a request with wait_time=0 makes it commit right now.
+
         :param float|None wait_time:
         """
         if self.read_only:
             return
         if wait_time is None:
             wait_time = self.default_git_commit_wait_time
-        self._add_task(_GitCommitDrinkersTask(db=self, wait_time=wait_time))
+        self.scheduler.add("git_commit", self.git_commit_dirty, wait_time=wait_time)
 
-    def _add_git_commit_admin_cash_task(self, wait_time=None):
+    def _add_git_dirty_key(self, key):
         """
-        :param float|None wait_time:
+        :param str key: storage key which was written or removed. call this after the write
         """
-        if self.read_only:
+        with self._state_lock:
+            self._git_dirty_keys.add(key)
+
+    def _init_git_dirty_keys(self):
+        """
+        Changes which were not committed in an earlier run (e.g. due to a crash) are committed with the next commit.
+        """
+        try:
+            out = subprocess.check_output(
+                ["git", "status", "--porcelain", "-z", "--no-renames", "--untracked-files=all", "--"]
+                + ["drinkers", AdminCashPosition.DbFilePath, SqliteStorage.Filename],
+                cwd=self.path,
+            )
+        except (OSError, subprocess.CalledProcessError) as exc:
+            print("Git status error:", exc)
             return
-        if wait_time is None:
-            wait_time = self.default_git_commit_wait_time
-        self._add_task(_GitCommitAdminCashTask(db=self, wait_time=wait_time))
+        for entry in out.decode("utf8").split("\0"):
+            if len(entry) > 3 and not entry.endswith(FileStorage.TmpExt):
+                self._git_dirty_keys.add(entry[3:])
+
+    def get_git_commit_engine(self):
+        """
+        :rtype: GitCommitEngine
+        """
+        with self._state_lock:
+            if not self._git_commit_engine:
+                self._git_commit_engine = GitCommitEngine(self.path)
+            return self._git_commit_engine
+
+    def git_commit_dirty(self):
+        """
+        Commits all the files which were written since the last commit.
+
+        No DB lock is held while Git runs, such that purchases are not blocked by it.
+        The dirty keys are taken before the files are read,
+        and writers mark a key as dirty after the write,
+        so anything written after the snapshot goes into the next commit.
+        """
+        engine = self.get_git_commit_engine()
+        with self._git_commit_lock:
+            # The journal is not committed, so first fold it into the files which we commit.
+            self.compact_journal()
+            with self._state_lock:
+                keys = sorted(self._git_dirty_keys)
+                if not keys:
+                    return
+                self._git_dirty_keys.clear()
+            paths = sorted(set(self.storage.git_commit_paths(keys)))
+            contents = self.storage.read_git_commit_files(paths)
+            msgs = []
+            if any(key.startswith("drinkers/") for key in keys):
+                msgs.append("drinkers update")
+            if AdminCashPosition.DbFilePath in keys:
+                msgs.append("admin-cash-position")
+            if not engine.commit(paths, "drink-kiosk: %s" % ", ".join(msgs or ["update"]), contents=contents):
+                with self._state_lock:
+                    self._git_dirty_keys.update(keys)  # retry with the next commit
 
     def at_exit(self):
         """
         At-exit handler for the DB.
         """
         print("DB at exit handler.")
-        while True:
-            with self.lock:
-                if not self.tasks:
-                    break
-                task = self.tasks[0]
-                print("DB at exit handler: skip task:", task)
-                task.skip_wait_time()
-            # Outside the lock:
-            task.join()
+        # Runs the pending tasks right now.
+        self.scheduler.shutdown()
+        self.events.close(timeout=1)
+        if self.journal:
+            self.compact_journal()
+            self.journal.close()
+        if self._git_commit_engine:
+            self._git_commit_engine.close()
+        self.storage.close()
+
+
+class ReadOnlyDb(Db):
+    """
+    The current state, directly from the DB files, e.g. for ``tools/remote-admin.py --db`` while the kiosk is down.
+    Nothing is written. The journal (if the kiosk uses one) is replayed in memory only.
+    """
 
-
-class HistoricDb(Db):
     read_only = True
 
-    def __init__(self, path, git_revision):
+    def __init__(self, path):
         """
         :param str path:
-        :param str git_revision:
         """
-        try:
-            # https://gitpython.readthedocs.io/en/stable/tutorial.html
-            import git
-        except ImportError:
-            print("pip3 install --user GitPython")
-            raise
-        self.git_mod = git
-        self.git_repo = git.Repo(path)
-        self.git_commit = self.git_repo.commit(git_revision)
-        assert isinstance(self.git_commit, git.Commit)
-        self.git_tree = self.git_commit.tree
-        assert isinstance(self.git_tree, git.Tree)
-        super(HistoricDb, self).__init__(path="")
-
-    def _check_valid_path(self):
-        self._open(self.drinkers_list_filename).read()
-
-    def _open(self, fn, mode="r"):
-        """
-        :param str fn:
-        :param str mode:
-        """
-        assert mode == "r", "only read support for custom file %r" % (fn,)
-        assert self.path == "" and fn.startswith("/")  # fn starts with "<path>/"
-        fn = fn[1:]
-        try:
-            blob = self.git_tree.join(fn)
-        except KeyError as exc:
-            raise FileNotFoundError(str(exc))
-        assert isinstance(blob, self.git_mod.Blob)
-        from io import TextIOWrapper, BytesIO
+        super(ReadOnlyDb, self).__init__(path=path)
+        self._replay_journal_in_memory()
 
-        raw_stream = BytesIO(blob.data_stream.read())
-        return TextIOWrapper(raw_stream)
+    def _replay_journal_in_memory(self):
+        """
+        Like :func:`_init_journal`, but without writing anything.
+        """
+        if not os.path.isdir("%s/journal" % self.path):
+            return
+        journal = Journal("%s/journal" % self.path, read_only=True)
+        files = journal.list_files()
+        manifest = journal.read_manifest()
+        if manifest:
+            # Interrupted compaction. The temporary snapshot files contain the folded journal files.
+            for tmp_fn, fn in manifest["renames"]:
+                if self.storage.exists(tmp_fn):
+                    obj = self._parse(self.storage.read(tmp_fn), tmp_fn)
+                    if isinstance(obj, Drinker):
+                        self._journal_dirty_drinkers[obj.name] = obj
+                    elif isinstance(obj, AdminCashPosition):
+                        self.admin_cash_position = obj
+            files = [fn for fn in files if fn not in manifest["files"]]
+        records = journal.read_records(files)
+        if records:
+            print("Journal: replay %i records from %i files, in memory." % (len(records), len(files)))
+        for record in records:
+            self._journal_replay(record)
+
+
+class HistoricDb(Db):
+    read_only = True
 
-    def _exists(self, fn):
+    def __init__(self, path, git_revision):
         """
-        :param str fn:
-        :rtype: bool
+        :param str path:
+        :param str git_revision:
         """
-        try:
-            self._open(fn)
-            return True
-        except FileNotFoundError:
-            return False
+        storage = GitTreeStorage(path, git_revision)
+        self.git_commit = storage.git_commit
+        super(HistoricDb, self).__init__(path=path, storage=storage)
 
 
 def main():
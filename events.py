@@ -0,0 +1,193 @@
+"""
+Event bus for DB change events, e.g. to update the GUI when a drinker was updated.
+
+Publishing never blocks on a subscriber: every subscriber has its own queue and dispatcher thread.
+Repeated events for the same key (drinker name) are coalesced while they are pending.
+When a subscriber falls too far behind, its queue collapses into a single ``None`` event,
+which means "reload everything".
+"""
+
+import sys
+import time
+from collections import OrderedDict, deque
+from threading import Thread, Condition
+import better_exchook
+
+
+class Subscription:
+    def __init__(self, callback, name, max_pending=100):
+        """
+        :param (str|None)->None callback: gets the drinker name, or None for everything
+        :param str name: for the thread name and the stats
+        :param int max_pending: back-pressure. with more pending keys, they collapse into a single None event
+        """
+        self.callback = callback
+        self.name = name
+        self.max_pending = max_pending
+        self.condition = Condition()
+        self._pending = OrderedDict()  # type: OrderedDict  # key -> time.monotonic() of the first publish
+        self._pending_all = None  # type: float|None  # time.monotonic() of the first publish, for the None event
+        self._busy = False
+        self._closed = False
+        self.num_published = 0
+        self.num_delivered = 0
+        self.num_coalesced = 0
+        self.num_collapsed = 0
+        self.latencies = deque(maxlen=100)  # type: deque  # secs from first publish until the callback returned
+        self.thread = Thread(target=self._thread_main, name="EventBus-%s" % name, daemon=True)
+        self.thread.start()
+
+    def publish(self, key):
+        """
+        Does not block.
+
+        :param str|None key: drinker name, or None for everything
+        """
+        now = time.monotonic()
+        with self.condition:
+            if self._closed:
+                return
+            self.num_published += 1
+            if self._pending_all is not None:
+                self.num_coalesced += 1  # covered by the pending None event
+                return
+            if key is None or len(self._pending) >= self.max_pending:
+                if key is not None:
+                    self.num_collapsed += 1
+                self._pending_all = min([now] + list(self._pending.values()))
+                self.num_coalesced += len(self._pending)
+                self._pending.clear()
+            elif key in self._pending:
+                self.num_coalesced += 1
+                return
+            else:
+                self._pending[key] = now
+            self.condition.notify_all()
+
+    def _thread_main(self):
+        while True:
+            with self.condition:
+                while not self._pending and self._pending_all is None:
+                    if self._closed:
+                        return
+                    self.condition.wait()
+                if self._pending_all is not None:
+                    key, publish_time = None, self._pending_all
+                    self._pending_all = None
+                else:
+                    key, publish_time = self._pending.popitem(last=False)
+                self._busy = True
+            # noinspection PyBroadException
+            try:
+                self.callback(key)
+            except Exception:
+                better_exchook.better_exchook(*sys.exc_info())
+            with self.condition:
+                self.latencies.append(time.monotonic() - publish_time)
+                self.num_delivered += 1
+                self._busy = False
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        :param float|None timeout:
+        :return: whether all events were delivered
+        :rtype: bool
+        """
+        end_time = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            while self._pending or self._pending_all is not None or self._busy:
+                if end_time is None:
+                    self.condition.wait()
+                elif not self.condition.wait(max(end_time - time.monotonic(), 0)) and time.monotonic() >= end_time:
+                    return False
+            return True
+
+    def close(self, timeout=None):
+        """
+        Delivers the pending events, then stops the thread.
+
+        :param float|None timeout: for joining the thread
+        """
+        with self.condition:
+            self._closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def get_stats_formatted(self):
+        """
+        :rtype: str
+        """
+        with self.condition:
+            latencies = sorted(self.latencies)
+            s = "%s: published %i, delivered %i, coalesced %i, collapsed %i, pending %i" % (
+                self.name,
+                self.num_published,
+                self.num_delivered,
+                self.num_coalesced,
+                self.num_collapsed,
+                len(self._pending) + (1 if self._pending_all is not None else 0),
+            )
+        if latencies:
+            s += ", latency median %.3f sec, max %.3f sec" % (latencies[len(latencies) // 2], latencies[-1])
+        return s + "\n"
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.name)
+
+
+class EventBus:
+    def __init__(self):
+        self.subscriptions = []  # type: list  # list[Subscription]
+
+    def subscribe(self, callback, name=None, max_pending=100):
+        """
+        :param (str|None)->None callback: called in the dispatcher thread of this subscription
+        :param str|None name:
+        :param int max_pending: see :class:`Subscription`
+        :rtype: Subscription
+        """
+        if name is None:
+            name = getattr(callback, "__qualname__", None) or repr(callback)
+        sub = Subscription(callback=callback, name=name, max_pending=max_pending)
+        # Copy on write, such that publish does not need a lock.
+        self.subscriptions = self.subscriptions + [sub]
+        return sub
+
+    def unsubscribe(self, sub):
+        """
+        :param Subscription sub:
+        """
+        self.subscriptions = [s for s in self.subscriptions if s is not sub]
+        sub.close(timeout=0)
+
+    def publish(self, key):
+        """
+        :param str|None key: drinker name, or None for everything
+        """
+        for sub in self.subscriptions:
+            sub.publish(key)
+
+    def flush(self, timeout=None):
+        """
+        :param float|None timeout: per subscription
+        :return: whether all events were delivered
+        :rtype: bool
+        """
+        return all([sub.flush(timeout) for sub in self.subscriptions])
+
+    def close(self, timeout=None):
+        """
+        :param float|None timeout: per subscription. e.g. the GUI might not process events anymore at exit
+        """
+        for sub in self.subscriptions:
+            sub.close(timeout)
+
+    def get_stats_formatted(self):
+        """
+        :return: stats of all subscriptions, suitable for stdout
+        :rtype: str
+        """
+        if not self.subscriptions:
+            return "no subscriptions\n"
+        return "".join([sub.get_stats_formatted() for sub in self.subscriptions])
@@ -0,0 +1,279 @@
+"""
+Git commits of the DB directory.
+
+Forking ``git add`` and ``git commit`` is slow on the Pi, and ``git commit <dir>`` rescans the whole dir.
+Instead, :class:`GitCommitEngine` keeps a single ``git fast-import`` process open,
+and writes a commit directly with exactly the files which the DB knows that it touched.
+"""
+
+import os
+import time
+import hashlib
+import subprocess
+import typing
+from collections import deque
+from threading import Lock
+
+
+class GitCommitEngine:
+    Unchanged = "unchanged"  # all files are the same as in HEAD. nothing to commit
+
+    def __init__(self, path):
+        """
+        :param str path: DB directory (Git work tree)
+        """
+        self.path = path
+        self.lock = Lock()
+        self.proc = None  # type: subprocess.Popen|None
+        self.git_dir = None  # type: str|None
+        self.committer = None  # type: bytes|None  # "Name <email>"
+        self.use_fast_import = True
+        self.num_commits = 0
+        self._num_fast_import_requests = 0
+        self.gc_interval = 50  # run "git gc --auto" every N commits
+        self.stats = deque(maxlen=100)  # type: deque  # (time stamp, num files, latency in secs)
+
+    def _start(self):
+        self.git_dir = os.path.join(
+            self.path, subprocess.check_output(["git", "rev-parse", "--git-dir"], cwd=self.path).decode("utf8").strip()
+        )
+        # Like "Name <email> 1700000000 +0100". We only take the "Name <email>" part.
+        ident = subprocess.check_output(["git", "var", "GIT_COMMITTER_IDENT"], cwd=self.path).strip()
+        self.committer = ident.rsplit(b" ", 2)[0]
+        self.proc = subprocess.Popen(
+            ["git", "fast-import", "--quiet"], cwd=self.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+    def _read_head(self):
+        """
+        :return: (ref, commit hash). the commit hash is None for an unborn branch. ref is None for a detached HEAD
+        :rtype: (str|None, str|None)
+        """
+        head = open("%s/HEAD" % self.git_dir).read().strip()
+        if not head.startswith("ref: "):
+            return None, head
+        ref = head[len("ref: ") :]
+        if os.path.exists("%s/%s" % (self.git_dir, ref)):
+            return ref, open("%s/%s" % (self.git_dir, ref)).read().strip()
+        if os.path.exists("%s/packed-refs" % self.git_dir):
+            for line in open("%s/packed-refs" % self.git_dir).read().splitlines():
+                if line.endswith(" " + ref) and not line.startswith("#"):
+                    return ref, line.split(" ", 1)[0]
+        return ref, None
+
+    def read_contents(self, paths):
+        """
+        :param list[str] paths: files relative to the DB directory
+        :return: path -> data, or None if the file does not exist (deleted)
+        :rtype: dict[str,bytes|None]
+        """
+        contents = {}  # type: typing.Dict[str,typing.Optional[bytes]]
+        for path in paths:
+            fn = "%s/%s" % (self.path, path)
+            if os.path.exists(fn):
+                with open(fn, "rb") as f:
+                    contents[path] = f.read()
+            else:
+                contents[path] = None
+        return contents
+
+    def commit(self, paths, commit_msg, contents=None):
+        """
+        :param list[str] paths: files relative to the DB directory. deleted files will be deleted in Git
+        :param str commit_msg:
+        :param dict[str,bytes|None]|None contents: via :func:`read_contents`, as a consistent snapshot.
+            Then the files can be changed while we commit. Otherwise the files are read here.
+            (The git add/commit fallback always uses the files.)
+        :return: whether the commit was successful
+        :rtype: bool
+        """
+        if not paths:
+            return True
+        with self.lock:
+            start_time = time.monotonic()
+            ok = False
+            if self.use_fast_import:
+                try:
+                    ok = self._commit_fast_import(paths, commit_msg, contents=contents)
+                except (OSError, subprocess.CalledProcessError) as exc:
+                    print("Git fast-import error:", exc)
+                if not ok:
+                    print("Git fast-import failed, falling back to git add/commit.")
+                    self.use_fast_import = False
+                    self.close()
+            if not ok:
+                ok = self._commit_fallback(paths, commit_msg)
+            if not ok:
+                return False
+            if ok == self.Unchanged:
+                return True
+            latency = time.monotonic() - start_time
+            self.stats.append((time.time(), len(paths), latency))
+            self.num_commits += 1
+            print("Git commit: %i files, %.3f sec." % (len(paths), latency))
+            if self.num_commits % self.gc_interval == 0:
+                subprocess.call(["git", "gc", "--auto", "--quiet"], cwd=self.path)
+            return True
+
+    def _commit_fast_import(self, paths, commit_msg, contents=None):
+        """
+        :param list[str] paths:
+        :param str commit_msg:
+        :param dict[str,bytes|None]|None contents:
+        :return: whether successful, or :data:`Unchanged`
+        :rtype: bool|str
+        """
+        if not self.proc:
+            self._start()
+        ref, parent = self._read_head()
+        if not ref:
+            print("Git: detached HEAD, cannot use fast-import.")
+            return False
+        if contents is None:
+            contents = self.read_contents(paths)
+        changed = self._get_changed(parent, contents)
+        if changed is None:
+            return False
+        if not changed:
+            return self.Unchanged
+        commit_msg_bytes = commit_msg.encode("utf8") + b"\n"
+        out = [b"commit %s\n" % ref.encode("utf8")]
+        out.append(b"committer %s %i %s\n" % (self.committer, int(time.time()), time.strftime("%z").encode("utf8")))
+        out.append(b"data %i\n%s" % (len(commit_msg_bytes), commit_msg_bytes))
+        if parent:
+            out.append(b"from %s\n" % parent.encode("utf8"))
+        for path in changed:
+            data = contents[path]
+            if data is not None:
+                out.append(b"M 100644 inline %s\ndata %i\n%s\n" % (path.encode("utf8"), len(data), data))
+            else:
+                out.append(b"D %s\n" % path.encode("utf8"))
+        # checkpoint: write the objects, update the ref. progress: tells us when this is done.
+        out.append(b"\ncheckpoint\n\n")
+        if self._request(out, num_lines=0) is None:
+            return False
+        _, new_head = self._read_head()
+        if new_head == parent:
+            print("Git fast-import: %s was not updated." % ref)
+            return False
+        self._update_index(changed)
+        return True
+
+    def _update_index(self, changed):
+        """
+        fast-import does not touch the index. Update it, otherwise "git status" would show the reverted files.
+        If a file was changed in the meantime, it is just shown as modified, and it is part of the next commit.
+        We already know the blob hashes, so Git does not need to read HEAD or the files for this.
+
+        :param dict[str,str|None] changed: path -> blob hash, or None if deleted. see :func:`_get_changed`
+        """
+        lines = []
+        for path, blob_hash in changed.items():
+            if blob_hash:
+                lines.append("100644 %s\t%s\n" % (blob_hash, path))
+            else:
+                lines.append("0 %s\t%s\n" % ("0" * 40, path))  # mode 0 removes the entry
+        proc = subprocess.Popen(["git", "update-index", "--index-info"], cwd=self.path, stdin=subprocess.PIPE)
+        proc.communicate("".join(lines).encode("utf8"))
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    def _request(self, out, num_lines):
+        """
+        :param list[bytes] out: commands for fast-import
+        :param int num_lines: num lines to read from stdout, e.g. for the "ls" commands
+        :return: the output lines, or None on error
+        :rtype: list[bytes]|None
+        """
+        self._num_fast_import_requests += 1
+        progress_msg = b"progress drink-kiosk %i\n" % self._num_fast_import_requests
+        self.proc.stdin.write(b"".join(out) + progress_msg)
+        self.proc.stdin.flush()
+        lines = [self.proc.stdout.readline() for _ in range(num_lines + 1)]
+        if lines[-1] != progress_msg:
+            print("Git fast-import: unexpected output %r" % lines)
+            return None
+        return lines[:-1]
+
+    def _get_changed(self, parent, contents):
+        """
+        :param str|None parent: commit hash, or None for an unborn branch
+        :param dict[str,bytes|None] contents: path -> data, or None if deleted
+        :return: the files which differ from the parent commit: path -> blob hash, or None if deleted.
+            None on error
+        :rtype: dict[str,str|None]|None
+        """
+        changed = {}  # type: typing.Dict[str,typing.Optional[str]]
+        if parent:
+            parent_ = parent.encode("utf8")
+            lines = self._request([b"ls %s %s\n" % (parent_, path.encode("utf8")) for path in contents], len(contents))
+            if lines is None:
+                return None
+        else:
+            lines = [b"missing"] * len(contents)
+        for (path, data), line in zip(contents.items(), lines):
+            # Either "<mode> blob <hash>\t<path>" or "missing <path>".
+            if line.startswith(b"missing"):
+                if data is not None:
+                    changed[path] = hashlib.sha1(b"blob %i\0" % len(data) + data).hexdigest()
+                continue
+            if data is None:
+                changed[path] = None
+                continue
+            blob_hash = hashlib.sha1(b"blob %i\0" % len(data) + data).hexdigest()
+            if line.split(b"\t", 1)[0].split(b" ")[2].decode("utf8") != blob_hash:
+                changed[path] = blob_hash
+        return changed
+
+    def _commit_fallback(self, paths, commit_msg):
+        """
+        :param list[str] paths:
+        :param str commit_msg:
+        :return: whether successful, or :data:`Unchanged`
+        :rtype: bool|str
+        """
+        try:
+            cmd = ["git", "add", "-A", "--"] + paths
+            print("$ %s" % " ".join(cmd))
+            subprocess.check_call(cmd, cwd=self.path)
+        except subprocess.CalledProcessError as exc:
+            print("Git add error:", exc)
+            return False
+        # Otherwise "git commit" fails with "nothing to commit", and the caller would retry forever.
+        if subprocess.call(["git", "diff", "--cached", "--quiet", "--"] + paths, cwd=self.path) == 0:
+            return self.Unchanged
+        try:
+            cmd = ["git", "commit", "-m", commit_msg, "--"] + paths
+            print("$ %s" % " ".join(cmd))
+            subprocess.check_call(cmd, cwd=self.path)
+        except subprocess.CalledProcessError as exc:
+            print("Git commit error:", exc)
+            return False
+        return True
+
+    def get_stats_formatted(self):
+        """
+        :return: commit latency and number of files per commit, suitable for stdout
+        :rtype: str
+        """
+        if not self.stats:
+            return "no commits\n"
+        latencies = sorted(latency for (_, _, latency) in self.stats)
+        num_files = [n for (_, n, _) in self.stats]
+        return "".join(
+            [
+                "commits: %i (last %i: files per commit avg %.1f, max %i)\n"
+                % (self.num_commits, len(self.stats), sum(num_files) / len(num_files), max(num_files)),
+                "latency: median %.3f sec, max %.3f sec\n" % (latencies[len(latencies) // 2], latencies[-1]),
+                "method: %s\n" % ("fast-import" if self.use_fast_import else "git add/commit"),
+            ]
+        )
+
+    def close(self):
+        """
+        Stops the fast-import process.
+        """
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
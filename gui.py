@@ -3,6 +3,11 @@ GUI
 """
 
 import sys
+import queue
+import string
+import weakref
+import bisect
+import traceback
 from threading import Thread
 import time
 import typing
@@ -12,59 +17,319 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.button import Button
 from kivy.uix.label import Label
+from kivy.uix.textinput import TextInput
 from kivy.graphics import Color, Rectangle
 from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
 from kivy.uix.popup import Popup
-from kivy.animation import Animation
+from kivy.uix.widget import Widget
 import threading
-from threading import Condition
+from collections import OrderedDict, deque
 from db import Db, BuyItem, Drinker
+from utils import time_stamp
+from search_index import PrefixIndex, normalize_words
 from kivy.clock import Clock
-from concurrent.futures import Future
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import better_exchook
 
 
-# noinspection PyPep8Naming
-class run_in_mainthread_blocking:
-    def __init__(self):
-        pass
+class MainThreadDispatcher:
+    """
+    Runs functions in the Kivy main thread, for calls from other threads.
 
-    def __call__(self, func):
-        def wrapped_func(*args, **kwargs):
-            if threading.current_thread() is threading.main_thread():
-                return func(*args, **kwargs)
+    All work items are put into a queue, and a single Clock trigger per frame runs all of them.
+    Work items with the same key (e.g. an update of the same widget) which are still queued
+    are collapsed into one.
+    Blocking callers wait with a timeout, such that a stuck main loop does not deadlock the caller.
+    """
+
+    def __init__(self, default_timeout=10.0):
+        """
+        :param float|None default_timeout: for :func:`call_blocking`. None means to wait forever
+        """
+        self.default_timeout = default_timeout
+        self.lock = threading.Lock()
+        self.queue = OrderedDict()  # type: OrderedDict  # key -> (func, args, kwargs, future, enqueue time)
+        self._trigger = Clock.create_trigger(self._run_queue, 0)
+        self._next_anonymous_key = 0
+        self.latencies = deque(maxlen=1000)  # type: deque  # secs from enqueue until the item was run
+        self.num_executed = 0
+        self.num_collapsed = 0
+        self.num_timeouts = 0
+        self.max_batch_size = 0
 
-            cond = Condition()
+    def submit(self, func, args=(), kwargs=None, key=None):
+        """
+        :param callable func:
+        :param tuple args:
+        :param dict[str]|None kwargs:
+        :param object|None key: if there is a queued item with the same key, this collapses into it
+        :return: future for the result
+        :rtype: Future
+        """
+        with self.lock:
+            if key is None:
+                key = ("anonymous", self._next_anonymous_key)
+                self._next_anonymous_key += 1
+            elif key in self.queue:
+                self.num_collapsed += 1
+                return self.queue[key][3]
             future = Future()
+            self.queue[key] = (func, args, kwargs or {}, future, time.monotonic())
+        self._trigger()
+        return future
+
+    def call_blocking(self, func, args=(), kwargs=None, key=None, timeout=None):
+        """
+        :param callable func:
+        :param tuple args:
+        :param dict[str]|None kwargs:
+        :param object|None key: see :func:`submit`
+        :param float|None timeout: by default :data:`default_timeout`
+        :return: result of func
+        """
+        if threading.current_thread() is threading.main_thread():
+            return func(*args, **(kwargs or {}))
+        future = self.submit(func, args=args, kwargs=kwargs, key=key)
+        if timeout is None:
+            timeout = self.default_timeout
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            with self.lock:
+                self.num_timeouts += 1
+                queue_len = len(self.queue)
+            # The item stays in the queue, and it will still be run once the main loop continues.
+            raise TimeoutError(
+                "main thread did not run %s within %.1f sec (queue length %i). main loop stuck?"
+                % (getattr(func, "__qualname__", func), timeout, queue_len)
+            )
+
+    def _run_queue(self, _dt):
+        assert threading.current_thread() is threading.main_thread()
+        with self.lock:
+            items = list(self.queue.values())
+            self.queue.clear()
+            self.max_batch_size = max(self.max_batch_size, len(items))
+        for func, args, kwargs, future, enqueue_time in items:
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.latencies.append(time.monotonic() - enqueue_time)
+            try:
+                res = func(*args, **kwargs)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(res)
+            self.num_executed += 1
+
+    def get_stats_formatted(self):
+        """
+        :return: queueing latency etc., suitable for stdout
+        :rtype: str
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            queue_len = len(self.queue)
+        s = "executed %i, collapsed %i, timeouts %i, queued %i, max batch size %i\n" % (
+            self.num_executed,
+            self.num_collapsed,
+            self.num_timeouts,
+            queue_len,
+            self.max_batch_size,
+        )
+        if latencies:
+            s += "latency: median %.3f sec, 99%% %.3f sec, max %.3f sec\n" % (
+                latencies[len(latencies) // 2],
+                latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+                latencies[-1],
+            )
+        return s
+
 
-            def callback_func(_dt):
-                try:
-                    res = func(*args, **kwargs)
-                    with cond:
-                        future.set_result(res)
-                        cond.notify()
-                except Exception as exc:
-                    with cond:
-                        future.set_exception(exc)
-                        cond.notify()
-                finally:
-                    with cond:
-                        if not future.done():
-                            future.cancel()
-                            cond.notify()
-
-            with cond:
-                Clock.schedule_once(callback_func, 0)
-                cond.wait()
-                assert future.done()
-                if future.cancelled():
-                    raise Exception("did not execute func %s" % func)
-                if future.exception():
-                    raise future.exception()
-                return future.result()
+main_thread_dispatcher = MainThreadDispatcher()
+
+
+# noinspection PyPep8Naming
+class run_in_mainthread:
+    """
+    Decorator for methods which must run in the main thread, via :data:`main_thread_dispatcher`.
+    When called from another thread, it blocks until the method was run in the main thread.
+    Queued calls of the same method on the same object with the same args are collapsed into one.
+    """
+
+    def __init__(self, timeout=None):
+        """
+        :param float|None timeout: see :func:`MainThreadDispatcher.call_blocking`
+        """
+        self.timeout = timeout
+
+    def __call__(self, func):
+        def wrapped_func(self_, *args, **kwargs):
+            key = (func, id(self_), args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:  # unhashable args, cannot collapse
+                key = None
+            return main_thread_dispatcher.call_blocking(
+                func, args=(self_,) + args, kwargs=kwargs, key=key, timeout=self.timeout
+            )
 
         return wrapped_func
 
 
+class PurchaseWorker:
+    """
+    Persists purchases (:func:`Db.drinker_buy_item`) in a background thread,
+    such that the GUI does not wait for file I/O or DB locks.
+    Purchases are persisted one after another, in the order they were submitted.
+    The result is passed back to the main thread via :data:`main_thread_dispatcher`.
+
+    Every purchase gets a sequence number. For every drinker state from :func:`get_drinker`,
+    we know up to which sequence number the purchases are contained,
+    such that the GUI adds only the other pending purchases (see :func:`get_pending_items`).
+    While purchases of a drinker are pending, :func:`get_drinker` returns the last state from the worker,
+    and does not read the DB, such that the GUI never waits for the DB locks which the worker holds.
+    """
+
+    def __init__(self, db):
+        """
+        :param Db db:
+        """
+        self.db = db
+        self.queue = queue.Queue()  # type: queue.Queue  # (seq, drinker name, item name, callback) or None to stop
+        # Purchases where the callback did not run yet. They are already shown in the GUI (optimistic UI).
+        # Only accessed in the main thread.
+        self.pending = {}  # type: typing.Dict[str,typing.Dict[int,str]]  # drinker name -> seq -> drink intern name
+        self._next_seq = 1
+        # Drinker name -> (drinker state, seq of the last purchase it contains), for drinkers with pending purchases.
+        # Initially the state shown when the first purchase was submitted, then updated by the worker thread.
+        self.lock = threading.Lock()  # for _persisted. leaf lock, never held while waiting for the DB
+        self._persisted = {}  # type: typing.Dict[str,typing.Tuple[Drinker,int]]
+        self._persisted_reads = set()  # type: typing.Set[str]  # drinker names read from _persisted, see _on_done
+        # Drinker state (as returned by get_drinker) -> seq of the last purchase it contains. Only in the main thread.
+        self._drinker_seqs = weakref.WeakKeyDictionary()  # type: typing.MutableMapping[Drinker,int]
+        self.num_done = 0
+        self.num_failed = 0
+        self.thread = Thread(target=self._thread_main, name=self.__class__.__name__, daemon=True)
+        self.thread.start()
+
+    def buy_item(self, drinker, item_name, callback):
+        """
+        Does not block. Only in the main thread.
+
+        :param Drinker drinker: the state currently shown, from :func:`get_drinker`
+        :param str item_name: intern name
+        :param (Drinker|None,Exception|None)->None callback: called in the main thread,
+            with the updated drinker, or with the exception on failure
+        """
+        seq = self._next_seq
+        self._next_seq += 1
+        if drinker.name not in self.pending:
+            with self.lock:
+                self._persisted[drinker.name] = (drinker, self._drinker_seqs.get(drinker, 0))
+        self.pending.setdefault(drinker.name, {})[seq] = item_name
+        self.queue.put((seq, drinker.name, item_name, callback))
+
+    def get_drinker(self, name):
+        """
+        Like :func:`Db.get_drinker`, and remembers which purchases this drinker state contains.
+        Only in the main thread.
+
+        :param str name:
+        :rtype: Drinker
+        """
+        if name in self.pending:
+            with self.lock:
+                drinker, seq = self._persisted[name]
+            self._persisted_reads.add(name)
+        else:
+            # No purchase of this drinker is in flight, so this state contains all of them.
+            drinker = self.db.get_drinker(name)
+            seq = self._next_seq - 1
+        self._drinker_seqs[drinker] = seq
+        return drinker
+
+    def get_pending_items(self, drinker):
+        """
+        Only in the main thread.
+
+        :param Drinker drinker: from :func:`get_drinker`, or passed to the callback of :func:`buy_item`
+        :return: drink intern name -> count, of the pending purchases which are not contained in this drinker state
+        :rtype: dict[str,int]
+        """
+        contained_seq = self._drinker_seqs.get(drinker, 0)
+        counts = {}  # type: typing.Dict[str,int]
+        for seq, item_name in self.pending.get(drinker.name, {}).items():
+            if seq > contained_seq:
+                counts[item_name] = counts.get(item_name, 0) + 1
+        return counts
+
+    def _thread_main(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            seq, drinker_name, item_name, callback = item
+            # noinspection PyBroadException
+            try:
+                # A copy, as the main thread reads it, and the DB might modify its object.
+                drinker = self.db.drinker_buy_item(drinker_name=drinker_name, item_name=item_name).copy()
+                # The GUI might reload the drinker (e.g. via the update event) before our callback runs.
+                # Then it gets this state, with the seq, such that it does not count this purchase twice.
+                with self.lock:
+                    self._persisted[drinker_name] = (drinker, seq)
+            except Exception as exc:
+                self.num_failed += 1
+                print("PurchaseWorker: %s drinks %s failed:" % (drinker_name, item_name))
+                better_exchook.better_exchook(*sys.exc_info())
+                main_thread_dispatcher.submit(self._on_done, args=(seq, drinker_name, None, exc, callback))
+            else:
+                self.num_done += 1
+                main_thread_dispatcher.submit(self._on_done, args=(seq, drinker_name, drinker, None, callback))
+            self.queue.task_done()
+
+    def _on_done(self, seq, drinker_name, drinker, exc, callback):
+        """
+        In the main thread.
+
+        :param int seq:
+        :param str drinker_name:
+        :param Drinker|None drinker: updated drinker, which contains this purchase
+        :param Exception|None exc:
+        :param (Drinker|None,Exception|None)->None callback:
+        """
+        pending = self.pending[drinker_name]
+        del pending[seq]
+        if drinker is not None:
+            self._drinker_seqs[drinker] = max(seq, self._drinker_seqs.get(drinker, 0))
+        if not pending:
+            del self.pending[drinker_name]
+            with self.lock:
+                del self._persisted[drinker_name]
+        callback(drinker, exc)
+        if not pending and drinker_name in self._persisted_reads:
+            # Some reload got the state from the worker instead of the DB. Other changes (e.g. via the admin RPC)
+            # might have been missed, so reload once more from the DB, via the usual update event.
+            self._persisted_reads.discard(drinker_name)
+            self.db.events.publish(drinker_name)
+
+    def close(self, timeout=None):
+        """
+        Persists all pending purchases, then stops the thread.
+        The callbacks of the pending purchases might not be called anymore, when the main loop is stopped.
+
+        :param float|None timeout:
+        """
+        self.queue.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print("PurchaseWorker: not finished after %s sec, %i purchases pending." % (timeout, self.queue.qsize()))
+
+
 class Setter:
     def __init__(self, obj, attrib):
         self.obj = obj
@@ -108,48 +373,454 @@ def kill_at_night(night_hours_range=(3, 4), min_runtime_hours=12):
     KillAtNightTimerThread()
 
 
-class DrinkerWidget(BoxLayout):
+class ColumnWidths:
+    """
+    Widths of the balance label and of the buy item buttons of a drinker row.
+    Measuring needs a texture update, so this is done once per buy items config, and not per row.
+    """
+
+    _cache = {}  # type: typing.Dict[tuple,ColumnWidths]  # buy items config -> column widths
+
+    def __init__(self, db):
+        """
+        :param Db db:
+        """
+        self.key = self.get_key(db)
+        # Use width=..., size_hint_x=None for fixed width.
+        label = Label(text="-XX.XX %s" % db.currency)
+        label.texture_update()  # to know the size of the text (texture_size)
+        self.credit_balance = label.texture_size[0] + 2  # text size + padding
+        self.buy_items = {}  # type: typing.Dict[str,int]  # drink intern name -> button width
+        button = Button(font_size="12sp")
+        for drink in db.get_buy_items():
+            button.text = "%s (%s %s): %s" % (drink.shown_name, drink.price, db.currency, "XXX")
+            button.texture_update()
+            self.buy_items[drink.intern_name] = button.texture_size[0] + 2
+
+    @classmethod
+    def get_key(cls, db):
+        """
+        :param Db db:
+        :rtype: tuple
+        """
+        return (db.currency,) + tuple(
+            [(drink.intern_name, drink.shown_name, str(drink.price)) for drink in db.get_buy_items()]
+        )
+
+    @classmethod
+    def get(cls, db):
+        """
+        :param Db db:
+        :rtype: ColumnWidths
+        """
+        key = cls.get_key(db)
+        if key not in cls._cache:
+            cls._cache[key] = ColumnWidths(db)
+        return cls._cache[key]
+
+
+def get_drinker_sort_key(drinker):
+    """
+    :param Drinker drinker:
+    :return: key for the order of the drinkers in the GUI, by last name
+    :rtype: list[str]
+    """
+    return drinker.shown_name.split()[::-1]
+
+
+def diff_drinkers(db, shown_drinkers, sort_keys, force_changed=False, get_drinker=None):
+    """
+    Compares the drinkers currently shown in the GUI with the DB.
+
+    :param Db db:
+    :param dict[str,Drinker] shown_drinkers: drinker name -> drinker, as currently shown in the GUI
+    :param dict[str,list[str]] sort_keys: drinker name -> :func:`get_drinker_sort_key`. updated in place
+    :param bool force_changed: all drinkers which are not added are considered changed, e.g. when the buy items changed
+    :param ((str)->Drinker)|None get_drinker: e.g. :func:`PurchaseWorker.get_drinker`. by default :func:`Db.get_drinker`
+    :return: added drinkers, removed drinker names, changed drinkers, all drinker names in the order for the GUI
+    :rtype: (list[Drinker],list[str],list[Drinker],list[str])
+    """
+    added, changed = [], []
+    if get_drinker is None:
+        get_drinker = db.get_drinker
+    names = db.get_drinker_names()
+    for name in names:
+        drinker = get_drinker(name)
+        shown_drinker = shown_drinkers.get(name)
+        if shown_drinker is None:
+            added.append(drinker)
+        elif force_changed or (
+            shown_drinker.shown_name != drinker.shown_name
+            or shown_drinker.credit_balance != drinker.credit_balance
+            or shown_drinker.buy_item_counts != drinker.buy_item_counts
+        ):
+            changed.append(drinker)
+        elif name in sort_keys:
+            continue
+        sort_keys[name] = get_drinker_sort_key(drinker)
+    names_set = set(names)
+    removed = [name for name in shown_drinkers if name not in names_set]
+    for name in removed:
+        sort_keys.pop(name, None)
+    order = sorted(names, key=sort_keys.__getitem__)
+    return added, removed, changed, order
+
+
+class HighlightDecayTimer:
+    """
+    Fades out the highlighted buttons of all :class:`DrinkerWidget` instances with a single Clock timer,
+    instead of one animation per button.
+    The timer only runs while some button is highlighted, such that there are no wakeups when the kiosk is idle.
+    """
+
+    def __init__(self, interval=10.0):
+        """
+        :param float interval: secs
+        """
+        self.interval = interval
+        self.widgets = weakref.WeakSet()  # type: typing.MutableSet[DrinkerWidget]
+        self._event = None
+
+    def add(self, widget):
+        """
+        :param DrinkerWidget widget: has some highlighted button
+        """
+        self.widgets.add(widget)
+        if self._event is None:
+            self._event = Clock.schedule_interval(self._tick, self.interval)
+
+    def _tick(self, _dt):
+        for widget in list(self.widgets):
+            if not widget._load_highlights():
+                self.widgets.discard(widget)
+        if not self.widgets:
+            self._event.cancel()
+            self._event = None
+
+
+highlight_decay_timer = HighlightDecayTimer()
+
+
+class IdleMode:
+    """
+    After some time without any touch or key press, the GUI goes into idle mode:
+    the Clock frame rate is lowered, and the screen is dimmed or blanked (by an overlay).
+    The first touch wakes it up again. On a blanked screen, this touch is consumed,
+    such that it does not accidentally press some button which was not visible.
+
+    The CPU time is accounted separately for the active and the idle periods, see :func:`get_stats_formatted`.
+    """
+
+    Screens = {"none": None, "dim": 0.6, "blank": 1.0}  # -> opacity of the black overlay
+
+    def __init__(self, timeout=120.0, idle_fps=5, screen="dim", on_idle=None):
+        """
+        :param float timeout: secs of inactivity until idle mode
+        :param int idle_fps: max frame rate in idle mode
+        :param str screen: see :data:`Screens`
+        :param (()->None)|None on_idle: called in the main thread when entering idle mode
+        """
+        assert screen in self.Screens, "invalid idle screen %r, expected one of %r" % (screen, list(self.Screens))
+        self.timeout = timeout
+        self.idle_fps = idle_fps
+        self.screen = screen
+        self.on_idle = on_idle
+        self.idle = False
+        self.last_activity_time = time.monotonic()
+        self._active_max_fps = None  # type: Optional[float]
+        self._overlay = None  # type: Optional[Widget]
+        self._check_event = None
+        self._window = None
+        self._mode_start_time = time.monotonic()
+        self._mode_start_cpu_time = time.process_time()
+        self.num_idle_periods = 0
+        # mode ("active" or "idle") -> [wall secs, cpu secs], for the finished periods
+        self.totals = {"active": [0.0, 0.0], "idle": [0.0, 0.0]}  # type: typing.Dict[str,typing.List[float]]
+
+    def start(self):
+        """
+        Call this once the app is running (e.g. in on_start).
+        """
+        from kivy.core.window import Window
+
+        self._window = Window
+        Window.bind(on_touch_down=self._on_touch_down, on_key_down=self._on_key_down)
+        self._active_max_fps = Clock._max_fps  # not public API, but it is read on every frame
+        self._schedule_check(self.timeout)
+
+    def _schedule_check(self, wait_time):
+        if self._check_event is not None:
+            self._check_event.cancel()
+        # A single timer, rescheduled for exactly when the timeout could be reached. No polling.
+        self._check_event = Clock.schedule_once(self._check, max(wait_time, 0.0))
+
+    def _check(self, _dt):
+        self._check_event = None
+        if self.idle:
+            return
+        remaining_time = self.last_activity_time + self.timeout - time.monotonic()
+        if remaining_time > 0:
+            self._schedule_check(remaining_time)
+            return
+        self._enter_idle()
+
+    def _on_touch_down(self, _window, _touch):
+        consume = self.idle and self.screen == "blank"
+        self.wake()
+        return consume
+
+    def _on_key_down(self, *_args):
+        self.wake()
+        return False
+
+    def _switch_mode(self):
+        now, cpu_time = time.monotonic(), time.process_time()
+        totals = self.totals["idle" if self.idle else "active"]
+        totals[0] += now - self._mode_start_time
+        totals[1] += cpu_time - self._mode_start_cpu_time
+        self._mode_start_time, self._mode_start_cpu_time = now, cpu_time
+        self.idle = not self.idle
+
+    def _enter_idle(self):
+        print("GUI: idle mode, after %.0f sec without activity." % self.timeout)
+        self._switch_mode()
+        self.num_idle_periods += 1
+        Clock._max_fps = float(self.idle_fps)
+        opacity = self.Screens[self.screen]
+        if opacity is not None:
+            self._overlay = Widget()
+            with self._overlay.canvas:
+                Color(0, 0, 0, opacity)
+                rect = Rectangle(pos=(0, 0), size=self._window.size)
+            self._overlay.bind(size=Setter(rect, "size"))
+            self._overlay.size = self._window.size
+            self._window.add_widget(self._overlay)
+        if self.on_idle:
+            self.on_idle()
+
+    def wake(self):
+        """
+        Registers activity, and leaves the idle mode (if active). Only in the main thread.
+        """
+        self.last_activity_time = time.monotonic()
+        if not self.idle:
+            return
+        self._switch_mode()
+        Clock._max_fps = self._active_max_fps
+        if self._overlay:
+            self._window.remove_widget(self._overlay)
+            self._overlay = None
+        self._schedule_check(self.timeout)
+
+    def get_stats_formatted(self):
+        """
+        :return: CPU usage in the active and the idle periods, suitable for stdout
+        :rtype: str
+        """
+        now, cpu_time = time.monotonic(), time.process_time()
+        s = "idle mode: %s, %i idle periods\n" % ("on" if self.idle else "off", self.num_idle_periods)
+        for mode in ["active", "idle"]:
+            wall_time, mode_cpu_time = self.totals[mode]
+            if self.idle == (mode == "idle"):
+                wall_time += now - self._mode_start_time
+                mode_cpu_time += cpu_time - self._mode_start_cpu_time
+            s += "%s: %.0f sec, CPU %.1f sec (%.1f%%)\n" % (
+                mode,
+                wall_time,
+                mode_cpu_time,
+                mode_cpu_time / wall_time * 100.0 if wall_time > 0 else 0.0,
+            )
+        return s
+
+
+class StallWatchdog:
+    """
+    Detects when the Kivy main thread stalls, e.g. on NFS hiccups or while it waits for some DB lock.
+
+    The Clock sets a heartbeat every frame, and a watchdog thread checks it.
+    When there was no heartbeat for longer than the threshold,
+    the stacks of all threads and the holders of the DB locks are written to the log (and stdout).
+    The gaps between frames are collected in a histogram, see :func:`get_frame_gaps_formatted`.
+    """
+
+    # Upper bounds of the histogram buckets, in secs.
+    FrameGapBuckets = (0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, float("inf"))
+
+    def __init__(self, db, threshold=5.0, log_filename=None):
+        """
+        :param Db db:
+        :param float threshold: secs without a frame until we consider the main thread as stalled
+        :param str|None log_filename: the stall reports are appended to this file, and printed to stdout
+        """
+        self.db = db
+        self.threshold = threshold
+        self.log_filename = log_filename
+        self.last_heartbeat_time = time.monotonic()
+        self.frame_gap_counts = [0] * len(self.FrameGapBuckets)
+        self.max_frame_gap = 0.0
+        self.num_stalls = 0
+        self._stall_reported = False
+        self._thread = None  # type: Optional[Thread]
+
+    def start(self):
+        """
+        Call this once the app is running (e.g. in on_start).
+        """
+        self.last_heartbeat_time = time.monotonic()
+        Clock.schedule_interval(self._heartbeat, 0)
+        self._thread = Thread(target=self._thread_main, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self, _dt):
+        now = time.monotonic()
+        gap = now - self.last_heartbeat_time
+        self.last_heartbeat_time = now
+        self.frame_gap_counts[bisect.bisect_left(self.FrameGapBuckets, gap)] += 1
+        self.max_frame_gap = max(self.max_frame_gap, gap)
+        if self._stall_reported:
+            self._stall_reported = False
+            self._log("%s: GUI main thread recovered, after a stall of %.1f sec.\n" % (time_stamp(), gap))
+
+    def _thread_main(self):
+        while True:
+            time.sleep(self.threshold / 4.0)
+            gap = time.monotonic() - self.last_heartbeat_time
+            if gap > self.threshold and not self._stall_reported:
+                self._stall_reported = True
+                self.num_stalls += 1
+                self._log(self.get_stall_report_formatted(gap))
+
+    def get_stall_report_formatted(self, gap):
+        """
+        :param float gap: secs since the last frame
+        :return: stacks of all threads, and the DB lock holders
+        :rtype: str
+        """
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        s = "%s: GUI main thread stalled, no frame since %.1f sec.\n" % (time_stamp(), gap)
+        s += self.db.get_lock_holders_formatted()
+        # noinspection PyProtectedMember
+        for ident, frame in sorted(sys._current_frames().items()):
+            thread = threads.get(ident)
+            s += "\nThread %s (%s):\n" % (thread.name if thread else "?", ident)
+            s += "".join(traceback.format_stack(frame))
+        return s
+
+    def _log(self, s):
+        """
+        :param str s:
+        """
+        print(s, end="")
+        if self.log_filename:
+            # noinspection PyBroadException
+            try:
+                with open(self.log_filename, "a", encoding="utf8") as f:
+                    f.write(s)
+            except Exception as exc:
+                print("StallWatchdog: cannot write log %s: %s" % (self.log_filename, exc))
+
+    def get_frame_gaps_formatted(self):
+        """
+        :return: histogram of the gaps between frames, suitable for stdout
+        :rtype: str
+        """
+        counts = list(self.frame_gap_counts)
+        total = sum(counts)
+        s = "%i frames, max gap %.3f sec, %i stalls (> %.1f sec)\n" % (
+            total,
+            self.max_frame_gap,
+            self.num_stalls,
+            self.threshold,
+        )
+        lower = 0.0
+        for upper, count in zip(self.FrameGapBuckets, counts):
+            s += "%6.2f - %6.2f sec: %8i (%5.1f%%)\n" % (lower, upper, count, count * 100.0 / max(total, 1))
+            lower = upper
+        return s
+
+
+class DrinkerWidget(RecycleDataViewBehavior, BoxLayout):
     """
     Widget for a single drinker.
+    This is used by :class:`DrinkersListWidget`, and as reusable row by :class:`DrinkersRecycleView`.
     """
 
-    def __init__(self, db: Db, drinker: Drinker, **kwargs):
+    HighlightDuration = 60 * 5  # seconds
+    HighlightColorBought = (0.0, 1.0, 0.0)  # RGB
+    HighlightColorFailed = (1.0, 0.0, 0.0)
+
+    def __init__(self, list_widget=None, drinker: Optional[Drinker] = None, **kwargs):
+        """
+        :param DrinkersListWidget|DrinkersRecycleView|None list_widget:
+            None when created by the RecycleView. then it is set in :func:`refresh_view_attrs`
+        :param Drinker|None drinker:
+        """
         super(DrinkerWidget, self).__init__(spacing=4, orientation="horizontal", **kwargs)
-        self.db = db
-        self.drinker = drinker  # cached here. WARNING: might not be up-to-date
-        self.name = drinker.name
+        self.list_widget = None  # type: typing.Union[DrinkersListWidget,DrinkersRecycleView,None]
+        self.db = None  # type: Optional[Db]
+        self.drinker = None  # type: Optional[Drinker]  # cached here. WARNING: might not be up-to-date
+        self.name = None  # type: Optional[str]
+        self._column_widths_key = None  # type: Optional[tuple]
+        self._highlights_state = None  # type: Optional[tuple]  # to know when to update the button colors
         # White background
         with self.canvas.before:
             Color(1, 1, 1, 1)
             self.rect = Rectangle(size=self.size, pos=self.pos)
-        self.name_label = Label(text=self.drinker.shown_name, color=(0, 0, 0, 1))
+        self.name_label = Label(color=(0, 0, 0, 1))
         self.add_widget(self.name_label)
-        # Use width=..., size_hint_x=None for fixed width.
-        self.credit_balance_label = Label(text="-XX.XX %s" % self.db.currency, color=(0, 0, 0, 1), size_hint_x=None)
-        self.credit_balance_label.texture_update()  # to know the size of the text (texture_size)
-        self.credit_balance_label.width = self.credit_balance_label.texture_size[0] + 2  # text size + padding
+        self.credit_balance_label = Label(color=(0, 0, 0, 1), size_hint_x=None)
         self.add_widget(self.credit_balance_label)
         self.drink_buttons = {}  # type: typing.Dict[str,Button]  # by drink intern name
+        self.bind(size=Setter(self.rect, "size"), pos=Setter(self.rect, "pos"))
+        if list_widget:
+            self._setup(list_widget)
+            self._load(drinker)
+
+    def _setup(self, list_widget):
+        """
+        Creates the buy item buttons, if not done yet, or if the buy items config changed.
+
+        :param DrinkersListWidget|DrinkersRecycleView list_widget:
+        """
+        self.list_widget = list_widget
+        self.db = list_widget.db
+        column_widths = ColumnWidths.get(self.db)
+        if column_widths.key == self._column_widths_key:
+            return
+        self._column_widths_key = column_widths.key
+        self._highlights_state = None
+        for button in self.drink_buttons.values():
+            self.remove_widget(button)
+        self.drink_buttons.clear()
+        self.credit_balance_label.width = column_widths.credit_balance
         for drink in self.db.get_buy_items():
-            txt = "%s (%s %s): %s" % (drink.shown_name, drink.price, self.db.currency, "XXX")
-            button = Button(text=txt, font_size="12sp")
-            button.texture_update()  # to know the size of the text (texture_size)
             # Use width=..., size_hint_x=None for fixed width.
-            button.size_hint_x = None
-            button.width = button.texture_size[0] + 2  # text size + padding
+            button = Button(font_size="12sp", size_hint_x=None, width=column_widths.buy_items[drink.intern_name])
             button.bind(on_release=lambda btn, _drink=drink: self._on_drink_button_click(_drink, btn))
             self.add_widget(button)
             self.drink_buttons[drink.intern_name] = button
-        self.bind(size=Setter(self.rect, "size"), pos=Setter(self.rect, "pos"))
-        self._load(drinker)
+
+    def refresh_view_attrs(self, rv, index, data):
+        """
+        Called by the RecycleView when this row gets (re)used for some drinker.
+
+        :param DrinkersRecycleView rv:
+        :param int index:
+        :param dict[str] data: see :func:`DrinkersRecycleView.update_all`
+        """
+        self._setup(rv)
+        self._load(data["drinker"])
 
     def _on_drink_button_click(self, drink: BuyItem, button: Button):
-        print("GUI: %s asks to drink %s." % (self.name, drink.intern_name))
+        # Keep the drinker. When this is a RecycleView row, it might be reused for another drinker in the meantime.
+        drinker = self.drinker
+        list_widget = self.list_widget
+        print("GUI: %s asks to drink %s." % (drinker.name, drink.intern_name))
         popup = Popup(
-            title="Confirm: %s: Buy %s?" % (self.name, drink.shown_name),
+            title="Confirm: %s: Buy %s?" % (drinker.name, drink.shown_name),
             content=Button(
                 text="[size=35]%s\n(%s)[/size]\n\nwants to drink [b]%s[/b] for %s %s."
-                % (self.drinker.shown_name, self.name, drink.shown_name, drink.price, self.db.currency),
+                % (drinker.shown_name, drinker.name, drink.shown_name, drink.price, self.db.currency),
                 markup=True,
                 halign="center",
             ),
@@ -164,53 +835,137 @@ class DrinkerWidget(BoxLayout):
             # and this gets executed multiple times.
             if not Handlers.confirmed:
                 Handlers.confirmed = True
-                updated_drinker = self.db.drinker_buy_item(drinker_name=self.name, item_name=drink.intern_name)
-                self._load(updated_drinker)
-
-                button.background_color = (0, 1, 0, 1)
-                anim = getattr(button, "_drink_kiosk_drink_click_fadeout_anim", None)
-                if anim is None:
-                    anim = Animation(
-                        background_color=(1, 1, 1, 1),  # default background color
-                        duration=60 * 5,  # seconds
-                        step=10,  # seconds?
-                    )
-                    button._drink_kiosk_drink_click_fadeout_anim = anim
-                anim.start(button)
+                highlight = (time.monotonic(), self.HighlightColorBought)
+                list_widget.highlights[(drinker.name, drink.intern_name)] = highlight
+                self._buy_item_async(drinker, drink)
 
             popup.dismiss()
 
         def on_dismissed(*_args):
             if not Handlers.confirmed:
-                print("GUI: cancelled: %s asks to drink %s." % (self.name, drink.intern_name))
+                print("GUI: cancelled: %s asks to drink %s." % (drinker.name, drink.intern_name))
 
         popup.content.bind(on_press=on_confirmed)
         popup.bind(on_dismiss=on_dismissed)
         popup.open()
 
+    def _buy_item_async(self, drinker: Drinker, drink: BuyItem):
+        """
+        Shows the purchase right away, and persists it in the background.
+        If that fails, the purchase is rolled back in the GUI, and an error is shown.
+        """
+        list_widget = self.list_widget
+
+        def on_done(updated_drinker: Optional[Drinker], exc: Optional[Exception]):
+            if exc is not None:
+                # This replaces the highlight (and its fade-out) of the purchase.
+                highlight = (time.monotonic(), self.HighlightColorFailed)
+                list_widget.highlights[(drinker.name, drink.intern_name)] = highlight
+                list_widget.update_drinker(drinker.name)
+                Popup(
+                    title="Error",
+                    content=Label(
+                        text="%s: buying %s failed, it was not booked.\n\n%s: %s"
+                        % (drinker.shown_name, drink.shown_name, type(exc).__name__, exc),
+                        halign="center",
+                    ),
+                    size_hint=(0.7, 0.3),
+                ).open()
+            else:
+                list_widget.set_drinker(updated_drinker)
+
+        list_widget.purchase_worker.buy_item(drinker=drinker, item_name=drink.intern_name, callback=on_done)
+        list_widget.set_drinker(drinker)
+
     def _load(self, drinker: Optional[Drinker] = None):
         assert threading.current_thread() is threading.main_thread()
+        purchase_worker = self.list_widget.purchase_worker
         if not drinker:
-            drinker = self.db.get_drinker(self.name)
+            drinker = purchase_worker.get_drinker(self.name)
         self.drinker = drinker
+        self.name = drinker.name
         self.shown_name = drinker.shown_name
         self.name_label.text = self.shown_name
-        self.credit_balance_label.text = "%s %s" % (drinker.credit_balance, self.db.currency)
         drinks = self.db.get_buy_items_by_intern_name()
+        pending = purchase_worker.get_pending_items(drinker)
+        credit_balance = drinker.credit_balance
+        for intern_drink_name, count in pending.items():
+            credit_balance -= drinks[intern_drink_name].price * count
+        self.credit_balance_label.text = "%s %s" % (credit_balance, self.db.currency)
         for intern_drink_name, button in self.drink_buttons.items():
             drink = drinks[intern_drink_name]
-            count = drinker.buy_item_counts.get(intern_drink_name, 0)
+            count = drinker.buy_item_counts.get(intern_drink_name, 0) + pending.get(intern_drink_name, 0)
             button.text = "%s (%s %s): %i" % (drink.shown_name, drink.price, self.db.currency, count)
+        highlights_state = (drinker.name,) + tuple(
+            [self.list_widget.highlights.get((drinker.name, intern_drink_name)) for intern_drink_name in drinks]
+        )
+        if highlights_state != self._highlights_state:
+            self._highlights_state = highlights_state
+            self._load_highlights()
 
-    @run_in_mainthread_blocking()
+    def _load_highlights(self):
+        """
+        Buttons of recently bought items are highlighted in green (or red, if persisting failed),
+        which fades out over time.
+        The highlights are kept by the list widget, as this widget might be reused for another drinker.
+        The fading is done by :data:`highlight_decay_timer`, for all widgets together.
+
+        :return: whether some button is still highlighted
+        :rtype: bool
+        """
+        highlights = self.list_widget.highlights
+        now = time.monotonic()
+        any_highlighted = False
+        for intern_drink_name, button in self.drink_buttons.items():
+            start_time, highlight_color = highlights.get((self.name, intern_drink_name), (None, None))
+            f = 1.0 - (now - start_time) / self.HighlightDuration if start_time else 0.0
+            if f > 0:
+                any_highlighted = True
+            else:
+                f = 0.0
+                if start_time:
+                    highlights.pop((self.name, intern_drink_name), None)
+            # Fade to white (the default background color).
+            color = tuple([1.0 - f * (1.0 - c) for c in highlight_color or (1.0, 1.0, 1.0)]) + (1.0,)
+            if tuple(button.background_color) != color:
+                button.background_color = color
+        if any_highlighted:
+            highlight_decay_timer.add(self)
+        return any_highlighted
+
+    @run_in_mainthread()
     def update(self):
         self._load()
 
 
+def find_first_drinker_by_letter(names, sort_keys, letter):
+    """
+    :param list[str] names: drinker names, in the order as shown
+    :param dict[str,list[str]] sort_keys: drinker name -> :func:`get_drinker_sort_key`
+    :param str letter: e.g. "M"
+    :return: first drinker whose sort key (last name) starts with the letter, or the last one before
+    :rtype: str|None
+    """
+    letter = letter.casefold()
+    last_before = None
+    for name in names:
+        words = normalize_words(" ".join(sort_keys[name]))
+        if words and words[0][:1] >= letter:
+            return name
+        last_before = name
+    return last_before
+
+
 class DrinkersListWidget(ScrollView):
-    def __init__(self, db, **kwargs):
+    """
+    Shows all drinkers, with one :class:`DrinkerWidget` per drinker.
+    See :class:`DrinkersRecycleView` for a variant which only creates the visible rows.
+    """
+
+    def __init__(self, db, purchase_worker, **kwargs):
         """
         :param Db db:
+        :param PurchaseWorker purchase_worker:
         """
         # https://kivy.org/doc/stable/api-kivy.uix.scrollview.html
         # Window resize recursion error while using ScrollView? https://github.com/kivy/kivy/issues/5638
@@ -218,70 +973,461 @@ class DrinkersListWidget(ScrollView):
         # self.parent.bind(size=self.setter("size")), once the parent assigned?
         super(DrinkersListWidget, self).__init__(**kwargs)
         self.db = db
+        self.purchase_worker = purchase_worker
+        # (drinker, drink) -> start time, RGB color
+        self.highlights = {}  # type: typing.Dict[typing.Tuple[str,str],typing.Tuple[float,typing.Tuple[float,...]]]
+        self.quick_picks = None  # type: Optional[QuickPicksWidget]
+        self.search_index = PrefixIndex()
+        self._filter = None  # type: Optional[typing.Set[str]]  # drinker names matching the search, None for all
+        self._widgets_by_name = {}  # type: typing.Dict[str,DrinkerWidget]
+        self._sort_keys = {}  # type: typing.Dict[str,typing.List[str]]  # drinker name -> get_drinker_sort_key
+        self._order = []  # type: typing.List[str]  # all drinker names, sorted
+        self._column_widths_key = None  # type: Optional[tuple]
         self.layout = GridLayout(cols=1, spacing=2, size_hint_y=None)
         # Make sure the height is such that there is something to scroll.
         self.layout.bind(minimum_height=self.layout.setter("height"))
         self.add_widget(self.layout)
         self.update_all()
 
-    @run_in_mainthread_blocking()
+    @run_in_mainthread()
     def update_all(self):
-        self.layout.clear_widgets()
-        drinkers = []
-        for drinker_name in self.db.get_drinker_names():
-            drinkers.append(self.db.get_drinker(drinker_name))
-        drinkers.sort(key=lambda drinker_: drinker_.shown_name.split()[::-1])
-        for drinker in drinkers:
-            self.layout.add_widget(DrinkerWidget(db=self.db, drinker=drinker, size_hint_y=None, height=30))
-
-    @run_in_mainthread_blocking()
+        """
+        Reloads all drinkers from the DB, and only touches the widgets of drinkers which were added, removed or changed.
+        """
+        column_widths_key = ColumnWidths.get_key(self.db)
+        shown_drinkers = {name: widget.drinker for (name, widget) in self._widgets_by_name.items()}
+        added, removed, changed, order = diff_drinkers(
+            self.db,
+            shown_drinkers,
+            self._sort_keys,
+            force_changed=column_widths_key != self._column_widths_key,
+            get_drinker=self.purchase_worker.get_drinker,
+        )
+        self._column_widths_key = column_widths_key
+        for name in removed:
+            self.layout.remove_widget(self._widgets_by_name.pop(name))
+            self.search_index.remove(name)
+        for drinker in changed:
+            widget = self._widgets_by_name[drinker.name]
+            widget._setup(self)
+            widget._load(drinker)
+        for drinker in added:
+            self._widgets_by_name[drinker.name] = DrinkerWidget(
+                list_widget=self, drinker=drinker, size_hint_y=None, height=30
+            )
+        for drinker in added + changed:
+            self.search_index.set(drinker.name, [drinker.name, drinker.shown_name])
+        self._order = order
+        self._update_layout(added_names={drinker.name for drinker in added})
+
+    def get_shown_names(self):
+        """
+        :return: drinker names matching the search, in the order as shown
+        :rtype: list[str]
+        """
+        if self._filter is None:
+            return self._order
+        return [name for name in self._order if name in self._filter]
+
+    def _update_layout(self, added_names=()):
+        """
+        :param set[str]|tuple[str] added_names: widgets which were just created
+        """
+        names = self.get_shown_names()
+        # The GridLayout shows the children in reversed order.
+        cur_names = [widget.name for widget in reversed(self.layout.children)]
+        if cur_names == names:
+            return
+        if cur_names == [name for name in names if name not in added_names]:
+            # Only insert the new widgets.
+            for pos, name in enumerate(names):
+                if name in added_names:
+                    self.layout.add_widget(self._widgets_by_name[name], index=len(self.layout.children) - pos)
+        else:
+            # Some sort key or the search changed. Reorder, but keep all the widgets.
+            self.layout.clear_widgets()
+            for name in names:
+                self.layout.add_widget(self._widgets_by_name[name])
+
+    def set_search(self, query):
+        """
+        Only shows the drinkers matching the query. See :func:`PrefixIndex.search`.
+
+        :param str query: empty to show all
+        """
+        self._filter = self.search_index.search(query)
+        self._update_layout()
+        self.scroll_y = 1
+
+    def jump_to_letter(self, letter):
+        """
+        :param str letter: scrolls to the first drinker with this letter in the last name
+        """
+        name = find_first_drinker_by_letter(self.get_shown_names(), self._sort_keys, letter)
+        if name:
+            self.scroll_to(self._widgets_by_name[name], padding=0, animate=False)
+
+    def _get_drinker_widget(self, drinker_name):
+
+        """
+        :param str drinker_name:
+        :rtype: DrinkerWidget|None
+        """
+        # None could happen e.g. for drinker in DB but not in GUI.
+        return self._widgets_by_name.get(drinker_name)
+
+    @run_in_mainthread()
     def update_drinker(self, drinker_name):
         """
         :param str drinker_name:
         """
-        for widget in self.layout.children:
-            assert isinstance(widget, DrinkerWidget)
-            if widget.name == drinker_name:
-                widget.update()
-                return
-        # No exception here. This could happen e.g. for drinker in DB but not in GUI.
+        if drinker_name not in self._widgets_by_name:
+            return  # This could happen e.g. for drinker in DB but not in GUI.
+        self.set_drinker(self.purchase_worker.get_drinker(drinker_name))
+
+    def set_drinker(self, drinker):
+        """
+        Shows the given state of the drinker. Only in the main thread.
+
+        :param Drinker drinker:
+        """
+        widget = self._get_drinker_widget(drinker.name)
+        if widget:
+            widget._load(drinker)
+        if self.quick_picks:
+            self.quick_picks.set_drinker_row(drinker)
+
+
+class DrinkersRecycleView(RecycleView):
+    """
+    Shows all drinkers, like :class:`DrinkersListWidget`,
+    but it only creates the :class:`DrinkerWidget` rows which are currently visible,
+    and reuses them while scrolling.
+    The shown drinkers are kept in :attr:`data`, as dicts with the key "drinker".
+    """
+
+    RowHeight = 30
+    RowSpacing = 2
+
+    def __init__(self, db, purchase_worker, **kwargs):
+        """
+        :param Db db:
+        :param PurchaseWorker purchase_worker:
+        """
+        super(DrinkersRecycleView, self).__init__(**kwargs)
+        self.db = db
+        self.purchase_worker = purchase_worker
+        # (drinker, drink) -> start time, RGB color
+        self.highlights = {}  # type: typing.Dict[typing.Tuple[str,str],typing.Tuple[float,typing.Tuple[float,...]]]
+        self.quick_picks = None  # type: Optional[QuickPicksWidget]
+        self.search_index = PrefixIndex()
+        self._filter = None  # type: Optional[typing.Set[str]]  # drinker names matching the search, None for all
+        self._drinkers = {}  # type: typing.Dict[str,Drinker]  # all drinkers, also the ones not matching the search
+        self._index_by_name = {}  # type: typing.Dict[str,int]  # drinker name -> index in data
+        self._sort_keys = {}  # type: typing.Dict[str,typing.List[str]]  # drinker name -> get_drinker_sort_key
+        self._order = []  # type: typing.List[str]  # all drinker names, sorted
+        self._column_widths_key = None  # type: Optional[tuple]
+        self.viewclass = DrinkerWidget
+        self.layout = RecycleBoxLayout(
+            orientation="vertical",
+            spacing=self.RowSpacing,
+            default_size=(None, self.RowHeight),
+            default_size_hint=(1, None),
+            size_hint_y=None,
+        )
+        # Make sure the height is such that there is something to scroll.
+        self.layout.bind(minimum_height=self.layout.setter("height"))
+        self.add_widget(self.layout)
+        self.update_all()
+
+    @run_in_mainthread()
+    def update_all(self):
+        """
+        Reloads all drinkers from the DB.
+        When the shown drinkers and their order stay the same, only the rows of changed drinkers are updated.
+        """
+        added, removed, changed, order = diff_drinkers(
+            self.db, self._drinkers, self._sort_keys, get_drinker=self.purchase_worker.get_drinker
+        )
+        for name in removed:
+            del self._drinkers[name]
+            self.search_index.remove(name)
+        for drinker in added + changed:
+            self._drinkers[drinker.name] = drinker
+            self.search_index.set(drinker.name, [drinker.name, drinker.shown_name])
+        self._order = order
+        column_widths_key = ColumnWidths.get_key(self.db)
+        force = column_widths_key != self._column_widths_key
+        self._column_widths_key = column_widths_key
+        self._update_data(changed=changed, force=force)
+
+    def get_shown_names(self):
+        """
+        :return: drinker names matching the search, in the order as shown
+        :rtype: list[str]
+        """
+        if self._filter is None:
+            return self._order
+        return [name for name in self._order if name in self._filter]
+
+    def _update_data(self, changed=(), force=False):
+        """
+        :param list[Drinker]|tuple[Drinker] changed: when the shown drinkers stay the same, only these rows are updated
+        :param bool force: always replace the data, such that all rows are refreshed
+        """
+        names = self.get_shown_names()
+        if (
+            not force
+            and len(names) == len(self.data)
+            and all([self._index_by_name.get(name) == i for (i, name) in enumerate(names)])
+        ):
+            for drinker in changed:
+                self._set_row(drinker)
+            return
+        self._index_by_name = {name: i for (i, name) in enumerate(names)}
+        self.data = [{"drinker": self._drinkers[name]} for name in names]
+
+    def set_search(self, query):
+        """
+        Only shows the drinkers matching the query. See :func:`PrefixIndex.search`.
+
+        :param str query: empty to show all
+        """
+        self._filter = self.search_index.search(query)
+        self._update_data()
+        self.scroll_y = 1
+
+    def jump_to_letter(self, letter):
+        """
+        :param str letter: scrolls to the first drinker with this letter in the last name
+        """
+        name = find_first_drinker_by_letter(self.get_shown_names(), self._sort_keys, letter)
+        if not name:
+            return
+        # All rows have the same height, so we can calculate the position without the row widgets.
+        scrollable_height = self.layout.height - self.height
+        if scrollable_height > 0:
+            pos = self._index_by_name[name] * (self.RowHeight + self.RowSpacing)
+            self.scroll_y = max(0.0, min(1.0, 1.0 - pos / scrollable_height))
+
+    @run_in_mainthread()
+    def update_drinker(self, drinker_name):
+        """
+        :param str drinker_name:
+        """
+        if drinker_name not in self._drinkers:
+            return  # This could happen e.g. for drinker in DB but not in GUI.
+        self.set_drinker(self.purchase_worker.get_drinker(drinker_name))
+
+    def set_drinker(self, drinker):
+        """
+        Shows the given state of the drinker. Only in the main thread.
+
+        :param Drinker drinker:
+        """
+        if drinker.name not in self._drinkers:
+            return
+        self._drinkers[drinker.name] = drinker
+        self._set_row(drinker)
+        if self.quick_picks:
+            self.quick_picks.set_drinker_row(drinker)
+
+    def _set_row(self, drinker):
+        """
+        :param Drinker drinker:
+        """
+        index = self._index_by_name.get(drinker.name)
+        if index is None:
+            return  # not shown
+        # Modify the dict in place, such that the RecycleView does not refresh all rows.
+        self.data[index]["drinker"] = drinker
+        view = self.view_adapter.get_visible_view(index)
+        if view is not None:
+            assert isinstance(view, DrinkerWidget)
+            view._load(drinker)
+
+
+class QuickPicksWidget(GridLayout):
+    """
+    Rows of the regular drinkers (see :class:`db.QuickPicks`), shown above the full list,
+    such that they can buy without scrolling.
+    The rows are :class:`DrinkerWidget` instances, like in the full list.
+    """
+
+    RefreshInterval = 60  # secs. the order should not change while someone is about to tap
+
+    def __init__(self, drinkers_list, num_drinkers, **kwargs):
+        """
+        :param DrinkersListWidget|DrinkersRecycleView drinkers_list:
+        :param int num_drinkers:
+        """
+        super(QuickPicksWidget, self).__init__(cols=1, spacing=2, size_hint_y=None, **kwargs)
+        self.drinkers_list = drinkers_list
+        self.db = drinkers_list.db
+        self.purchase_worker = drinkers_list.purchase_worker
+        self.highlights = drinkers_list.highlights  # shared, such that both rows of a drinker look the same
+        self.num_drinkers = num_drinkers
+        self._widgets_by_name = {}  # type: typing.Dict[str,DrinkerWidget]
+        self.bind(minimum_height=self.setter("height"))
+        drinkers_list.quick_picks = self
+        self.refresh()
+        Clock.schedule_interval(lambda _dt: self.refresh(), self.RefreshInterval)
+
+    def refresh(self, reload_drinkers=False):
+        """
+        Updates which drinkers are shown. Only in the main thread.
+
+        :param bool reload_drinkers: also reload the drinkers which were shown already
+        """
+        names = self.db.get_quick_picks(self.num_drinkers)
+        widgets = {}
+        for name in names:
+            widget = self._widgets_by_name.get(name)
+            if not widget:
+                drinker = self.purchase_worker.get_drinker(name)
+                widget = DrinkerWidget(list_widget=self, drinker=drinker, size_hint_y=None, height=30)
+            elif reload_drinkers:
+                widget._setup(self)
+                widget._load(self.purchase_worker.get_drinker(name))
+            widgets[name] = widget
+        self._widgets_by_name = widgets
+        # The GridLayout shows the children in reversed order.
+        if names != [widget.name for widget in reversed(self.children)]:
+            self.clear_widgets()
+            for name in names:
+                self.add_widget(widgets[name])
+
+    def update_drinker(self, drinker_name):
+        """
+        :param str drinker_name:
+        """
+        self.drinkers_list.update_drinker(drinker_name)
+
+    def set_drinker(self, drinker):
+        """
+        Shows the given state of the drinker, here and in the full list. Only in the main thread.
+
+        :param Drinker drinker:
+        """
+        self.drinkers_list.set_drinker(drinker)
+
+    def set_drinker_row(self, drinker):
+        """
+        Called by the full list, when the drinker is updated there.
+
+        :param Drinker drinker:
+        """
+        widget = self._widgets_by_name.get(drinker.name)
+        if widget:
+            widget._load(drinker)
+
+
+class DrinkerSearchBar(BoxLayout):
+    """
+    Search field and alphabet jump buttons for the drinkers list.
+    """
+
+    def __init__(self, drinkers_list, **kwargs):
+        """
+        :param DrinkersListWidget|DrinkersRecycleView drinkers_list:
+        """
+        super(DrinkerSearchBar, self).__init__(orientation="horizontal", spacing=2, **kwargs)
+        self.drinkers_list = drinkers_list
+        self.text_input = TextInput(multiline=False, hint_text="Search", size_hint_x=None, width=200)
+        self.text_input.bind(text=lambda _instance, text: self.drinkers_list.set_search(text))
+        self.add_widget(self.text_input)
+        clear_button = Button(text="X", size_hint_x=None, width=40)
+        clear_button.bind(on_release=lambda _btn: setattr(self.text_input, "text", ""))
+        self.add_widget(clear_button)
+        for letter in string.ascii_uppercase:
+            button = Button(text=letter)
+            button.bind(on_release=lambda _btn, _letter=letter: self.drinkers_list.jump_to_letter(_letter))
+            self.add_widget(button)
 
 
 class KioskApp(App):
     """
     Builds the Kivy GUI app.
 
-    Note, when interactively debugging, to get access to DrinkersListWidget:
+    Note, when interactively debugging, to get access to DrinkersListWidget (or DrinkersRecycleView):
 
-        app.root
+        app.drinkers_list
 
-    and to individual DrinkerWidget instances:
+    and to individual DrinkerWidget instances (with DrinkersRecycleView only the visible ones):
 
-        app.root.layout.children
+        app.drinkers_list.layout.children
     """
 
-    def __init__(self, db):
+    def __init__(
+        self,
+        db,
+        virtual_list=False,
+        num_quick_picks=0,
+        idle_timeout=120.0,
+        idle_screen="dim",
+        watchdog_threshold=5.0,
+        watchdog_log_filename=None,
+    ):
         """
         :param Db db:
+        :param bool virtual_list: use :class:`DrinkersRecycleView`, which only creates the visible rows
+        :param int num_quick_picks: show that many regular drinkers at the top. see :class:`QuickPicksWidget`
+        :param float idle_timeout: secs without activity until the idle mode. 0 disables it. see :class:`IdleMode`
+        :param str idle_screen: see :data:`IdleMode.Screens`
+        :param float watchdog_threshold: secs. 0 disables it. see :class:`StallWatchdog`
+        :param str|None watchdog_log_filename:
         """
         self.db = db
+        self.virtual_list = virtual_list
+        self.num_quick_picks = num_quick_picks
+        self.idle_mode = None  # type: Optional[IdleMode]
+        if idle_timeout > 0:
+            self.idle_mode = IdleMode(timeout=idle_timeout, screen=idle_screen, on_idle=self._on_idle)
+        self.watchdog = None  # type: Optional[StallWatchdog]
+        if watchdog_threshold > 0:
+            self.watchdog = StallWatchdog(db=db, threshold=watchdog_threshold, log_filename=watchdog_log_filename)
+        self.purchase_worker = PurchaseWorker(db=db)
+        self.drinkers_list = None  # type: typing.Union[DrinkersListWidget,DrinkersRecycleView,None]
+        self.quick_picks = None  # type: Optional[QuickPicksWidget]
+        self.search_bar = None  # type: Optional[DrinkerSearchBar]
         super(KioskApp, self).__init__()
 
     def build(self):
+        if self.virtual_list:
+            self.drinkers_list = DrinkersRecycleView(db=self.db, purchase_worker=self.purchase_worker)
+        else:
+            self.drinkers_list = DrinkersListWidget(db=self.db, purchase_worker=self.purchase_worker)
         # After this returns, later self.root will ref to this instance.
-        return DrinkersListWidget(db=self.db)
+        root = BoxLayout(orientation="vertical")
+        self.search_bar = DrinkerSearchBar(drinkers_list=self.drinkers_list, size_hint_y=None, height=40)
+        root.add_widget(self.search_bar)
+        if self.num_quick_picks > 0:
+            self.quick_picks = QuickPicksWidget(drinkers_list=self.drinkers_list, num_drinkers=self.num_quick_picks)
+            root.add_widget(self.quick_picks)
+        root.add_widget(self.drinkers_list)
+        return root
 
     def on_start(self):
-        pass
+        if self.idle_mode:
+            self.idle_mode.start()
+        if self.watchdog:
+            self.watchdog.start()
+
+    def _on_idle(self):
+        # Reset the search for the next person. Also, a focused text input would redraw for the blinking cursor.
+        self.search_bar.text_input.focus = False
+        self.search_bar.text_input.text = ""
 
-    @run_in_mainthread_blocking()
+    @run_in_mainthread()
     def reload(self, drinker_name=None):
         """
         :param str|None drinker_name:
         """
-        widget = self.root
-        assert isinstance(widget, DrinkersListWidget)
+        widget = self.drinkers_list
+        assert isinstance(widget, (DrinkersListWidget, DrinkersRecycleView))
         if drinker_name:
             widget.update_drinker(drinker_name=drinker_name)
         else:
             widget.update_all()
+            if self.quick_picks:
+                self.quick_picks.refresh(reload_drinkers=True)
@@ -0,0 +1,152 @@
+"""
+Append-only journal of DB operations (purchases, payments, admin operations).
+
+With the journal, an operation only appends one record (a single line) to the current journal file,
+instead of rewriting the whole drinker file (and the whole admin cash position file).
+From time to time, :func:`db.Db.compact_journal` folds the journal into the snapshot files
+(i.e. the usual drinker state files and the admin cash position file),
+and at startup, any remaining journal is replayed.
+
+Compaction uses a manifest as a redo log, such that it is safe to crash at any point:
+
+1. The new snapshot files are written to temporary files.
+2. The manifest is written (atomically), listing the temporary files and the journal files which are folded.
+3. The temporary files are renamed to the snapshot files.
+4. The folded journal files are removed.
+5. The manifest is removed.
+
+When a manifest exists at startup, steps 3-5 are redone.
+Otherwise, the remaining temporary files are garbage, and the journal files get replayed.
+"""
+
+import os
+import json
+import time
+from utils import make_git_ignored_dir
+
+
+class Journal:
+    FileExt = ".log"
+    TmpExt = ".journal-tmp"  # for the snapshot files during compaction
+    ManifestFilename = "compact-manifest.json"
+
+    def __init__(self, path, fsync=True, read_only=False):
+        """
+        :param str path: directory for the journal files, e.g. "<db>/journal"
+        :param bool fsync: fsync after every record. on NFS, otherwise the record might only be in the local cache
+        :param bool read_only: only for reading (:func:`list_files`, :func:`read_records`, :func:`read_manifest`)
+        """
+        self.path = path
+        self.fsync = fsync
+        self.read_only = read_only
+        if not read_only:
+            # The journal is local state. The DB Git repo only tracks the snapshot files.
+            make_git_ignored_dir(path)
+        self._file = None
+        self._file_day = None
+        self._seq = 0
+        for fn in self.list_files():
+            self._seq = max(self._seq, int(os.path.basename(fn).split(".")[1]) + 1)
+
+    def _new_filename(self, day):
+        """
+        :param str day:
+        :rtype: str
+        """
+        fn = "%s/%s.%06i%s" % (self.path, day, self._seq, self.FileExt)
+        self._seq += 1
+        return fn
+
+    def append(self, record):
+        """
+        :param list[str|int] record: op name and args. the time stamp is added here
+        """
+        assert not self.read_only
+        day = time.strftime("%Y%m%d", time.localtime())
+        if self._file is None or self._file_day != day:
+            self.rotate()
+            self._file = open(self._new_filename(day), "a")
+            self._file_day = day
+        self._file.write(json.dumps([time.strftime("%Y%m%d.%H%M%S", time.localtime())] + list(record)) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """
+        Closes the current journal file. The next record will go into a new file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_day = None
+
+    def list_files(self):
+        """
+        :return: all journal files, in order
+        :rtype: list[str]
+        """
+        return sorted(["%s/%s" % (self.path, fn) for fn in os.listdir(self.path) if fn.endswith(self.FileExt)])
+
+    @staticmethod
+    def read_records(files):
+        """
+        :param list[str] files: via :func:`list_files`
+        :return: all records, in order. each record is [time_stamp, op, args...]
+        :rtype: list[list[str|int]]
+        """
+        records = []
+        for i, fn in enumerate(files):
+            lines = open(fn).read().splitlines()
+            for j, line in enumerate(lines):
+                try:
+                    record = json.loads(line)
+                    assert isinstance(record, list) and len(record) >= 2
+                except (ValueError, AssertionError):
+                    if i == len(files) - 1 and j == len(lines) - 1:
+                        # Last record was not completely written. The operation did not return, so just skip it.
+                        print("Journal: skip incomplete last record in %s: %r" % (fn, line))
+                        continue
+                    raise Exception("Journal: invalid record in %s, line %i: %r" % (fn, j + 1, line))
+                records.append(record)
+        return records
+
+    def write_manifest(self, renames, files):
+        """
+        :param list[(str,str)] renames: (tmp filename, snapshot filename), as storage keys
+        :param list[str] files: journal files which are folded into the snapshots
+        """
+        fn = "%s/%s" % (self.path, self.ManifestFilename)
+        with open(fn + ".tmp", "w") as f:
+            json.dump({"renames": renames, "files": files}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(fn + ".tmp", fn)
+
+    def read_manifest(self):
+        """
+        :return: manifest, like written by :func:`write_manifest`, or None
+        :rtype: dict[str,list]|None
+        """
+        fn = "%s/%s" % (self.path, self.ManifestFilename)
+        if not os.path.exists(fn):
+            return None
+        return json.load(open(fn))
+
+    def finish_compaction(self, manifest, storage):
+        """
+        Steps 3-5 of the compaction, see module docstring. This is idempotent.
+
+        :param dict[str,list] manifest:
+        :param storage.Storage storage: where the snapshot files are
+        """
+        for tmp_fn, fn in manifest["renames"]:
+            if storage.exists(tmp_fn):
+                storage.rename(tmp_fn, fn)
+        for fn in manifest["files"]:
+            if os.path.exists(fn):
+                os.remove(fn)
+        os.remove("%s/%s" % (self.path, self.ManifestFilename))
+
+    def close(self):
+        self.rotate()
@@ -4,7 +4,8 @@ import better_exchook
 import argparse
 import sys
 from db import Db
-from utils import init_ipython_kernel, enable_debug_threads
+from admin_rpc import AdminRpc, AdminRpcServer, get_default_socket_path
+from utils import init_ipython_kernel, enable_debug_threads, StartupPipeline
 from typing import TYPE_CHECKING, Optional
 if TYPE_CHECKING:
     import gui
@@ -35,44 +36,92 @@ def main():
     arg_parser.add_argument("--update-drinkers-list", action="store_true")
     arg_parser.add_argument("--debug", action="store_true")
     arg_parser.add_argument("--readonly", action="store_true", help="do not write to DB")
+    arg_parser.add_argument("--journal", action="store_true", help="write purchases to an append-only journal")
+    arg_parser.add_argument("--virtual-list", action="store_true", help="only create the visible rows in the GUI")
+    arg_parser.add_argument("--quick-picks", type=int, default=0, help="show N regular drinkers at the top")
+    arg_parser.add_argument("--idle-timeout", type=float, default=120, help="secs until idle mode. 0 disables it")
+    arg_parser.add_argument("--idle-screen", default="dim", choices=["none", "dim", "blank"], help="in idle mode")
+    arg_parser.add_argument("--watchdog-threshold", type=float, default=5, help="secs of GUI stall until stack dump")
+    arg_parser.add_argument("--watchdog-log", help="stall reports are appended here. default: <db>/local/stalls.log")
+    arg_parser.add_argument(
+        "--admin-socket", help="Unix socket for admin RPC. default: <db>/local/admin-rpc.sock. '' disables"
+    )
     arg_parser.add_argument('kivy_args', nargs='*', help="use -- to separate the Kivy args")
     args = arg_parser.parse_args()
 
     if args.debug:
         enable_debug_threads()
 
-    db = Db(path=args.db)
+    startup = StartupPipeline()
 
-    if args.readonly:
-        db.read_only = True
+    def _init_db():
+        db_ = Db(path=args.db, use_journal=args.journal and not args.readonly, read_only=args.readonly)
+        # Also with --readonly, for the admin socket and the stall log.
+        db_.make_local_dir()
+        return db_
 
     if args.update_drinkers_list:
+        db = startup.run("db_init", _init_db)
         print("Update drinkers list.")
         db.update_drinkers_list(verbose=True)
         print("Quit.")
         return
 
-    # Always update.
-    db.update_drinkers_list()
+    # These run in the background, while the main thread imports Kivy and creates the window.
+    db_future = startup.run_async("db_init", _init_db)
+    preload_future = startup.run_async("preload_drinkers", lambda db_: db_.preload_drinkers(), depends=[db_future])
+    # Always update the drinkers list. Until it is done, the GUI shows the list from the last run.
+    # When it changes, the DB publishes a reload event, and the GUI updates incrementally.
+    startup.run_async("ldap_update", lambda db_: db_.update_drinkers_list(), depends=[db_future])
+    startup.run_async("ipython_import", lambda: __import__("background_zmq_ipython"))
 
     # Kivy always parses sys.argv.
     sys.argv = sys.argv[:1] + args.kivy_args
-    # Do not globally import, as it has side effects.
-    import kivy
-    kivy.require("1.10.0")
-    from gui import KioskApp, kill_at_night
-    kill_at_night()  # maybe make configurable...
-    app = KioskApp(db=db)
-    db.update_drinker_callbacks.append(app.reload)
-    init_ipython_kernel(
-        user_ns={"db": db, "app": app, "reload": reload, "exit_": exit_async},
-        config_path="%s/config" % db.path,
-        debug_connection_filename=args.debug)
+
+    def _init_kivy():
+        # Do not globally import, as it has side effects.
+        import kivy
+        kivy.require("1.10.0")
+        from kivy.core.window import Window  # noqa: F401  # creates the window
+        import gui
+        return gui
+
+    gui = startup.run("kivy_import", _init_kivy)
+    gui.kill_at_night()  # maybe make configurable...
+    db = db_future.result()
+    startup.run("wait_preload", preload_future.result)
+    app = gui.KioskApp(
+        db=db,
+        virtual_list=args.virtual_list,
+        num_quick_picks=args.quick_picks,
+        idle_timeout=args.idle_timeout,
+        idle_screen=args.idle_screen,
+        watchdog_threshold=args.watchdog_threshold,
+        watchdog_log_filename=args.watchdog_log or "%s/stalls.log" % db.local_path,
+    )
+    db.events.subscribe(app.reload, name="gui")
+    rpc = AdminRpc(db, extra_methods={"reload": reload, "exit": exit_async})
+    admin_rpc_server = None
+    admin_socket = get_default_socket_path(db.path) if args.admin_socket is None else args.admin_socket
+    if admin_socket:
+        admin_rpc_server = startup.run("admin_rpc_init", AdminRpcServer, rpc, admin_socket)
+    startup.run(
+        "ipython_init",
+        lambda: init_ipython_kernel(
+            user_ns={"db": db, "app": app, "reload": reload, "exit_": exit_async, "startup": startup, "rpc": rpc},
+            config_path="%s/config" % db.path,
+            debug_connection_filename=args.debug,
+        ),
+    )
+    app.bind(on_start=lambda *_args: gui.Clock.schedule_once(lambda _dt: startup.mark("first_frame"), 0))
     try:
         app.run()
     except KeyboardInterrupt:
         print("KeyboardInterrupt")
     finally:
+        if admin_rpc_server:
+            admin_rpc_server.close()
+        app.purchase_worker.close(timeout=10)
         db.at_exit()
     print("Kiosk quit.")
 
@@ -0,0 +1,188 @@
+"""
+Delayed background tasks of the DB (Git commit, journal compaction), all run by a single thread.
+"""
+
+import sys
+import time
+import heapq
+from threading import Thread, Condition
+import better_exchook
+
+
+class _Entry:
+    def __init__(self, key, func, due_time, seq):
+        """
+        :param str key:
+        :param ()->None func:
+        :param float due_time: time.monotonic() based
+        :param int seq: to find outdated heap items
+        """
+        self.key = key
+        self.func = func
+        self.due_time = due_time
+        self.seq = seq
+        self.creation_time = time.monotonic()
+
+    def __repr__(self):
+        return "<Task %r, due in %.1f sec, delayed %.1f sec>" % (
+            self.key,
+            self.due_time - time.monotonic(),
+            time.monotonic() - self.creation_time,
+        )
+
+
+class Scheduler:
+    """
+    There is at most one pending task per key (task kind).
+    Adding a task for a key which is already pending does not add a new task,
+    but it can move the pending task forward (e.g. wait_time=0 means run now).
+
+    The heap can contain outdated items (from a moved or cancelled task). They are skipped.
+    """
+
+    def __init__(self, name="Scheduler"):
+        """
+        :param str name: thread name
+        """
+        self.name = name
+        self.condition = Condition()
+        self._heap = []  # type: list  # (due time, seq, key)
+        self._entries = {}  # type: dict  # key -> _Entry
+        self._seq = 0
+        self._running = None  # type: _Entry|None
+        self._thread = None  # type: Thread|None
+        self._shutdown = False
+        self.num_tasks_run = 0
+
+    def add(self, key, func, wait_time=0.0):
+        """
+        :param str key: task kind. see class docstring
+        :param ()->None func: called in the scheduler thread
+        :param float wait_time: in secs
+        :return: whether a new task was added (otherwise it was merged into the pending one)
+        :rtype: bool
+        """
+        with self.condition:
+            # Check and insert under the same lock, such that a concurrent shutdown cannot miss this task.
+            if not self._shutdown:
+                due_time = time.monotonic() + wait_time
+                entry = self._entries.get(key)
+                if entry:
+                    if due_time < entry.due_time:
+                        print("%s: run task %r earlier, requested wait time %.1f sec." % (self.name, key, wait_time))
+                        self._push(entry, due_time)
+                    return False
+                self._seq += 1
+                entry = _Entry(key=key, func=func, due_time=due_time, seq=self._seq)
+                self._entries[key] = entry
+                heapq.heappush(self._heap, (due_time, entry.seq, key))
+                if not self._thread:
+                    self._thread = Thread(target=self._thread_main, name=self.name, daemon=True)
+                    self._thread.start()
+                self.condition.notify_all()
+                return True
+        # Not under the lock, the task might take a while, or add other tasks.
+        print("%s: task %r added after shutdown, run it directly." % (self.name, key))
+        func()
+        return True
+
+    def _push(self, entry, due_time):
+        """
+        :param _Entry entry:
+        :param float due_time:
+        """
+        self._seq += 1
+        entry.seq = self._seq
+        entry.due_time = due_time
+        heapq.heappush(self._heap, (due_time, entry.seq, entry.key))
+        self.condition.notify_all()
+
+    def run_now(self, key):
+        """
+        :param str key:
+        :return: whether there was such a pending task
+        :rtype: bool
+        """
+        with self.condition:
+            entry = self._entries.get(key)
+            if not entry:
+                return False
+            self._push(entry, time.monotonic())
+            return True
+
+    def cancel(self, key):
+        """
+        :param str key:
+        :return: whether there was such a pending task. a task which is running right now is not affected
+        :rtype: bool
+        """
+        with self.condition:
+            return self._entries.pop(key, None) is not None
+
+    def pending(self):
+        """
+        :return: pending tasks, sorted by due time. the running task (if any) is not included
+        :rtype: list[_Entry]
+        """
+        with self.condition:
+            return sorted(self._entries.values(), key=lambda entry: entry.due_time)
+
+    def _pop_due(self):
+        """
+        :return: the next due entry. waits until there is one. None after shutdown
+        :rtype: _Entry|None
+        """
+        with self.condition:
+            while True:
+                # Skip outdated heap items.
+                while self._heap:
+                    due_time, seq, key = self._heap[0]
+                    entry = self._entries.get(key)
+                    if entry and entry.seq == seq:
+                        break
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    if self._shutdown:
+                        return None
+                    self.condition.wait()
+                    continue
+                due_time, _, key = self._heap[0]
+                wait_time = due_time - time.monotonic()
+                if wait_time > 0 and not self._shutdown:
+                    self.condition.wait(wait_time)
+                    continue
+                heapq.heappop(self._heap)
+                entry = self._entries.pop(key)
+                self._running = entry
+                return entry
+
+    def _thread_main(self):
+        while True:
+            entry = self._pop_due()
+            if not entry:
+                return
+            # noinspection PyBroadException
+            try:
+                entry.func()
+            except Exception:
+                better_exchook.better_exchook(*sys.exc_info())
+            with self.condition:
+                self._running = None
+                self.num_tasks_run += 1
+                self.condition.notify_all()
+
+    def shutdown(self):
+        """
+        Runs all pending tasks right now, and stops the thread afterwards.
+        """
+        with self.condition:
+            self._shutdown = True
+            for entry in self.pending():
+                print("%s: shutdown, run task now: %r" % (self.name, entry))
+            self.condition.notify_all()
+            thread = self._thread
+        if thread:
+            thread.join()
+
+    def __repr__(self):
+        return "<%s, pending: %r, running: %r>" % (self.name, self.pending(), self._running)
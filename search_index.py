@@ -0,0 +1,91 @@
+"""
+Prefix search index, for the drinker search in the GUI.
+
+Every key (drinker name) has some texts (e.g. the name and the shown name).
+These are split into normalized words (lower case, without accents),
+and all (word, key) pairs are kept in a sorted list.
+A prefix lookup is then a binary search, and adding or removing a key only touches its own words.
+"""
+
+import re
+import bisect
+import unicodedata
+
+
+def normalize_words(text):
+    """
+    :param str text: e.g. "Jürgen Müller-Lüdenscheidt"
+    :return: e.g. ["jurgen", "muller", "ludenscheidt"]
+    :rtype: list[str]
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join([c for c in text if not unicodedata.combining(c)])
+    return [word for word in re.split(r"\W+", text.casefold()) if word]
+
+
+class PrefixIndex:
+    def __init__(self):
+        self._entries = []  # type: list  # sorted list of (word, key)
+        self._words_by_key = {}  # type: dict  # key -> set of words
+
+    def set(self, key, texts):
+        """
+        Adds the key, or updates it if it exists already.
+
+        :param str key:
+        :param list[str] texts: the key is found by a prefix of any word of these
+        """
+        words = set()
+        for text in texts:
+            words.update(normalize_words(text))
+        old_words = self._words_by_key.get(key, set())
+        if words == old_words:
+            return
+        for word in old_words - words:
+            self._entries.pop(bisect.bisect_left(self._entries, (word, key)))
+        for word in words - old_words:
+            bisect.insort(self._entries, (word, key))
+        self._words_by_key[key] = words
+
+    def remove(self, key):
+        """
+        :param str key:
+        """
+        for word in self._words_by_key.pop(key, set()):
+            self._entries.pop(bisect.bisect_left(self._entries, (word, key)))
+
+    def _find_prefix(self, prefix):
+        """
+        :param str prefix: normalized word prefix
+        :return: all keys which have a word with this prefix
+        :rtype: set[str]
+        """
+        keys = set()
+        for i in range(bisect.bisect_left(self._entries, (prefix,)), len(self._entries)):
+            word, key = self._entries[i]
+            if not word.startswith(prefix):
+                break
+            keys.add(key)
+        return keys
+
+    def search(self, query):
+        """
+        :param str query: every word of it must be a prefix of some word of the key. e.g. "ma mu" for "Max Müller"
+        :return: matching keys, or None if the query is empty (i.e. no filter)
+        :rtype: set[str]|None
+        """
+        keys = None
+        for prefix in normalize_words(query):
+            if keys is None:
+                keys = self._find_prefix(prefix)
+            else:
+                keys &= self._find_prefix(prefix)
+            if not keys:
+                break
+        return keys
+
+    def __len__(self):
+        return len(self._words_by_key)
+
+    def __repr__(self):
+        return "<%s, %i keys, %i words>" % (self.__class__.__name__, len(self._words_by_key), len(self._entries))
@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+
+"""
+Storage backends for the DB.
+
+All DB files are addressed by keys, which are the paths relative to the DB directory,
+e.g. ``"drinkers/state/<name>.txt"`` or ``"config/buy_items.txt"``.
+The content is always the text as written by :mod:`codec` (or the hand-written config files).
+
+* :class:`FileStorage`: one file per key in the DB directory. This is the original layout.
+* :class:`SqliteStorage`: the DB state (drinkers list, drinker states, admin cash position)
+  is stored in a single SQLite file (``db.sqlite`` in the DB directory).
+  All other keys (e.g. the config files) are still plain files.
+* :class:`GitTreeStorage`: read-only, from some Git revision of the DB directory (for :class:`db.HistoricDb`).
+
+Run this module directly to migrate the DB state from one backend to another.
+"""
+
+import os
+import sqlite3
+import tempfile
+from urllib.parse import quote
+from threading import Lock
+from typing import Optional
+from io import TextIOWrapper, BytesIO
+from utils import is_git_dir
+
+
+class Storage:
+    """
+    Storage backend interface.
+    """
+
+    def check_valid(self):
+        """
+        Raises an exception if the storage is not usable.
+        """
+        raise NotImplementedError
+
+    def read(self, key):
+        """
+        :param str key:
+        :return: content. raises FileNotFoundError if it does not exist
+        :rtype: str
+        """
+        raise NotImplementedError
+
+    def write(self, key, data, sync=False):
+        """
+        :param str key:
+        :param str data:
+        :param bool sync: make sure it is on disk when this returns
+        """
+        raise NotImplementedError
+
+    def exists(self, key):
+        """
+        :param str key:
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def remove(self, key):
+        """
+        :param str key:
+        """
+        raise NotImplementedError
+
+    def rename(self, src_key, dst_key):
+        """
+        Atomically replaces dst_key by src_key.
+
+        :param str src_key:
+        :param str dst_key:
+        """
+        raise NotImplementedError
+
+    def stat_key(self, key):
+        """
+        :param str key:
+        :return: some key which changes whenever the content changes, or None if it does not exist
+        :rtype: object|None
+        """
+        raise NotImplementedError
+
+    def list_dir(self, dir_key):
+        """
+        :param str dir_key: e.g. "drinkers/state"
+        :return: sorted base names of the keys in this dir, e.g. ["foo.txt", ...]
+        :rtype: list[str]
+        """
+        raise NotImplementedError
+
+    def git_commit_paths(self, paths):
+        """
+        :param list[str] paths: paths (dirs or keys) in the DB directory which should be committed
+        :return: paths (relative to the DB directory) which need to be committed for this
+        :rtype: list[str]
+        """
+        return paths
+
+    def read_git_commit_files(self, paths):
+        """
+        :param list[str] paths: via :func:`git_commit_paths`
+        :return: path -> file content, or None if it does not exist. a consistent snapshot for the Git commit
+        :rtype: dict[str,bytes|None]
+        """
+        # All backends which can be committed have the DB directory in self.path.
+        contents = {}
+        for path in paths:
+            fn = "%s/%s" % (self.path, path)
+            if os.path.exists(fn):
+                with open(fn, "rb") as f:
+                    contents[path] = f.read()
+            else:
+                contents[path] = None
+        return contents
+
+    def close(self):
+        pass
+
+
+class FileStorage(Storage):
+    """
+    One file per key.
+    Writes are atomic (via a temporary file), such that a reader never sees a partially written file.
+    """
+
+    TmpExt = ".tmp"
+
+    def __init__(self, path):
+        """
+        :param str path: DB directory
+        """
+        self.path = path
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.path)
+
+    def _filename(self, key):
+        """
+        :param str key:
+        :rtype: str
+        """
+        return "%s/%s" % (self.path, key)
+
+    def check_valid(self):
+        assert os.path.isdir(self.path)
+        assert is_git_dir(self.path), "not a Git dir?"
+
+    def read(self, key):
+        with open(self._filename(key)) as f:
+            return f.read()
+
+    def write(self, key, data, sync=False):
+        fn = self._filename(key)
+        with open(fn + self.TmpExt, "w") as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(fn + self.TmpExt, fn)
+
+    def exists(self, key):
+        return os.path.exists(self._filename(key))
+
+    def remove(self, key):
+        os.remove(self._filename(key))
+
+    def rename(self, src_key, dst_key):
+        os.rename(self._filename(src_key), self._filename(dst_key))
+
+    def stat_key(self, key):
+        try:
+            st = os.stat(self._filename(key))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def list_dir(self, dir_key):
+        dir_fn = self._filename(dir_key)
+        return sorted(fn for fn in os.listdir(dir_fn) if os.path.isfile("%s/%s" % (dir_fn, fn)))
+
+
+class SqliteStorage(Storage):
+    """
+    The DB state is stored in a single SQLite file, in a simple key-value table.
+    Other keys (e.g. config files) are delegated to :class:`FileStorage`.
+
+    We use the SQLite WAL mode, such that a write only appends the changed pages.
+    WAL needs shared memory between all processes accessing the DB, which does not work over NFS.
+    Thus we also use the exclusive locking mode, i.e. only a single process (the kiosk) can access the DB.
+
+    With ``read_only``, no pragma or table creation is run, and the DB file is opened with ``mode=ro``.
+    While the kiosk runs, it holds the exclusive lock, and then this fails.
+    Without a WAL file (i.e. the kiosk quit cleanly), everything is in the DB file,
+    and it is opened as immutable, because a WAL reader would create the ``-wal`` and ``-shm`` files.
+    (Only if the kiosk crashed and left a WAL file, SQLite needs to create the ``-shm`` file next to it.)
+    """
+
+    Filename = "db.sqlite"
+    StateKeyPrefixes = ("drinkers/list.txt", "drinkers/state/", "admin-cash-position.txt")
+
+    def __init__(self, path, read_only=False, filename=None, immutable=False):
+        """
+        :param str path: DB directory
+        :param bool read_only: do not write anything, see class docstring
+        :param str|None filename: SQLite file. by default :data:`Filename` in the DB directory
+        :param bool immutable: the file does not change (e.g. a snapshot from Git). implies read_only
+        """
+        self.path = path
+        self.files = FileStorage(path)
+        self.filename = filename or "%s/%s" % (path, self.Filename)
+        self.read_only = read_only or immutable
+        self.lock = Lock()
+        if self.read_only:
+            if not os.path.exists(self.filename + "-wal"):
+                immutable = True
+            uri = "file:%s?mode=ro%s" % (quote(os.path.abspath(self.filename)), "&immutable=1" if immutable else "")
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None, timeout=1)
+            try:
+                self._version = self.conn.execute("SELECT IFNULL(MAX(version), 0) FROM files").fetchone()[0]
+            except sqlite3.OperationalError as exc:
+                self.conn.close()
+                if "locked" in str(exc):
+                    raise Exception(
+                        "%s is locked, the kiosk holds the DB while it runs."
+                        " Read the last Git commit instead, e.g. remote-admin --db <db> --rev HEAD. (%s)"
+                        % (self.filename, exc)
+                    )
+                raise
+            return
+        # We do our own locking, thus check_same_thread=False is fine.
+        self.conn = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL)"
+        )
+        self._version = self.conn.execute("SELECT IFNULL(MAX(version), 0) FROM files").fetchone()[0]
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.filename)
+
+    @classmethod
+    def exists_in(cls, path):
+        """
+        :param str path: DB directory
+        :return: whether there is a SQLite DB file
+        :rtype: bool
+        """
+        return os.path.exists("%s/%s" % (path, cls.Filename))
+
+    def _is_state_key(self, key):
+        """
+        :param str key:
+        :rtype: bool
+        """
+        return key.startswith(self.StateKeyPrefixes)
+
+    def check_valid(self):
+        self.files.check_valid()
+        assert self.conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+
+    def read(self, key):
+        if not self._is_state_key(key):
+            return self.files.read(key)
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM files WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise FileNotFoundError("%s: %s" % (self.filename, key))
+        return row[0]
+
+    def write(self, key, data, sync=False):
+        if not self._is_state_key(key):
+            return self.files.write(key, data, sync=sync)
+        assert not self.read_only, "%s: read-only, cannot write %r" % (self, key)
+        with self.lock:
+            self._version += 1
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (key, data, self._version))
+
+    def exists(self, key):
+        return self.stat_key(key) is not None
+
+    def remove(self, key):
+        if not self._is_state_key(key):
+            return self.files.remove(key)
+        with self.lock:
+            cur = self.conn.execute("DELETE FROM files WHERE key = ?", (key,))
+        if cur.rowcount == 0:
+            raise FileNotFoundError("%s: %s" % (self.filename, key))
+
+    def rename(self, src_key, dst_key):
+        if not self._is_state_key(src_key):
+            assert not self._is_state_key(dst_key)
+            return self.files.rename(src_key, dst_key)
+        assert self._is_state_key(dst_key)
+        with self.lock:
+            self._version += 1
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM files WHERE key = ?", (dst_key,))
+            cur = self.conn.execute(
+                "UPDATE files SET key = ?, version = ? WHERE key = ?", (dst_key, self._version, src_key)
+            )
+            if cur.rowcount == 0:
+                self.conn.execute("ROLLBACK")
+                raise FileNotFoundError("%s: %s" % (self.filename, src_key))
+            self.conn.execute("COMMIT")
+
+    def stat_key(self, key):
+        if not self._is_state_key(key):
+            return self.files.stat_key(key)
+        with self.lock:
+            row = self.conn.execute("SELECT version FROM files WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def list_dir(self, dir_key):
+        prefix = dir_key + "/"
+        if not self._is_state_key(prefix):
+            return self.files.list_dir(dir_key)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key FROM files WHERE substr(key, 1, ?) = ? ORDER BY key", (len(prefix), prefix)
+            ).fetchall()
+        return [key[len(prefix) :] for (key,) in rows if "/" not in key[len(prefix) :]]
+
+    def list_state_keys(self):
+        """
+        :return: all keys stored in SQLite
+        :rtype: list[str]
+        """
+        with self.lock:
+            return [key for (key,) in self.conn.execute("SELECT key FROM files ORDER BY key")]
+
+    def git_commit_paths(self, paths):
+        assert not self.read_only
+        # Make sure that everything is in the main DB file.
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return [path for path in paths if not self._is_state_key(path)] + [self.Filename]
+
+    def read_git_commit_files(self, paths):
+        # Under the lock, such that the DB file is not changed while we read it.
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            return super(SqliteStorage, self).read_git_commit_files(paths)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class GitTreeStorage(Storage):
+    """
+    Read-only, from some Git revision.
+    If the DB state is in SQLite at this revision (``db.sqlite`` in the tree),
+    the state keys are read from a temporary copy of that file (see :class:`SqliteStorage`).
+    """
+
+    def __init__(self, path, git_revision):
+        """
+        :param str path: DB directory (Git repo)
+        :param str git_revision:
+        """
+        try:
+            # https://gitpython.readthedocs.io/en/stable/tutorial.html
+            import git
+        except ImportError:
+            print("pip3 install --user GitPython")
+            raise
+        self.git_mod = git
+        self.git_repo = git.Repo(path)
+        self.git_commit = self.git_repo.commit(git_revision)
+        assert isinstance(self.git_commit, git.Commit)
+        self.git_tree = self.git_commit.tree
+        assert isinstance(self.git_tree, git.Tree)
+        self.sqlite = None  # type: Optional[SqliteStorage]
+        try:
+            sqlite_blob = self._blob(SqliteStorage.Filename)
+        except FileNotFoundError:
+            pass
+        else:
+            # The committed file is complete (checkpointed, see SqliteStorage.git_commit_paths).
+            fd, tmp_filename = tempfile.mkstemp(suffix=".sqlite", prefix="drink-kiosk-git-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(sqlite_blob.data_stream.read())
+                # This opens the file. Afterwards we do not need the name anymore.
+                self.sqlite = SqliteStorage(path, filename=tmp_filename, immutable=True)
+            finally:
+                os.remove(tmp_filename)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.git_commit.hexsha[:8])
+
+    def _blob(self, key):
+        """
+        :param str key:
+        :rtype: git.Blob
+        """
+        try:
+            blob = self.git_tree.join(key)
+        except KeyError as exc:
+            raise FileNotFoundError(str(exc))
+        assert isinstance(blob, self.git_mod.Blob)
+        return blob
+
+    def _sqlite_for_key(self, key):
+        """
+        :param str key:
+        :return: the SQLite storage, if this key is stored there at this revision
+        :rtype: SqliteStorage|None
+        """
+        if self.sqlite and self.sqlite._is_state_key(key):
+            return self.sqlite
+        return None
+
+    def check_valid(self):
+        self.read("drinkers/list.txt")
+
+    def read(self, key):
+        if self._sqlite_for_key(key):
+            return self.sqlite.read(key)
+        raw_stream = BytesIO(self._blob(key).data_stream.read())
+        return TextIOWrapper(raw_stream).read()
+
+    def write(self, key, data, sync=False):
+        raise Exception("%s: only read support for %r" % (self, key))
+
+    def remove(self, key):
+        raise Exception("%s: only read support for %r" % (self, key))
+
+    def rename(self, src_key, dst_key):
+        raise Exception("%s: only read support for %r" % (self, src_key))
+
+    def exists(self, key):
+        return self.stat_key(key) is not None
+
+    def stat_key(self, key):
+        if self._sqlite_for_key(key):
+            return self.sqlite.stat_key(key)
+        try:
+            return self._blob(key).hexsha
+        except FileNotFoundError:
+            return None
+
+    def list_dir(self, dir_key):
+        if self._sqlite_for_key(dir_key + "/"):
+            return self.sqlite.list_dir(dir_key)
+        try:
+            tree = self.git_tree.join(dir_key)
+        except KeyError:
+            raise FileNotFoundError("%s: %s" % (self, dir_key))
+        return sorted(blob.name for blob in tree.blobs)
+
+    def close(self):
+        if self.sqlite:
+            self.sqlite.close()
+
+
+def make_storage(path, read_only=False):
+    """
+    :param str path: DB directory
+    :param bool read_only: see :class:`SqliteStorage`. (the other storages do not write on their own)
+    :return: storage for the DB directory. SQLite if the DB file exists, otherwise the files
+    :rtype: Storage
+    """
+    if SqliteStorage.exists_in(path):
+        return SqliteStorage(path, read_only=read_only)
+    return FileStorage(path)
+
+
+def state_keys(storage):
+    """
+    :param Storage storage:
+    :return: all keys of the DB state, i.e. what :class:`SqliteStorage` stores
+    :rtype: list[str]
+    """
+    keys = ["drinkers/list.txt"]
+    keys += ["drinkers/state/%s" % fn for fn in storage.list_dir("drinkers/state") if fn.endswith(".txt")]
+    if storage.exists("admin-cash-position.txt"):
+        keys.append("admin-cash-position.txt")
+    return keys
+
+
+def migrate(src, dst):
+    """
+    Copies the DB state from one storage to another.
+
+    :param Storage src:
+    :param Storage dst:
+    :return: number of copied keys
+    :rtype: int
+    """
+    keys = state_keys(src)
+    for key in keys:
+        dst.write(key, src.read(key))
+    return len(keys)
+
+
+def main():
+    import better_exchook
+
+    better_exchook.install()
+    from argparse import ArgumentParser
+
+    arg_parser = ArgumentParser(description="Migrate the DB state between storage backends.")
+    arg_parser.add_argument("--db", required=True, help="path to database")
+    arg_parser.add_argument("--to", required=True, choices=["sqlite", "files"])
+    args = arg_parser.parse_args()
+    sqlite_fn = "%s/%s" % (args.db, SqliteStorage.Filename)
+    if args.to == "sqlite":
+        assert not os.path.exists(sqlite_fn), "already exists: %s" % sqlite_fn
+        src, dst = FileStorage(args.db), SqliteStorage(args.db)
+    else:
+        assert os.path.exists(sqlite_fn), "does not exist: %s" % sqlite_fn
+        src, dst = SqliteStorage(args.db), FileStorage(args.db)
+    src.check_valid()
+    num = migrate(src, dst)
+    src.close()
+    dst.close()
+    print("Copied %i keys from %r to %r." % (num, src, dst))
+    if args.to == "files":
+        os.rename(sqlite_fn, sqlite_fn + ".bak")
+        print("Moved %s to %s.bak. The DB uses the files now." % (sqlite_fn, sqlite_fn))
+    else:
+        print("The DB uses %s now. The old files are not used anymore." % sqlite_fn)
+    print("Remember to commit the changes in the DB Git repo.")
+
+
+if __name__ == "__main__":
+    main()
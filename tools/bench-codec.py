@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for parsing the drinker state files: ``eval`` vs :mod:`codec`.
+Also checks that the codec writes the files byte-for-byte as they are.
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(os.path.realpath(__file__))))
+sys.path.insert(0, main_dir)
+
+import codec  # noqa: E402
+from db import Db  # noqa: E402
+from decimal import Decimal  # noqa: E402
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--db", default="%s/demo-db" % main_dir, help="path to database")
+    arg_parser.add_argument("--repeat", type=int, default=100, help="how often to parse each file")
+    args = arg_parser.parse_args()
+
+    fns = sorted(glob.glob("%s/drinkers/state/*.txt" % args.db))
+    assert fns, "no drinkers found in %s" % args.db
+    contents = [open(fn).read() for fn in fns]
+    eval_globals = dict(Db.codec_names, Decimal=Decimal)
+
+    for fn, s in zip(fns, contents):
+        drinker = codec.loads(s, names=Db.codec_names, filename=fn)
+        assert repr(drinker) == repr(eval(s, eval_globals)), "codec mismatch: %s" % fn
+        assert codec.dumps(drinker) == s, "codec does not reproduce file content: %s" % fn
+    print("Checked %i drinker files, codec output is identical." % len(fns))
+
+    def _bench(name, func):
+        start_time = time.perf_counter()
+        for _ in range(args.repeat):
+            for s in contents:
+                func(s)
+        total_time = time.perf_counter() - start_time
+        per_drinker = total_time / (args.repeat * len(contents))
+        print("%s: %.1f us per drinker" % (name, per_drinker * 1e6))
+        return per_drinker
+
+    eval_time = _bench("eval", lambda s: eval(s, eval_globals))
+    codec_time = _bench("codec", lambda s: codec.loads(s, names=Db.codec_names))
+    print("Speedup: %.1fx" % (eval_time / codec_time))
+
+
+if __name__ == "__main__":
+    import better_exchook
+
+    better_exchook.install()
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Measures the purchase latency (:func:`db.Db.drinker_buy_item`) while Git commits are running.
+Git is made slow via a fake ``git`` in ``PATH``, which sleeps before it runs the real ``git``.
+The DB is a temporary copy of the given DB.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(os.path.realpath(__file__))))
+sys.path.insert(0, main_dir)
+
+from db import Db  # noqa: E402
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--db", default="%s/demo-db" % main_dir, help="path to database (copied)")
+    arg_parser.add_argument("--git-delay", type=float, default=2.0, help="secs, for every git call")
+    arg_parser.add_argument("--num-purchases", type=int, default=200)
+    args = arg_parser.parse_args()
+
+    real_git = shutil.which("git")
+    assert real_git, "git not found"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = "%s/db" % tmp_dir
+        shutil.copytree(args.db, db_path)
+        for cmd in [
+            ["git", "init", "-q"],
+            ["git", "add", "-A"],
+            ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-q", "-m", "init"],
+            ["git", "config", "user.name", "bench"],
+            ["git", "config", "user.email", "bench@localhost"],
+        ]:
+            subprocess.check_call(cmd, cwd=db_path)
+        os.mkdir("%s/bin" % tmp_dir)
+        with open("%s/bin/git" % tmp_dir, "w") as f:
+            f.write('#!/bin/sh\nsleep %f\nexec "%s" "$@"\n' % (args.git_delay, real_git))
+        os.chmod("%s/bin/git" % tmp_dir, 0o755)
+        os.environ["PATH"] = "%s/bin:%s" % (tmp_dir, os.environ["PATH"])
+
+        db = Db(path=db_path)
+        drinker_names = db.get_drinker_names_all_in_db()
+        item_name = db.get_buy_items()[0].intern_name
+        latencies = []
+        start_time = time.perf_counter()
+        for i in range(args.num_purchases):
+            if i % 20 == 0:
+                db._add_git_commit_task(wait_time=0)
+                time.sleep(0.01)  # let the commit start
+            t = time.perf_counter()
+            db.drinker_buy_item(drinker_names[i % len(drinker_names)], item_name)
+            latencies.append(time.perf_counter() - t)
+        total_time = time.perf_counter() - start_time
+        db.at_exit()
+
+    latencies.sort()
+    print(
+        "%i purchases in %.1f sec, latency: median %.1f ms, max %.1f ms (git delay: %.1f sec)"
+        % (len(latencies), total_time, latencies[len(latencies) // 2] * 1e3, latencies[-1] * 1e3, args.git_delay)
+    )
+    print(db.get_git_commit_engine().get_stats_formatted(), end="")
+    if latencies[-1] >= args.git_delay:
+        print("Purchases were blocked by Git.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    import better_exchook
+
+    better_exchook.install()
+    main()
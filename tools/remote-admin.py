@@ -8,47 +8,107 @@ import ast
 import time
 import typing
 import json
+import socket
+import csv
 from typing import Dict
 from decimal import Decimal
 from subprocess import Popen, PIPE, CalledProcessError
 
 
 main_dir = os.path.dirname(os.path.dirname(os.path.abspath(os.path.realpath(__file__))))
+sys.path.insert(0, main_dir)
+from utils import better_repr, time_stamp  # noqa: E402  # better_repr: same formatting as the kiosk
 
 
 def main_func():
     arg_parser = argparse.ArgumentParser(description="Attach remotely to main app, and run admin commands.")
     arg_parser.add_argument("--kernel", default="kernel.json", help="IPython/Jupyter kernel.json from main app")
+    arg_parser.add_argument(
+        "--transport", default="auto", choices=["auto", "kernel-client", "subprocess"],
+        help="kernel-client keeps one connection (needs jupyter_client), subprocess runs `jupyter run` per command")
+    arg_parser.add_argument(
+        "--kiosk-db", default="db",
+        help="DB directory of the running kiosk (relative to the main dir), for the default --admin-socket")
+    arg_parser.add_argument(
+        "--admin-socket",
+        help="admin RPC socket of the kiosk. used if it is available (same host), otherwise the kernel is used."
+        " default: <kiosk-db>/local/admin-rpc.sock. '' disables")
+    arg_parser.add_argument("--verbose", action="store_true", help="print the round-trip time of every command")
+    arg_parser.add_argument(
+        "--batch", metavar="FILE.csv",
+        help="non-interactive: apply all commands from this file at once (see Main.run_batch), then quit")
+    arg_parser.add_argument("--dry-run", action="store_true", help="with --batch: only validate and show the changes")
+    arg_parser.add_argument("--yes", action="store_true", help="with --batch: do not ask for confirmation")
+    arg_parser.add_argument(
+        "--db", help="offline, read-only: read the DB directly from this directory. works without the kiosk")
+    arg_parser.add_argument("--rev", help="with --db: read the DB at this Git revision")
     args = arg_parser.parse_args()
+    kernel_fn = args.kernel
+    if not kernel_fn.startswith("/"):
+        kernel_fn = os.path.normpath("%s/%s" % (main_dir, kernel_fn))
+    if args.rev and not args.db:
+        arg_parser.error("--rev requires --db")
+    if args.db:
+        if args.batch:
+            arg_parser.error("--batch does not work with --db (read-only). changes go through the kiosk")
+        transport = LocalDbTransport(args.db, git_revision=args.rev)
+        Main(kernel_fn=kernel_fn, transport=transport, verbose=args.verbose).run()
+        return
+    assert os.path.exists(kernel_fn), "kernel.json not found: %s" % (kernel_fn,)
+    transport = None
+    socket_path = args.admin_socket
+    if socket_path is None:
+        from admin_rpc import get_default_socket_path
+
+        socket_path = get_default_socket_path(args.kiosk_db)
+    if socket_path:
+        socket_path = os.path.normpath(os.path.join(main_dir, socket_path))
+        if os.path.exists(socket_path):
+            try:
+                transport = RpcSocketTransport(socket_path)
+            except OSError as exc:
+                print(f"Cannot connect to admin RPC socket {socket_path} ({exc}), using the kernel.")
+    if not transport:
+        transport = make_transport(args.transport, kernel_fn=kernel_fn)
+    if args.batch:
+        main = Main(kernel_fn=kernel_fn, transport=transport, verbose=args.verbose, interactive=False)
+        main.run_batch(args.batch, dry_run=args.dry_run, confirm=not args.yes)
+        return
+    # The kiosk creates these files again when it starts again.
+    restart_fn = transport.socket_path if isinstance(transport, RpcSocketTransport) else kernel_fn
     while True:
-        main = Main(kernel_fn=args.kernel)
+        main = Main(kernel_fn=kernel_fn, transport=transport, verbose=args.verbose)
         try:
             main.run()
         except _RestartKiosk:
+            old_mtime = os.stat(restart_fn).st_mtime if os.path.exists(restart_fn) else None
             print("Wait a moment for the kiosk to quit...")
             time.sleep(10)
             print("Waiting for kiosk to start again...")
             start_wait_time = time.monotonic()
             timeout = 60
-            while not os.path.exists(main.kernel_fn):
+            # E.g. the kiosk writes a new kernel.json (with new ports and key) when it starts again.
+            while not os.path.exists(restart_fn) or os.stat(restart_fn).st_mtime == old_mtime:
                 time.sleep(0.2)
                 if time.monotonic() - start_wait_time > timeout:
                     print(f"Timeout, waited more than {timeout} seconds.")
                     sys.exit(1)
-            assert os.path.exists(main.kernel_fn)
+            transport.reconnect()
             continue
         break
 
 
 class Main:
-    def __init__(self, kernel_fn):
+    def __init__(self, kernel_fn, transport, verbose=False, interactive=True):
         """
-        :param str kernel_fn: "kernel.json"
+        :param str kernel_fn: absolute path to "kernel.json"
+        :param RpcSocketTransport|LocalDbTransport|KernelClientTransport|SubprocessTransport transport:
+        :param bool verbose: print the round-trip time of every command
+        :param bool interactive: if False, do not print the balances of all drinkers at startup
         """
-        if not kernel_fn.startswith("/"):
-            kernel_fn = os.path.normpath("%s/%s" % (main_dir, kernel_fn))
-        assert os.path.exists(kernel_fn), "kernel.json not found: %s" % (kernel_fn,)
         self.kernel_fn = kernel_fn
+        self.transport = transport
+        self.verbose = verbose
 
         log_fn = os.path.dirname(kernel_fn) + "/remote-admin.log"
         try:
@@ -57,27 +117,37 @@ class Main:
             print(f"(While opening logfile {log_fn}, got: {type(exc).__name__}: {exc})")
             self.log_file = open("/dev/null", "w")
 
-        kernel_info = json.load(open(kernel_fn))
-        print(f"Connecting to Jupiter kernel remote IP {kernel_info['ip']} port {kernel_info['shell_port']}...")
-
-        # Get DB-path, mostly as a check.
-        db_path = self._remote_exec("db.path")
-        db_path = ast.literal_eval(db_path)
+        if isinstance(transport, LocalDbTransport):
+            git_commit = getattr(transport.db, "git_commit", None)  # HistoricDb
+            print(f"Offline, read-only: DB {transport.db.path}", end="")
+            print(f" at Git commit {git_commit}" if git_commit else "")
+        elif isinstance(transport, RpcSocketTransport):
+            print(f"Connecting to admin RPC socket {transport.socket_path}...")
+        else:
+            kernel_info = json.load(open(kernel_fn))
+            print(f"Connecting to Jupiter kernel remote IP {kernel_info['ip']} port {kernel_info['shell_port']}"
+                  f" via {transport.name}...")
+
+        # State snapshot via Db.export_state. Updated incrementally by refresh_state.
+        self.state = None  # type: typing.Optional[typing.Dict[str, typing.Any]]
+        self._state_time = 0.
+        self.drinker_names_all_in_db = []  # type: typing.List[str]
+        self.drinker_names_active = []  # type: typing.List[str]  # those in GUI, active user
+        self.buy_items = []  # type: typing.List[str]
+        db_path, state = self._rpc_calls([("get_db_path", ()), ("export_state", ())])
+        self._update_state(state)
+
+        # DB-path, mostly as a check.
         assert isinstance(db_path, str)
         if not db_path.startswith("/"):
             db_path = os.path.normpath("%s/%s" % (main_dir, db_path))
         assert os.path.exists(db_path)
         self.db_path = db_path
 
-        drinkers_credit_balances_str = self._remote_exec("db.get_drinkers_credit_balances_formatted()")
-        drinkers_credit_balances_str = ast.literal_eval(drinkers_credit_balances_str)
-        assert isinstance(drinkers_credit_balances_str, str)
-        print("Drinkers credit balances:")
-        print(drinkers_credit_balances_str)
-        self.drinker_names_all_in_db = sorted(_parse_drinkers_with_credit_balance(drinkers_credit_balances_str).keys())
+        if interactive:
+            print("Drinkers credit balances:")
+            print(_format_balances({name: d["credit_balance"] for (name, d) in self.state["drinkers"].items()}))
 
-        # those in GUI, active user
-        self.drinker_names_active = ast.literal_eval(self._remote_exec("db.get_drinker_names()"))
         assert isinstance(self.drinker_names_active, list)
         if not set(self.drinker_names_active).issubset(set(self.drinker_names_all_in_db)):
             err_msg = ["Active drinkers not in DB:"]
@@ -86,16 +156,13 @@ class Main:
                     err_msg.append("  %s" % drinker_name)
             raise Exception("\n".join(err_msg))
 
-        buy_items_str = self._remote_exec("sorted(db.get_buy_items_by_intern_name().keys())")
-        buy_items = ast.literal_eval(buy_items_str)
-        assert isinstance(buy_items, list) and buy_items and isinstance(buy_items[0], str)
-        self.buy_items = buy_items  # type: typing.List[str]
+        assert self.buy_items and isinstance(self.buy_items[0], str)
 
-        self._cmd_arg_drinker = CmdArg("<name>", self._parse_drinker_name, self.drinker_names_all_in_db)
+        self._cmd_arg_drinker = CmdArg("<name>", self._parse_drinker_name, lambda: self.drinker_names_all_in_db)
         self._cmd_arg_money_amount = CmdArg("<money-amount>", self._parse_money_amount)
         self._cmd_arg_purchase = CmdArg("<purchase>", self._parse_purchase)
         self._cmd_arg_item_amount = CmdArg("<item-amount>", self._parse_item_amount)
-        self._cmd_arg_item = CmdArg("<item>", self._parse_item, self.buy_items)
+        self._cmd_arg_item = CmdArg("<item>", self._parse_item, lambda: self.buy_items)
         self.available_cmds = {
             "drinker_pay": Cmd(
                 [self._cmd_arg_drinker, self._cmd_arg_money_amount], self.drinker_pay,
@@ -117,6 +184,9 @@ class Main:
             "restart_kiosk": Cmd([], self.restart_kiosk, "Restart the kiosk."),
             "help": Cmd([], self.help),
             "exit": Cmd([], self.exit)}
+        if isinstance(transport, LocalDbTransport):
+            self.available_cmds = {
+                name: cmd for (name, cmd) in self.available_cmds.items() if name in self.OfflineCmds}
         self.readline_completer = ReadlineCompleter(main=self, prompt="Command: ")
 
         # readline can be implemented using GNU readline or libedit
@@ -126,6 +196,36 @@ class Main:
         else:
             readline.parse_and_bind('tab: complete')
 
+    def _update_state(self, update):
+        """
+        :param dict[str] update: from Db.export_state, either full, or the changes since our version
+        """
+        if update["full"] or not self.state or update["instance"] != self.state["instance"]:
+            assert update["full"]
+            self.state = update
+        else:
+            self.state["drinkers"].update(update["drinkers"])
+            for name in update["deleted_drinkers"]:
+                self.state["drinkers"].pop(name, None)
+            for key in ["drinker_names", "buy_items", "admin_cash_position"]:
+                if key in update:
+                    self.state[key] = update[key]
+            self.state["version"] = update["version"]
+        self._state_time = time.monotonic()
+        self.drinker_names_all_in_db = sorted(self.state["drinkers"].keys())
+        self.drinker_names_active = self.state["drinker_names"]
+        self.buy_items = sorted([item["intern_name"] for item in self.state["buy_items"]])
+
+    def refresh_state(self, max_age=0.):
+        """
+        Fetches only what changed since our last snapshot.
+
+        :param float max_age: secs. do nothing if our snapshot is newer
+        """
+        if time.monotonic() - self._state_time < max_age:
+            return
+        self._update_state(self._rpc("export_state", self.state["version"], self.state["instance"]))
+
     def _parse_drinker_name(self, arg):
         """
         :param str arg:
@@ -176,17 +276,64 @@ class Main:
             raise Exception("invalid item amount %r: %s" % (arg, exc))
         return amount
 
-    def _remote_exec(self, cmd_str):
-        """
-        :param str cmd_str: Python code
-        :return: output (Python repr)
-        :rtype: str
-        """
-        try:
-            return sysexec_out("jupyter", "run", "--existing", self.kernel_fn, stdin=cmd_str)
-        except CalledProcessError as exc:
-            print("CalledProcessError:", exc)
-            sys.exit(1)
+    # These do not change anything, so they can safely be repeated after a connection problem.
+    ReadOnlyMethods = {
+        "export_state",
+        "get_db_path",
+        "get_drinkers_credit_balances",
+        "get_drinker_inactive_and_non_neg_balance",
+        "get_drinker_names",
+        "get_buy_items",
+        "get_drinker",
+        "get_admin_state_formatted",
+    }
+
+    def _rpc_calls(self, calls):
+        """
+        Calls the methods of the kiosk admin RPC (see admin_rpc.py).
+        All requests are sent at once (pipelined or batched, depending on the transport).
+
+        :param list[(str,tuple)] calls: method name and params
+        :return: results, in the same order
+        :rtype: list
+        """
+        requests = [{"id": i, "method": method, "params": list(params)} for (i, (method, params)) in enumerate(calls)]
+        for attempt in range(2):
+            start_time = time.perf_counter()
+            try:
+                responses = self.transport.call(requests)
+            except RemoteError:
+                raise
+            except Exception as exc:
+                if attempt > 0:
+                    print("%s: %s" % (type(exc).__name__, exc))
+                    sys.exit(1)
+                # E.g. the kiosk was restarted in the meantime.
+                print("Connection problem (%s: %s), reconnecting..." % (type(exc).__name__, exc))
+                self.transport.reconnect()
+                if all(method in self.ReadOnlyMethods for (method, _) in calls):
+                    continue
+                # The kiosk might have executed it already.
+                raise RemoteError("Reconnected. Not repeating %s. Please check the state." % (calls,))
+            if self.verbose:
+                print("(%s: %.1f ms for %s)" % (
+                    self.transport.name, (time.perf_counter() - start_time) * 1e3,
+                    ", ".join(method for (method, _) in calls)))
+            results = []
+            for response in responses:
+                if "error" in response:
+                    error = response["error"]
+                    raise RemoteError("Error in the kiosk: %s: %s" % (error["type"], error["message"]))
+                results.append(response["result"])
+            return results
+
+    def _rpc(self, method, *params):
+        """
+        :param str method: see admin_rpc.py
+        :param params:
+        :return: result
+        """
+        return self._rpc_calls([(method, params)])[0]
 
     def drinker_pay(self, name, amount):
         """
@@ -195,7 +342,7 @@ class Main:
         """
         assert name in self.drinker_names_all_in_db, "User %r does not seem to exist." % name
 
-        state_str = self._remote_exec("db.drinker_pay(%r, %r)" % (name, str(amount)))
+        state_str = _format_drinker(self._rpc("drinker_pay", name, str(amount)))
         print(state_str)
 
         run_posthook(
@@ -210,16 +357,14 @@ class Main:
         """
         assert name in self.drinker_names_all_in_db, "User %r does not seem to exist." % name
 
-        state_str = self._remote_exec("db.drinker_buy_item(%r, %r, %r)" % (name, item_name, amount))
-        print(state_str)
+        print(_format_drinker(self._rpc("drinker_buy_item", name, item_name, amount)))
 
     def drinker_state(self, name):
         """
         :param str name:
         """
         assert name in self.drinker_names_all_in_db, "User %r does not seem to exist." % name
-        state_str = self._remote_exec("db.get_drinker(%r)" % (name,))
-        print(state_str)
+        print(_format_drinker(self._rpc("get_drinker", name)))
 
     def admin_pay(self, name, purchase, amount):
         """
@@ -228,29 +373,22 @@ class Main:
         :param Decimal amount:
         """
         assert name in self.drinker_names_all_in_db, "User %r does not seem to exist." % name
-        state_str = self._remote_exec("db.admin_pay(%r, %r, %r)" % (name, purchase, str(amount)))
-        state_str = ast.literal_eval(state_str)
-        print(state_str)
+        print(self._rpc("admin_pay", name, purchase, str(amount)))
 
     def admin_set_cash_position(self, amount):
         """
         :param Decimal amount:
         """
-        state_str = self._remote_exec("db.admin_set_cash_position(%r)" % (str(amount),))
-        state_str = ast.literal_eval(state_str)
-        print(state_str)
+        print(self._rpc("admin_set_cash_position", str(amount)))
 
     def admin_state(self):
-        state_str = self._remote_exec("db.get_admin_state_formatted()")
-        state_str = ast.literal_eval(state_str)
-        print(state_str)
+        print(self._rpc("get_admin_state_formatted"))
 
     def drinker_delete_inactive_non_neg_balance(self):
-        s = self._remote_exec("db.get_drinker_inactive_and_non_neg_balance_formatted()")
-        s = ast.literal_eval(s)
+        balances = self._rpc("get_drinker_inactive_and_non_neg_balance")
         print("Inactive users with non-negative balance:")
-        print(s)
-        drinkers = sorted(_parse_drinkers_with_credit_balance(s).keys())
+        print(_format_balances(balances))
+        drinkers = sorted(balances.keys())
         if not drinkers:
             print("(None)")
             return
@@ -261,14 +399,14 @@ class Main:
         if answer.lower() != "y":
             print("Invalid answer %r. Not deleting." % answer)
             return
-        self._remote_exec("db.drinkers_delete(%r)" % (drinkers,))
+        self._rpc("drinkers_delete", drinkers)
         print("Deleted.")
 
     def reload(self):
-        self._remote_exec("reload()")
+        self._rpc("reload")
 
     def restart_kiosk(self):
-        self._remote_exec("exit_()")
+        self._rpc("exit")
         print("The remote admin interface will also restart now.")
         raise _RestartKiosk()
 
@@ -315,6 +453,10 @@ class Main:
                 print("%s: requires %i arguments (%s), got %i (%s)." % (
                     cmd_name, len(cmd.args), cmd.args_help, len(args), " ".join(args)))
                 continue
+            try:
+                self.refresh_state(max_age=1)  # e.g. new drinkers, for the parsing
+            except RemoteError as exc:
+                print(exc)
             parsed_args = []
             for i in range(len(args)):
                 arg = args[i]
@@ -325,9 +467,376 @@ class Main:
                     break
             if len(parsed_args) != len(args):
                 continue
-            cmd.func(*parsed_args)
+            try:
+                cmd.func(*parsed_args)
+            except RemoteError as exc:
+                print(exc)
             print("-" * 40)
 
+    # Commands which only read, i.e. which also work offline (LocalDbTransport).
+    OfflineCmds = ("drinker_state", "admin_state", "help", "exit")
+
+    # Commands which can be used in a batch file. See Db.apply_batch.
+    BatchCmds = ("drinker_pay", "drinker_buy_item", "admin_pay", "admin_set_cash_position")
+
+    def _parse_batch_file(self, filename):
+        """
+        :param str filename: CSV. Every row is a command with its args, like in the interactive mode,
+            e.g. ``drinker_pay,alexa,20``. ``<name>,<amount>`` is short for ``drinker_pay``.
+            Empty rows and rows starting with ``#`` are ignored.
+        :return: operations (for Db.apply_batch), and errors
+        :rtype: (list[tuple], list[str])
+        """
+        ops, errors = [], []
+        with open(filename, newline="") as f:
+            for line_num, row in enumerate(csv.reader(f), 1):
+                row = [cell.strip() for cell in row]
+                if not any(row) or row[0].startswith("#"):
+                    continue
+                if row[0] in self.BatchCmds:
+                    cmd_name, args = row[0], row[1:]
+                elif len(row) == 2:
+                    cmd_name, args = "drinker_pay", row
+                else:
+                    errors.append("line %i: invalid command %r, expected one of %s, or <name>,<money-amount>" % (
+                        line_num, row[0], ", ".join(self.BatchCmds)))
+                    continue
+                cmd = self.available_cmds[cmd_name]
+                if len(args) != len(cmd.args):
+                    errors.append("line %i: %s requires %i arguments (%s), got %i" % (
+                        line_num, cmd_name, len(cmd.args), cmd.args_help, len(args)))
+                    continue
+                try:
+                    parsed_args = [cmd_arg.parser(arg) for (cmd_arg, arg) in zip(cmd.args, args)]
+                except Exception as exc:
+                    errors.append("line %i: %s: %s" % (line_num, cmd_name, exc))
+                    continue
+                # Money amounts as str, for the RPC.
+                ops.append((cmd_name,) + tuple(str(a) if isinstance(a, Decimal) else a for a in parsed_args))
+        return ops, errors
+
+    def _batch_dry_run(self, ops):
+        """
+        Applies the operations on our state snapshot (locally), like Db.apply_batch would do it.
+
+        :param list[tuple] ops:
+        :return: drinker name -> (old balance, new balance, item name -> count change),
+            and old and new admin cash position
+        :rtype: (dict[str,(Decimal,Decimal,dict[str,int])], Decimal, Decimal)
+        """
+        prices = {item["intern_name"]: Decimal(item["price"]) for item in self.state["buy_items"]}
+        changes = {}
+        old_cash = cash = Decimal(self.state["admin_cash_position"]["cash_position"])
+        for op in ops:
+            if op[0] in {"drinker_pay", "drinker_buy_item"}:
+                name = op[1]
+                if name not in changes:
+                    balance = Decimal(self.state["drinkers"][name]["credit_balance"])
+                    changes[name] = (balance, balance, {})
+                old_balance, balance, counts = changes[name]
+                if op[0] == "drinker_pay":
+                    balance += Decimal(op[2])
+                    cash += Decimal(op[2])
+                else:
+                    _, _, item_name, amount = op
+                    balance -= prices[item_name] * amount
+                    counts[item_name] = counts.get(item_name, 0) + amount
+                changes[name] = (old_balance, balance, counts)
+            elif op[0] == "admin_pay":
+                cash -= Decimal(op[3])
+            elif op[0] == "admin_set_cash_position":
+                cash = Decimal(op[1])
+        return changes, old_cash, cash
+
+    def run_batch(self, filename, dry_run=False, confirm=True):
+        """
+        Validates all commands from the file (see :func:`_parse_batch_file`), and shows the changes.
+        Then applies all of them at once in the kiosk (Db.apply_batch, i.e. all or nothing, with a single Git commit),
+        and afterwards runs the drinker pay posthook for every payment.
+
+        :param str filename:
+        :param bool dry_run: only show the changes
+        :param bool confirm: ask before applying
+        """
+        ops, errors = self._parse_batch_file(filename)
+        if errors:
+            print("Errors in %s, nothing applied:" % filename)
+            for error in errors:
+                print("  %s" % error)
+            sys.exit(1)
+        if not ops:
+            print("No commands in %s." % filename)
+            return
+        changes, old_cash, new_cash = self._batch_dry_run(ops)
+        print("%i commands in %s. Changes:" % (len(ops), filename))
+        for name, (old_balance, balance, counts) in sorted(changes.items()):
+            counts_str = "".join([", %s %+i" % item for item in sorted(counts.items()) if item[1]])
+            diff = balance - old_balance
+            print("  %s: balance %s -> %s (%s%s)%s" % (
+                name, old_balance, balance, "+" if diff >= 0 else "", diff, counts_str))
+        print("  admin cash position: %s -> %s" % (old_cash, new_cash))
+        if dry_run:
+            print("Dry run, nothing applied.")
+            return
+        if confirm:
+            answer = input("Apply? (y/N)")
+            if answer.lower() != "y":
+                print("Not applied.")
+                return
+        drinkers = self._rpc("apply_batch", ops)
+        for op in ops:
+            self.log_file.write(f"{time_stamp()} batch {filename}: {' '.join(map(str, op))}\n")
+        self.log_file.flush()
+        print("Applied.")
+        for name, (_, balance, _) in sorted(changes.items()):
+            if Decimal(drinkers[name]["credit_balance"]) != balance:
+                # E.g. the drinker bought something in the meantime.
+                print("  Note: %s has balance %s now." % (name, drinkers[name]["credit_balance"]))
+
+        posthook_fn = "%s/config/remote_drinker_pay_posthook.py" % self.db_path
+        if os.path.exists(posthook_fn):
+            posthook = compile(open(posthook_fn).read(), posthook_fn, "exec")
+            for op in ops:
+                if op[0] == "drinker_pay":
+                    state_str = _format_drinker(drinkers[op[1]])
+                    eval(posthook, {"name": op[1], "amount": Decimal(op[2]), "state_str": state_str})
+
+
+class RemoteError(Exception):
+    """
+    Exception in the kiosk, while it executed some command.
+    """
+
+
+class RpcSocketTransport:
+    """
+    Connects to the admin RPC socket of the kiosk (see admin_rpc.py). Only works on the same host.
+    """
+
+    name = "rpc-socket"
+
+    def __init__(self, socket_path, timeout=30.0):
+        """
+        :param str socket_path:
+        :param float timeout: secs
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None  # type: typing.Optional[socket.socket]
+        self.file = None
+        self.reconnect()
+
+    def reconnect(self):
+        self.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.file = sock.makefile("rwb")
+
+    def close(self):
+        if self.sock:
+            self.file.close()
+            self.sock.close()
+            self.sock = self.file = None
+
+    def call(self, requests):
+        """
+        Pipelined: sends all requests, then reads all responses.
+
+        :param list[dict[str]] requests:
+        :rtype: list[dict[str]]
+        """
+        if not self.sock:
+            self.reconnect()
+        self.file.write(b"".join([json.dumps(request).encode("utf8") + b"\n" for request in requests]))
+        self.file.flush()
+        responses = []
+        for _ in requests:
+            line = self.file.readline()
+            if not line:
+                self.close()
+                raise ConnectionError("admin RPC socket closed")
+            responses.append(json.loads(line.decode("utf8")))
+        return responses
+
+
+class LocalDbTransport:
+    """
+    Reads the DB directly from the files (read-only), without the kiosk, e.g. while the kiosk restarts.
+    Serves the read-only admin RPC methods in this process (see admin_rpc.py).
+    The DB has its own drinker cache, which is validated against the files.
+    """
+
+    name = "local-db"
+
+    def __init__(self, db_path, git_revision=None):
+        """
+        :param str db_path:
+        :param str|None git_revision: if given, the DB at this Git revision (db.HistoricDb)
+        """
+        from db import ReadOnlyDb, HistoricDb
+        from admin_rpc import AdminRpc
+
+        db_path = os.path.abspath(db_path)
+        self.db = HistoricDb(db_path, git_revision) if git_revision else ReadOnlyDb(db_path)
+        self.rpc = AdminRpc(self.db, read_only=True)
+
+    def reconnect(self):
+        pass  # nothing to connect
+
+    def call(self, requests):
+        """
+        :param list[dict[str]] requests:
+        :rtype: list[dict[str]]
+        """
+        return self.rpc.handle(requests)
+
+
+class KernelTransportBase:
+    """
+    Runs Python code in the IPython kernel of the kiosk.
+    """
+
+    name = None  # type: str
+
+    def reconnect(self):
+        raise NotImplementedError
+
+    def exec(self, code):
+        """
+        :param str code: Python code
+        :return: output (Python repr)
+        :rtype: str
+        """
+        raise NotImplementedError
+
+    def call(self, requests):
+        """
+        Sends all requests as one batch to the admin RPC in the kernel (``rpc``, see main.py).
+
+        :param list[dict[str]] requests:
+        :rtype: list[dict[str]]
+        """
+        return json.loads(ast.literal_eval(self.exec("rpc.handle_json(%r)" % json.dumps(requests))))
+
+
+class KernelClientTransport(KernelTransportBase):
+    """
+    Executes code in the kiosk via a single :class:`jupyter_client.BlockingKernelClient` for the whole session.
+    This takes milliseconds per command, whereas `jupyter run` takes a second or more.
+    """
+
+    name = "kernel-client"
+
+    def __init__(self, kernel_fn, timeout=30.0):
+        """
+        :param str kernel_fn: kernel.json
+        :param float timeout: secs, for connecting and for every command
+        """
+        self.kernel_fn = kernel_fn
+        self.timeout = timeout
+        self.client = None
+        self.reconnect()
+
+    def reconnect(self):
+        """
+        (Re)reads kernel.json, and connects. E.g. after the kiosk was restarted.
+        """
+        from jupyter_client import BlockingKernelClient
+
+        self.close()
+        client = BlockingKernelClient()
+        client.load_connection_file(self.kernel_fn)
+        client.start_channels()
+        try:
+            client.wait_for_ready(timeout=self.timeout)
+        except Exception:
+            client.stop_channels()
+            raise
+        self.client = client
+
+    def close(self):
+        if self.client:
+            self.client.stop_channels()
+            self.client = None
+
+    def exec(self, code):
+        """
+        :param str code: Python code
+        :return: output, like `jupyter run` prints it, i.e. stdout and the repr of the result
+        :rtype: str
+        """
+        if not self.client:
+            self.reconnect()
+        out = []
+        errors = []
+
+        def _output_hook(msg):
+            msg_type, content = msg["msg_type"], msg["content"]
+            if msg_type == "stream":
+                out.append(content["text"])
+            elif msg_type == "execute_result":
+                out.append(content["data"].get("text/plain", "") + "\n")
+            elif msg_type == "error":
+                errors.append("\n".join(content["traceback"]))
+
+        reply = self.client.execute_interactive(
+            code, store_history=False, output_hook=_output_hook, timeout=self.timeout)
+        if reply["content"]["status"] != "ok" or errors:
+            raise RemoteError(
+                "Error in the kiosk for %r:\n%s" % (code, "\n".join(errors) or reply["content"].get("evalue")))
+        return "".join(out)
+
+
+class SubprocessTransport(KernelTransportBase):
+    """
+    Executes code in the kiosk via `jupyter run --existing kernel.json`, i.e. a new process and connection per command.
+    This is the fallback when jupyter_client cannot be imported.
+    """
+
+    name = "subprocess"
+
+    def __init__(self, kernel_fn):
+        """
+        :param str kernel_fn: kernel.json
+        """
+        self.kernel_fn = kernel_fn
+
+    def reconnect(self):
+        pass  # every command connects anew
+
+    def exec(self, code):
+        """
+        :param str code: Python code
+        :return: output (Python repr)
+        :rtype: str
+        """
+        return sysexec_out("jupyter", "run", "--existing", self.kernel_fn, stdin=code)
+
+
+def make_transport(kind, kernel_fn):
+    """
+    :param str kind: "auto", "kernel-client" or "subprocess"
+    :param str kernel_fn: kernel.json
+    :rtype: KernelClientTransport|SubprocessTransport
+    """
+    if kind == "auto":
+        try:
+            import jupyter_client  # noqa: F401
+            kind = "kernel-client"
+        except ImportError:
+            print("jupyter_client not available, fallback to `jupyter run` per command (slow).")
+            kind = "subprocess"
+    if kind == "kernel-client":
+        return KernelClientTransport(kernel_fn=kernel_fn)
+    assert kind == "subprocess", "invalid transport %r" % kind
+    return SubprocessTransport(kernel_fn=kernel_fn)
+
 
 class ReadlineCompleter:
     def __init__(self, main, prompt):
@@ -372,7 +881,11 @@ class ReadlineCompleter:
                     arg_idx = len(args) - 1
                     last_arg = args[-1]
                     matches = []
-                    for arg_choice in cmd.args[arg_idx].choices:
+                    try:
+                        self.main.refresh_state(max_age=5)  # live completions, e.g. new drinkers
+                    except RemoteError:
+                        pass  # just use what we have
+                    for arg_choice in cmd.args[arg_idx].get_choices():
                         if arg_choice.startswith(last_arg):
                             matches.append(arg_choice + " ")
                     self._matches = matches
@@ -395,12 +908,20 @@ class CmdArg:
         """
         :param str help_name:
         :param (str)->object parser:
-        :param typing.Iterable[str] choices:
+        :param typing.Iterable[str]|(()->typing.Iterable[str]) choices: e.g. a function, for live choices
         """
         self.help_name = help_name
         self.parser = parser
         self.choices = choices
 
+    def get_choices(self):
+        """
+        :rtype: typing.Iterable[str]
+        """
+        if callable(self.choices):
+            return self.choices()
+        return self.choices
+
 
 class Cmd:
     def __init__(self, args, func, help_str=None):
@@ -455,22 +976,22 @@ def run_posthook(posthook_fn, user_ns):
         eval(co, user_ns)
 
 
-# Copied from utils.py, but easier to avoid import hacks.
-def time_stamp():
+def _format_balances(balances: Dict[str, str]) -> str:
     """
-    :return: current time stamp
-    :rtype: str
+    :param balances: drinker name -> credit balance, like from the admin RPC
+    :return: like Db.get_drinkers_credit_balances_formatted
     """
-    return time.strftime("%Y%m%d.%H%M%S", time.localtime())
+    return "".join(["%s: %s\n" % (name, balance) for (name, balance) in sorted(balances.items())])
 
 
-def _parse_drinkers_with_credit_balance(s: str) -> Dict[str, Decimal]:
-    out = {}
-    for line in s.splitlines():
-        drinker_name, credit_balance_str = line.split(":", 2)
-        credit_balance = Decimal(credit_balance_str)
-        out[drinker_name] = credit_balance
-    return out
+def _format_drinker(drinker: Dict[str, typing.Any]) -> str:
+    """
+    :param drinker: like from the admin RPC
+    :return: like the repr of db.Drinker (codec.format_obj), the same as via the kernel
+    """
+    return "Drinker(\n%s)" % ",\n".join([
+        "%s=%s" % (key, better_repr(Decimal(value) if key == "credit_balance" else value))
+        for (key, value) in drinker.items()])
 
 
 class _RestartKiosk(Exception):
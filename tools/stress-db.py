@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Stress test for the DB locking: many threads run purchases and payments concurrently,
+together with admin operations and Git commits.
+Afterwards, the DB is reopened from disk, and all counters and balances are checked.
+The DB is a temporary copy of the given DB.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import subprocess
+from decimal import Decimal
+from threading import Thread
+
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(os.path.realpath(__file__))))
+sys.path.insert(0, main_dir)
+
+from db import Db  # noqa: E402
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--db", default="%s/demo-db" % main_dir, help="path to database (copied)")
+    arg_parser.add_argument("--num-threads", type=int, default=16)
+    arg_parser.add_argument("--num-ops", type=int, default=200, help="per thread")
+    arg_parser.add_argument("--journal", action="store_true")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = "%s/db" % tmp_dir
+        shutil.copytree(args.db, db_path)
+        for cmd in [
+            ["git", "init", "-q"],
+            ["git", "add", "-A"],
+            ["git", "-c", "user.name=stress", "-c", "user.email=stress@localhost", "commit", "-q", "-m", "init"],
+            ["git", "config", "user.name", "stress"],
+            ["git", "config", "user.email", "stress@localhost"],
+        ]:
+            subprocess.check_call(cmd, cwd=db_path)
+
+        db = Db(path=db_path, use_journal=args.journal)
+        db.default_git_commit_wait_time = 0.05  # commit all the time
+        drinker_names = db.get_drinker_names_all_in_db()
+        items = db.get_buy_items()
+        initial = {name: db.get_drinker(name) for name in drinker_names}
+        initial_cash = db.admin_cash_position.cash_position
+        # Per thread: drinker name -> item name -> count, drinker name -> paid amount, admin payout.
+        results = [({}, {}, [Decimal(0)]) for _ in range(args.num_threads)]
+
+        def _thread_main(thread_idx):
+            rnd = random.Random(thread_idx)
+            counts, paid, admin_paid = results[thread_idx]
+            for _ in range(args.num_ops):
+                name = rnd.choice(drinker_names)
+                r = rnd.random()
+                if r < 0.8:
+                    item = rnd.choice(items)
+                    amount = rnd.choice([1, 1, 1, 2, -1])
+                    db.drinker_buy_item(name, item.intern_name, amount=amount)
+                    drinker_counts = counts.setdefault(name, {})
+                    drinker_counts[item.intern_name] = drinker_counts.get(item.intern_name, 0) + amount
+                elif r < 0.95:
+                    amount = Decimal(rnd.randint(1, 20))
+                    db.drinker_pay(name, amount)
+                    paid[name] = paid.get(name, 0) + amount
+                else:
+                    amount = Decimal(rnd.randint(1, 5))
+                    db.admin_pay(name, "stress", amount)
+                    admin_paid[0] += amount
+
+        start_time = time.perf_counter()
+        threads = [Thread(target=_thread_main, args=(i,)) for i in range(args.num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total_time = time.perf_counter() - start_time
+        db.at_exit()
+
+        # Reopen from disk, to also check what was persisted.
+        db = Db(path=db_path, use_journal=args.journal)
+        prices = {item.intern_name: item.price for item in items}
+        num_errors = 0
+        for name in drinker_names:
+            drinker = db.get_drinker(name)
+            expected_total_counts = dict(initial[name].total_buy_item_counts)
+            expected_balance = initial[name].credit_balance
+            for counts, paid, _ in results:
+                for item_name, count in counts.get(name, {}).items():
+                    expected_total_counts[item_name] = expected_total_counts.get(item_name, 0) + count
+                    expected_balance -= prices[item_name] * count
+                expected_balance += paid.get(name, 0)
+            expected_total_counts = {k: v for (k, v) in expected_total_counts.items() if v}
+            total_counts = {k: v for (k, v) in drinker.total_buy_item_counts.items() if v}
+            if total_counts != expected_total_counts or drinker.credit_balance != expected_balance:
+                print(
+                    "Mismatch for %s: counts %r, expected %r, balance %s, expected %s"
+                    % (name, total_counts, expected_total_counts, drinker.credit_balance, expected_balance)
+                )
+                num_errors += 1
+        expected_cash = initial_cash
+        for _, paid, admin_paid in results:
+            expected_cash += sum(paid.values(), Decimal(0)) - admin_paid[0]
+        if db.admin_cash_position.cash_position != expected_cash:
+            print("Mismatch for admin cash: %s, expected %s" % (db.admin_cash_position.cash_position, expected_cash))
+            num_errors += 1
+        git_status_cmd = ["git", "status", "--porcelain", "--untracked-files=no"]
+        git_status = subprocess.check_output(git_status_cmd, cwd=db_path).decode("utf8")
+        if git_status.strip():
+            print("Uncommitted changes:\n%s" % git_status)
+            num_errors += 1
+        db.at_exit()
+
+    print(
+        "%i threads, %i ops in %.1f sec, %i errors."
+        % (args.num_threads, args.num_threads * args.num_ops, total_time, num_errors)
+    )
+    if num_errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    import better_exchook
+
+    better_exchook.install()
+    main()
@@ -4,6 +4,8 @@ import os
 import socket
 import subprocess
 import time
+import threading
+import typing
 
 
 def better_repr(obj):
@@ -85,12 +87,28 @@ def is_git_dir(path):
     """
     assert os.path.isdir(path)
     try:
-        subprocess.check_call(["git", "status"], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Faster than "git status", which would scan the whole work tree.
+        subprocess.check_call(
+            ["git", "rev-parse", "--is-inside-work-tree"], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
         return True
     except subprocess.CalledProcessError:
         return False
 
 
+def make_git_ignored_dir(path):
+    """
+    Creates the directory (if needed), with a .gitignore which ignores everything in it.
+    For local state of the kiosk, which is not tracked in the DB Git repo.
+
+    :param str path:
+    """
+    os.makedirs(path, exist_ok=True)
+    if not os.path.exists("%s/.gitignore" % path):
+        with open("%s/.gitignore" % path, "w") as f:
+            f.write("*\n")
+
+
 def time_stamp():
     """
     :rtype: str
@@ -121,3 +139,139 @@ def enable_debug_threads(trace_thread_init=False):
             orig_thread_debug_init(self, *args, **kwargs)
 
         threading.Thread.__init__ = thread_debug_init
+
+
+class OwnerTrackingLock:
+    """
+    Lock (by default reentrant) which knows which thread holds it, and since when.
+    This is for debugging, e.g. to see which thread blocks the GUI (see :class:`gui.StallWatchdog`).
+    """
+
+    def __init__(self, name, reentrant=True):
+        """
+        :param str name: for debug output
+        :param bool reentrant: RLock or Lock
+        """
+        self.name = name
+        self._lock = threading.RLock() if reentrant else threading.Lock()
+        self._count = 0
+        self.owner = None  # type: typing.Optional[threading.Thread]
+        self.owner_since = None  # type: typing.Optional[float]  # time.monotonic()
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        :param bool blocking:
+        :param float timeout:
+        :rtype: bool
+        """
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._count += 1
+        if self._count == 1:
+            self.owner = threading.current_thread()
+            self.owner_since = time.monotonic()
+        return True
+
+    def release(self):
+        self._count -= 1
+        if self._count == 0:
+            self.owner = None
+            self.owner_since = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def get_owner_formatted(self):
+        """
+        :return: e.g. "<name> held by <thread> for 3.2 sec", or None if not held
+        :rtype: str|None
+        """
+        owner, owner_since = self.owner, self.owner_since  # no lock, so read both once
+        if owner is None or owner_since is None:
+            return None
+        return "%s held by %s for %.1f sec" % (self.name, owner.name, time.monotonic() - owner_since)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.get_owner_formatted() or "%s free" % self.name)
+
+
+class StartupPipeline:
+    """
+    Runs the startup phases, some of them concurrently in background threads,
+    and logs the timings per phase.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.timings = []  # type: typing.List[typing.Tuple[str,float,float,str]]  # name, start, duration, thread
+        self._lock = threading.Lock()
+
+    def run(self, name, func, *args):
+        """
+        Runs the phase in the current thread.
+
+        :param str name:
+        :param callable func:
+        :param args:
+        :return: result of func
+        """
+        start_time = time.monotonic()
+        res = func(*args)
+        duration = time.monotonic() - start_time
+        with self._lock:
+            self.timings.append((name, start_time - self.start_time, duration, threading.current_thread().name))
+        print("Startup: %s took %.2f sec (done after %.2f sec)." % (name, duration, time.monotonic() - self.start_time))
+        return res
+
+    def run_async(self, name, func, depends=()):
+        """
+        Runs the phase in a new thread, once the phases it depends on are finished.
+
+        :param str name:
+        :param callable func: gets the results of the dependencies as args
+        :param list[concurrent.futures.Future] depends:
+        :return: future of the result of func. if some dependency fails, this fails as well
+        :rtype: concurrent.futures.Future
+        """
+        from concurrent.futures import Future
+
+        future = Future()
+
+        def _thread_main():
+            # noinspection PyBroadException
+            try:
+                args = [dep.result() for dep in depends]
+                future.set_result(self.run(name, func, *args))
+            except BaseException as exc:
+                print("Startup: %s failed: %s: %s" % (name, type(exc).__name__, exc))
+                future.set_exception(exc)
+
+        threading.Thread(target=_thread_main, name="Startup-%s" % name, daemon=True).start()
+        return future
+
+    def mark(self, name):
+        """
+        Logs that some point in the startup was reached, e.g. the first frame of the GUI.
+
+        :param str name:
+        """
+        self.run(name, lambda: None)
+
+    def get_timings_formatted(self):
+        """
+        :return: all phases, sorted by start time, suitable for stdout
+        :rtype: str
+        """
+        with self._lock:
+            timings = sorted(self.timings, key=lambda item: item[1])
+        return "".join(
+            [
+                "%-20s start %6.2f sec, took %6.2f sec, thread %s\n" % (name, start, duration, thread)
+                for (name, start, duration, thread) in timings
+            ]
+        )